@@ -0,0 +1,64 @@
+import time
+import unittest
+from zingest.cache import TTLCache
+
+
+class TestCache(unittest.TestCase):
+
+    def test_hits_and_misses(self):
+        loads = []
+        cache = TTLCache(2, 60)
+        load = lambda key: loads.append(key) or key.upper()
+        self.assertEqual("A", cache.get_or_load("a", load))
+        self.assertEqual("A", cache.get_or_load("a", load))
+        self.assertEqual(["a"], loads)
+        self.assertEqual({'size': 1, 'hits': 1, 'negative_hits': 0, 'misses': 1}, cache.stats())
+
+    def test_lru(self):
+        loads = []
+        cache = TTLCache(2, 60)
+        load = lambda key: loads.append(key) or key
+        for key in ("a", "b", "a", "c", "a", "b"):
+            cache.get_or_load(key, load)
+        #b was the least recently used when c was added
+        self.assertEqual(["a", "b", "c", "b"], loads)
+
+    def test_expiry_and_invalidation(self):
+        loads = []
+        cache = TTLCache(2, 0.05)
+        load = lambda key: loads.append(key) or key
+        cache.get_or_load("a", load)
+        time.sleep(0.1)
+        cache.get_or_load("a", load)
+        cache.invalidate("a")
+        cache.get_or_load("a", load)
+        self.assertEqual(["a", "a", "a"], loads)
+
+    def test_negative_caching(self):
+        calls = []
+        def load(key):
+            calls.append(key)
+            raise KeyError(key)
+        cache = TTLCache(2, 60, 60, lambda e: isinstance(e, KeyError))
+        for _ in range(2):
+            with self.assertRaises(KeyError):
+                cache.get_or_load("a", load)
+        self.assertEqual(["a"], calls)
+        self.assertEqual(1, cache.stats()['negative_hits'])
+
+        #Other errors aren't cached
+        def fail(key):
+            calls.append(key)
+            raise ValueError(key)
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                cache.get_or_load("b", fail)
+        self.assertEqual(["a", "b", "b"], calls)
+
+    def test_bad_size(self):
+        with self.assertRaises(ValueError):
+            TTLCache(0, 60)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,277 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, inspect, text
+import zingest.db
+
+
+class TestDb(unittest.TestCase):
+
+    def setUp(self):
+        self.fd, self.dbfile = tempfile.mkstemp()
+        zingest.db.init({'Database': {'database': 'sqlite:///' + self.dbfile}})
+        self.lease = timedelta(minutes=5)
+
+    def tearDown(self):
+        os.close(self.fd)
+        os.remove(self.dbfile)
+
+    def create_old_ingest(self, uuid="fake_uuid"):
+        ingest_id = zingest.db.create_ingest(uuid, {"workflow_id": "fast"})
+        dbs = zingest.db.get_session()
+        ingest = dbs.query(zingest.db.Ingest).filter(zingest.db.Ingest.ingest_id == ingest_id).one()
+        ingest.timestamp = datetime.utcnow() - timedelta(hours=2)
+        dbs.commit()
+        dbs.close()
+        return ingest_id
+
+    def get_ingest(self, ingest_id):
+        dbs = zingest.db.get_session()
+        ingest = dbs.query(zingest.db.Ingest).filter(zingest.db.Ingest.ingest_id == ingest_id).one()
+        dbs.close()
+        return ingest
+
+    def test_claim(self):
+        ingest_id = self.create_old_ingest()
+        self.assertIsNotNone(zingest.db.claim_ingest(ingest_id, "node-a", self.lease))
+        self.assertIsNone(zingest.db.claim_ingest(ingest_id, "node-b", self.lease))
+        self.assertEqual("node-a", self.get_ingest(ingest_id).owner)
+
+        zingest.db.release_ingest(ingest_id, "node-a")
+        self.assertIsNone(self.get_ingest(ingest_id).owner)
+        self.assertIsNotNone(zingest.db.claim_ingest(ingest_id, "node-b", self.lease))
+
+    def test_expired_claim(self):
+        ingest_id = self.create_old_ingest()
+        self.assertIsNotNone(zingest.db.claim_ingest(ingest_id, "node-a", timedelta(minutes=-1)))
+        self.assertIsNotNone(zingest.db.claim_ingest(ingest_id, "node-b", self.lease))
+        self.assertEqual("node-b", self.get_ingest(ingest_id).owner)
+        #Releasing someone else's claim does nothing
+        zingest.db.release_ingest(ingest_id, "node-a")
+        self.assertEqual("node-b", self.get_ingest(ingest_id).owner)
+
+    def test_claim_backlog(self):
+        first = self.create_old_ingest("first")
+        second = self.create_old_ingest("second")
+        #Too recent to be retried yet
+        zingest.db.create_ingest("recent", {"workflow_id": "fast"})
+        hour_ago = datetime.utcnow() - timedelta(hours=1)
+
+        claimed = zingest.db.claim_backlog("node-a", self.lease, hour_ago)
+        self.assertEqual([first], [ ingest.get_id() for ingest in claimed ])
+        self.assertEqual("node-a", claimed[0].owner)
+        claimed = zingest.db.claim_backlog("node-b", self.lease, hour_ago, limit=5)
+        self.assertEqual([second], [ ingest.get_id() for ingest in claimed ])
+        self.assertEqual([], zingest.db.claim_backlog("node-c", self.lease, hour_ago))
+
+    def test_claim_backlog_exclude(self):
+        first = self.create_old_ingest("first")
+        second = self.create_old_ingest("second")
+        hour_ago = datetime.utcnow() - timedelta(hours=1)
+
+        claimed = zingest.db.claim_backlog("node-a", self.lease, hour_ago, exclude={first})
+        self.assertEqual([second], [ ingest.get_id() for ingest in claimed ])
+        zingest.db.release_ingest(second, "node-a")
+        self.assertEqual([], zingest.db.claim_backlog("node-a", self.lease, hour_ago, exclude={first, second}))
+
+    def set_in_progress(self, ingest_id, timestamp):
+        dbs = zingest.db.get_session()
+        ingest = dbs.query(zingest.db.Ingest).filter(zingest.db.Ingest.ingest_id == ingest_id).one()
+        ingest.status = zingest.db.Status.IN_PROGRESS
+        ingest.timestamp = timestamp
+        dbs.commit()
+        dbs.close()
+
+    def test_heartbeat(self):
+        ingest_id = self.create_old_ingest()
+        zingest.db.claim_ingest(ingest_id, "node-a", self.lease)
+        self.set_in_progress(ingest_id, datetime.utcnow() - timedelta(hours=2))
+        before = self.get_ingest(ingest_id).heartbeat
+
+        self.assertEqual(1, zingest.db.heartbeat_ingests([ingest_id], "node-a", self.lease))
+        self.assertGreaterEqual(self.get_ingest(ingest_id).heartbeat, before)
+        #Only the owner can beat for an ingest
+        self.assertEqual(0, zingest.db.heartbeat_ingests([ingest_id], "node-b", self.lease))
+        #The heartbeat is fresh, so the old timestamp doesn't matter
+        self.assertEqual([], zingest.db.find_stale_ingests(datetime.utcnow() - timedelta(minutes=10)))
+
+    def test_requeue_stale(self):
+        ingest_id = self.create_old_ingest()
+        zingest.db.claim_ingest(ingest_id, "node-a", self.lease)
+        self.set_in_progress(ingest_id, datetime.utcnow() - timedelta(hours=2))
+        #Everything up until now is stale
+        stale_before = datetime.utcnow() + timedelta(seconds=1)
+
+        self.assertEqual([ingest_id], [ ingest.get_id() for ingest in zingest.db.find_stale_ingests(stale_before) ])
+        self.assertEqual(zingest.db.Status.FAILED, zingest.db.requeue_stale_ingest(ingest_id, stale_before, 10))
+        #Only one reaper wins
+        self.assertIsNone(zingest.db.requeue_stale_ingest(ingest_id, stale_before, 10))
+        ingest = self.get_ingest(ingest_id)
+        #The crash counts as a failed attempt, which is due straight away
+        self.assertEqual(zingest.db.Status.FAILED, ingest.status)
+        self.assertEqual(1, ingest.attempts)
+        self.assertLessEqual(ingest.next_attempt_at, datetime.utcnow())
+        self.assertIsNone(ingest.owner)
+        self.assertIsNotNone(zingest.db.claim_ingest(ingest_id, "node-b", self.lease))
+
+    def test_requeue_stale_dead_letter(self):
+        ingest_id = self.create_old_ingest()
+        statuses = []
+        for crash in range(3):
+            self.assertIsNotNone(zingest.db.claim_ingest(ingest_id, "node-a", self.lease))
+            self.set_in_progress(ingest_id, datetime.utcnow() - timedelta(hours=2))
+            statuses.append(zingest.db.requeue_stale_ingest(ingest_id, datetime.utcnow() + timedelta(seconds=1), 3))
+        #A recording which keeps killing its uploader is given up on like any other failure
+        self.assertEqual([zingest.db.Status.FAILED, zingest.db.Status.FAILED, zingest.db.Status.DEAD_LETTER], statuses)
+        ingest = self.get_ingest(ingest_id)
+        self.assertEqual(3, ingest.attempts)
+        self.assertIsNone(ingest.next_attempt_at)
+        self.assertEqual([], zingest.db.claim_backlog("node-a", self.lease, datetime.utcnow(), limit=5))
+
+    def test_stale_without_heartbeat(self):
+        ingest_id = self.create_old_ingest()
+        self.set_in_progress(ingest_id, datetime.utcnow() - timedelta(hours=2))
+        self.assertEqual(1, len(zingest.db.find_stale_ingests(datetime.utcnow() - timedelta(minutes=10))))
+
+    def test_retry_schedule(self):
+        ingest_id = self.create_old_ingest()
+        hour_ago = datetime.utcnow() - timedelta(hours=1)
+        zingest.db.claim_ingest(ingest_id, "node-a", self.lease)
+        status = zingest.db.record_failure(ingest_id, 1, "Broken", datetime.utcnow() + timedelta(minutes=5))
+        zingest.db.release_ingest(ingest_id, "node-a")
+        self.assertEqual(zingest.db.Status.FAILED, status)
+        self.assertEqual("Broken", self.get_ingest(ingest_id).last_error)
+
+        #Not due yet
+        self.assertEqual([], zingest.db.claim_backlog("node-a", self.lease, hour_ago))
+        self.assertGreater(zingest.db.next_attempt_due(), datetime.utcnow())
+
+        zingest.db.record_failure(ingest_id, 2, "Broken", datetime.utcnow() - timedelta(seconds=1))
+        self.assertEqual([ingest_id], [ ingest.get_id() for ingest in zingest.db.claim_backlog("node-a", self.lease, hour_ago) ])
+
+    def test_claim_overdue(self):
+        ingest_id = self.create_old_ingest()
+        self.create_old_ingest("new")
+        zingest.db.record_failure(ingest_id, 1, "Broken", datetime.utcnow() - timedelta(minutes=5))
+        hour_ago = datetime.utcnow() - timedelta(hours=1)
+
+        #Due, but not overdue yet, and new ingests are left alone
+        self.assertEqual([], zingest.db.claim_backlog("node-a", self.lease, None, due_before=hour_ago))
+        claimed = zingest.db.claim_backlog("node-a", self.lease, None, limit=5, due_before=datetime.utcnow() - timedelta(minutes=1))
+        self.assertEqual([ingest_id], [ ingest.get_id() for ingest in claimed ])
+
+    def test_dead_letter(self):
+        ingest_id = self.create_old_ingest()
+        self.assertEqual(zingest.db.Status.DEAD_LETTER, zingest.db.record_failure(ingest_id, 10, "Broken"))
+        self.assertEqual([], zingest.db.claim_backlog("node-a", self.lease, datetime.utcnow()))
+        self.assertIsNone(zingest.db.claim_ingest(ingest_id, "node-a", self.lease))
+        self.assertIsNone(zingest.db.next_attempt_due())
+
+    def test_checkpoint(self):
+        ingest_id = self.create_old_ingest()
+        self.assertEqual({}, self.get_ingest(ingest_id).get_checkpoint())
+        #Only the owner can record progress
+        self.assertFalse(zingest.db.save_checkpoint(ingest_id, "node-a", {'completed': ['catalogs']}))
+        zingest.db.claim_ingest(ingest_id, "node-a", self.lease)
+        self.assertTrue(zingest.db.save_checkpoint(ingest_id, "node-a", {'completed': ['catalogs']}))
+        self.assertEqual({'completed': ['catalogs']}, self.get_ingest(ingest_id).get_checkpoint())
+
+    def test_queued_ingest(self):
+        ingest_id = zingest.db.create_queued_ingest("fake_uuid", {"workflow_id": "fast"}, "bulk", "host", 1024)
+        self.assertEqual("fake_uuid", self.get_ingest(ingest_id).uuid)
+        published = []
+        publish = lambda entries: published.extend(entry.get_message_args() for entry in entries)
+        self.assertEqual(1, zingest.db.relay_outbox(publish))
+        self.assertEqual([("fake_uuid", ingest_id, "bulk", "host", 1024)], published)
+        #Published entries are gone
+        self.assertEqual(0, zingest.db.relay_outbox(publish))
+
+    def test_outbox_publish_failure(self):
+        first = zingest.db.create_queued_ingest("first", {"workflow_id": "fast"}, "webhook")
+        second = zingest.db.create_queued_ingest("second", {"workflow_id": "fast"}, "webhook")
+        def fail(entries):
+            raise ConnectionError("Queue is down")
+        with self.assertRaises(ConnectionError):
+            zingest.db.relay_outbox(fail)
+        #Nothing is lost, and the entries come out oldest first
+        published = []
+        publish = lambda entries: published.extend(entry.ingest_id for entry in entries)
+        self.assertEqual(1, zingest.db.relay_outbox(publish, limit=1))
+        self.assertEqual(1, zingest.db.relay_outbox(publish, limit=1))
+        self.assertEqual([first, second], published)
+
+    def test_webhook_events(self):
+        first = zingest.db.create_webhook_event("recording.completed", {"event": "recording.completed"})
+        second = zingest.db.create_webhook_event("recording.renamed", {"event": "recording.renamed"})
+        claimed = zingest.db.claim_webhook_events(self.lease)
+        self.assertEqual([first, second], [ event.event_id for event in claimed ])
+        self.assertEqual({"event": "recording.completed"}, claimed[0].get_body())
+        #Claimed events aren't handed out again until the lease expires
+        self.assertEqual([], zingest.db.claim_webhook_events(self.lease))
+
+        zingest.db.complete_webhook_event(first)
+        zingest.db.fail_webhook_event(second, 1, "Broken", datetime.utcnow() - timedelta(seconds=1))
+        claimed = zingest.db.claim_webhook_events(self.lease)
+        self.assertEqual([second], [ event.event_id for event in claimed ])
+        self.assertEqual(1, claimed[0].attempts)
+        #Given up on, but kept
+        zingest.db.fail_webhook_event(second, 2, "Broken")
+        self.assertEqual([], zingest.db.claim_webhook_events(timedelta(seconds=-1)))
+
+    def test_event_keys(self):
+        day = timedelta(days=1)
+        self.assertTrue(zingest.db.record_event_key("recording.completed:uuid", day))
+        self.assertFalse(zingest.db.record_event_key("recording.completed:uuid", day))
+        #Expired keys count as new
+        self.assertTrue(zingest.db.record_event_key("recording.completed:uuid", timedelta(seconds=-1)))
+        zingest.db.forget_event_key("recording.completed:uuid")
+        self.assertTrue(zingest.db.record_event_key("recording.completed:uuid", day))
+        self.assertEqual(1, zingest.db.purge_event_keys(datetime.utcnow() + timedelta(seconds=1)))
+
+    def test_recording_files(self):
+        hour_ago = datetime.utcnow() - timedelta(hours=1)
+        files = [{"id": "b", "recording_start": "2021-01-01T10:00:00Z", "file_type": "MP4", "status": "completed"},
+                 {"id": "a", "recording_start": "2021-01-01T09:00:00Z", "file_type": "CHAT", "status": "processing"},
+                 {"recording_start": "2021-01-01T09:00:00Z", "file_type": "MP4"}]
+        zingest.db.save_recording_files("uuid", files)
+        catalogued = zingest.db.find_recording_files("uuid", hour_ago)
+        self.assertEqual(["a", "b"], [ file.serialize()['recording_id'] for file in catalogued ])
+        self.assertEqual([False, True], [ file.is_complete() for file in catalogued ])
+        #Saving again replaces the old entries
+        zingest.db.save_recording_files("uuid", files[:1])
+        self.assertEqual(1, len(zingest.db.find_recording_files("uuid", hour_ago)))
+        #Stale entries aren't returned
+        self.assertEqual([], zingest.db.find_recording_files("uuid", datetime.utcnow() + timedelta(seconds=1)))
+
+    def test_find_users_by_ids(self):
+        zingest.db.create_user("a", "Ada", "Lovelace", "ada@example.com")
+        zingest.db.create_user("b", "Alan", "Turing", "alan@example.com")
+        users = zingest.db.find_users_by_ids(["a", "b", "a", "missing"])
+        self.assertEqual(["a", "b"], sorted(users))
+        self.assertEqual("Lovelace", users["a"].last_name)
+        self.assertEqual({}, zingest.db.find_users_by_ids([]))
+
+    def test_upgrade(self):
+        engine = create_engine('sqlite:///' + self.dbfile)
+        with engine.begin() as connection:
+            connection.execute(text("DROP TABLE ingest"))
+            connection.execute(text("CREATE TABLE ingest (id INTEGER PRIMARY KEY, uuid VARCHAR(32) NOT NULL, status INTEGER NOT NULL, timestamp DATETIME NOT NULL, is_webhook BOOLEAN NOT NULL, zingest_parms BLOB NOT NULL, mediapackage_id VARCHAR(36), workflow_id VARCHAR(36))"))
+        zingest.db.upgrade(engine)
+
+        inspector = inspect(engine)
+        columns = [ column['name'] for column in inspector.get_columns('ingest') ]
+        self.assertIn('owner', columns)
+        self.assertIn('lease_expires', columns)
+        self.assertIn('heartbeat', columns)
+        self.assertIn('attempts', columns)
+        self.assertIn('checkpoint', columns)
+        self.assertIn('ix_ingest_status_next_attempt', [ index['name'] for index in inspector.get_indexes('ingest') ])
+        self.assertIn('ix_ingest_status_timestamp', [ index['name'] for index in inspector.get_indexes('ingest') ])
+        self.assertIn('ix_ingest_uuid_is_webhook', [ index['name'] for index in inspector.get_indexes('ingest') ])
+        #Running it again is harmless
+        zingest.db.upgrade(engine)
+
+
+if __name__ == '__main__':
+    unittest.main()
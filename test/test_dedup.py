@@ -0,0 +1,66 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+import zingest.db
+from zingest.dedup import EventDeduplicator
+
+
+class TestDedup(unittest.TestCase):
+
+    def setUp(self):
+        self.fd, self.dbfile = tempfile.mkstemp()
+        zingest.db.init({'Database': {'database': 'sqlite:///' + self.dbfile}})
+        self.config = {"Webhook": {"dedup_cache_size": "2"}}
+
+    def tearDown(self):
+        os.close(self.fd)
+        os.remove(self.dbfile)
+
+    def test_event_key(self):
+        completed = {"event": "recording.completed", "payload": {"object": {"uuid": "abc", "topic": "Old"}}}
+        renamed = {"event": "recording.renamed", "payload": {"object": {"uuid": "abc", "topic": "New"}}}
+        self.assertEqual("recording.completed:abc", EventDeduplicator.event_key(completed))
+        self.assertEqual("recording.renamed:abc:New", EventDeduplicator.event_key(renamed))
+        self.assertIsNone(EventDeduplicator.event_key({"event": "recording.completed"}))
+
+    def test_duplicates(self):
+        dedup = EventDeduplicator(self.config)
+        self.assertFalse(dedup.is_duplicate("a"))
+        dedup.remember("a")
+        #Answered from memory, without the database
+        with patch("zingest.db.record_event_key") as record:
+            self.assertTrue(dedup.is_duplicate("a"))
+            record.assert_not_called()
+        self.assertEqual({'cached': 1, 'hits': 1, 'misses': 1}, dedup.stats())
+
+    def test_evicted_and_other_processes(self):
+        dedup = EventDeduplicator(self.config)
+        for key in ("a", "b", "c"):
+            self.assertFalse(dedup.is_duplicate(key))
+            dedup.remember(key)
+        #"a" has been evicted from memory, but the database still knows it
+        self.assertEqual(2, dedup.stats()['cached'])
+        self.assertTrue(dedup.is_duplicate("a"))
+        #As does another process
+        self.assertTrue(EventDeduplicator(self.config).is_duplicate("b"))
+
+    def test_forget(self):
+        dedup = EventDeduplicator(self.config)
+        self.assertFalse(dedup.is_duplicate("a"))
+        dedup.forget("a")
+        self.assertFalse(dedup.is_duplicate("a"))
+
+    def test_forget_in_other_process(self):
+        first = EventDeduplicator(self.config)
+        second = EventDeduplicator(self.config)
+        self.assertFalse(first.is_duplicate("a"))
+        #A redelivery while the first process is still working on it
+        self.assertTrue(second.is_duplicate("a"))
+        #Processing fails, and the next redelivery is processed wherever it lands
+        first.forget("a")
+        self.assertFalse(second.is_duplicate("a"))
+
+
+if __name__ == '__main__':
+    unittest.main()
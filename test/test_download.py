@@ -0,0 +1,143 @@
+import json
+import os
+import re
+import shutil
+import tempfile
+import unittest
+import requests_mock
+from requests_toolbelt.multipart.encoder import MultipartEncoder
+from zingest.download import Downloader, DownloadException, StreamingTrack
+
+url = "https://us02web.zoom.us/rec/download/fake"
+content = bytes(range(256)) * 40
+
+
+def range_callback(request, context):
+    match = re.match(r"bytes=(\d+)-(\d+)", request.headers.get('Range', ''))
+    if not match:
+        context.status_code = 200
+        return content
+    start, end = int(match.group(1)), int(match.group(2))
+    context.status_code = 206
+    context.headers['Content-Range'] = f"bytes { start }-{ end }/{ len(content) }"
+    return content[start:end + 1]
+
+
+class TestDownload(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.output = os.path.join(self.tempdir, "fake.mp4")
+        self.config = {"Uploader": {"download_connections": "4", "download_segment_mb": "1"}}
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def create_downloader(self, segment_size=1000):
+        downloader = Downloader(self.config)
+        #Segments are configured in MB, shrink them so the tests don't need large files
+        downloader.segment_size = segment_size
+        return downloader
+
+    def read_output(self):
+        with open(self.output, 'rb') as fd:
+            return fd.read()
+
+    def test_defaults(self):
+        downloader = Downloader({})
+        self.assertEqual(1, downloader.connections)
+        self.assertEqual(64 * 1024 * 1024, downloader.segment_size)
+
+    @requests_mock.Mocker()
+    def test_segmented(self, mocker):
+        download = mocker.get(url, content=range_callback)
+        self.create_downloader().download(url, self.output, len(content))
+
+        self.assertEqual(content, self.read_output())
+        #One probe, plus one request per segment
+        self.assertEqual(1 + 11, download.call_count)
+        self.assertFalse(os.path.isfile(f"{ self.output }.part"))
+        self.assertFalse(os.path.isfile(f"{ self.output }.journal"))
+
+    @requests_mock.Mocker()
+    def test_no_range_support(self, mocker):
+        download = mocker.get(url, content=content)
+        self.create_downloader().download(url, self.output, len(content))
+
+        self.assertEqual(content, self.read_output())
+        #The probe, then the fallback single stream
+        self.assertEqual(2, download.call_count)
+
+    @requests_mock.Mocker()
+    def test_single_stream(self, mocker):
+        download = mocker.get(url, content=range_callback)
+        self.config["Uploader"]["download_connections"] = "1"
+        self.create_downloader().download(url, self.output, len(content))
+
+        self.assertEqual(content, self.read_output())
+        self.assertEqual(1, download.call_count)
+
+    def write_partial(self, identity, done):
+        with open(f"{ self.output }.part", 'wb') as fd:
+            fd.truncate(len(content))
+            for start, end in done:
+                fd.seek(start)
+                fd.write(content[start:end])
+        with open(f"{ self.output }.journal", 'w') as fd:
+            json.dump({'identity': identity, 'size': len(content), 'done': done}, fd)
+
+    @requests_mock.Mocker()
+    def test_resume(self, mocker):
+        download = mocker.get(url, content=range_callback)
+        self.write_partial(url, [[0, 5000]])
+        self.create_downloader().download(f"{ url }?access_token=new", self.output, len(content))
+
+        self.assertEqual(content, self.read_output())
+        ranges = [ request.headers['Range'] for request in download.request_history ]
+        #The probe, then only the segments after byte 5000, which are fetched in parallel so may arrive in any order
+        self.assertEqual('bytes=0-0', ranges[0])
+        self.assertEqual(['bytes=10000-10239', 'bytes=5000-5999', 'bytes=6000-6999', 'bytes=7000-7999', 'bytes=8000-8999', 'bytes=9000-9999'], sorted(ranges[1:]))
+
+    @requests_mock.Mocker()
+    def test_resume_single_connection(self, mocker):
+        download = mocker.get(url, content=range_callback)
+        self.config["Uploader"]["download_connections"] = "1"
+        self.write_partial(url, [[0, 2500]])
+        self.create_downloader(segment_size=len(content)).download(url, self.output, len(content))
+
+        self.assertEqual(content, self.read_output())
+        self.assertEqual(['bytes=0-0', f'bytes=2500-{ len(content) - 1 }'], [ request.headers['Range'] for request in download.request_history ])
+
+    @requests_mock.Mocker()
+    def test_resume_different_file(self, mocker):
+        download = mocker.get(url, content=range_callback)
+        self.config["Uploader"]["download_connections"] = "1"
+        self.write_partial("https://us02web.zoom.us/rec/download/other", [[0, 5000]])
+        self.create_downloader().download(url, self.output, len(content))
+
+        self.assertEqual(content, self.read_output())
+        #The journal does not match, so the file is downloaded again from the start
+        self.assertEqual(1, download.call_count)
+        self.assertNotIn('Range', download.last_request.headers)
+
+    @requests_mock.Mocker()
+    def test_streaming_track(self, mocker):
+        mocker.get(url, content=content)
+        #A tiny buffer forces the reader to wait on the download thread
+        with StreamingTrack(url, "fake.mp4", len(content), 1) as track:
+            encoder = MultipartEncoder(fields={'flavor': 'presentation/source', 'BODY': (track.name, track, "video/mp4")})
+            expected_len = encoder.len
+            body = encoder.read()
+        self.assertEqual(expected_len, len(body))
+        self.assertIn(content, body)
+
+    @requests_mock.Mocker()
+    def test_streaming_track_truncated(self, mocker):
+        mocker.get(url, content=content[:100])
+        with StreamingTrack(url, "fake.mp4", len(content), 1024) as track:
+            with self.assertRaises(DownloadException):
+                track.read()
+
+
+if __name__ == '__main__':
+    unittest.main()
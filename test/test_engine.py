@@ -0,0 +1,214 @@
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+from zingest.common import RecordingNotFound
+from zingest.opencast import IngestJob, Opencast
+
+try:
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+    from zingest.engine import AsyncEngine
+except ImportError:
+    AsyncEngine = None
+
+ingest = dict()
+for event in ("add-dc", "add-track", "create-mp", "ingest"):
+    with open(f'test/resources/opencast/{ event }.xml', 'r') as xml:
+        ingest[event] = xml.read()
+
+
+class FakeOpencast:
+    """Records the steps each job goes through"""
+
+    HEADERS = Opencast.HEADERS
+
+    def __init__(self):
+        self.workers = 1
+        self.user = "test_user"
+        self.password = "test_password"
+        self._fail = MagicMock()
+
+    def _step(self, name):
+        def step(job):
+            job.append(name)
+        return step
+
+    def __getattr__(self, name):
+        return self._step(name)
+
+
+@unittest.skipUnless(AsyncEngine, "aiohttp is not installed")
+class TestEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.opencast = FakeOpencast()
+        self.config = {"Uploader": {"metadata_workers": "4", "download_workers": "4"}}
+
+    def _fake_steps(self, engine):
+        #The async steps, without the transfers
+        for name in ('_download_media', '_build_mediapackage', '_upload_track', '_trigger_workflow'):
+            async def step(job, name=name):
+                job.append(name)
+            setattr(engine, name, step)
+
+    def test_limits(self):
+        engine = AsyncEngine(self.config, self.opencast)
+        self.assertEqual(4, engine.limits['metadata'])
+        self.assertEqual(1, engine.limits['upload'])
+        self.assertEqual((4 + 4 + 1 + 1 + 1) * 4, engine.in_flight)
+
+    def test_process(self):
+        engine = AsyncEngine(self.config, self.opencast)
+        self._fake_steps(engine)
+        job = []
+        engine.process_threadsafe(job)
+        self.assertEqual(['_mark_in_progress', '_fetch_files', '_download_media', '_build_mediapackage', '_upload_track', '_trigger_workflow', '_clean_up', '_update_ingest'], job)
+
+    def test_step_concurrency(self):
+        engine = AsyncEngine(self.config, self.opencast)
+        self._fake_steps(engine)
+        uploading = []
+        async def upload(job):
+            uploading.append(engine.active['upload'])
+            await asyncio.sleep(0.05)
+        engine._upload_track = upload
+        async def run_all():
+            await asyncio.gather(*[ engine.process([]) for i in range(4) ])
+        asyncio.run_coroutine_threadsafe(run_all(), engine.loop).result(timeout=10)
+        #Only one upload at a time, even though all four recordings were fetched in parallel
+        self.assertEqual([1, 1, 1, 1], uploading)
+
+    def test_missing_recording(self):
+        def missing(job):
+            raise RecordingNotFound("missing")
+        self.opencast._mark_in_progress = missing
+        engine = AsyncEngine(self.config, self.opencast)
+        job = []
+        with self.assertRaises(RecordingNotFound):
+            engine.process_threadsafe(job)
+        self.assertEqual([], job)
+
+    def test_rabbit_callback_failure(self):
+        def fail(job):
+            raise FileNotFoundError("missing")
+        self.opencast._fetch_files = fail
+        self.opencast._find_ingest = lambda body: MagicMock()
+        self.opencast._claim = lambda ingest: True
+        self.opencast._create_job = lambda ingest: MagicMock(uuid="fake_uuid")
+        engine = AsyncEngine(self.config, self.opencast)
+        asyncio.run_coroutine_threadsafe(engine.rabbit_callback(None, None, b'{}'), engine.loop).result(timeout=10)
+        self.assertIsInstance(self.opencast._fail.call_args.args[1], FileNotFoundError)
+
+
+@unittest.skipUnless(AsyncEngine, "aiohttp is not installed")
+class TestEngineTransfers(unittest.TestCase):
+    """The real steps, against a local server standing in for both Zoom and Opencast"""
+
+    TRACK = os.urandom(256 * 1024)
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.requests = []
+        app = web.Application()
+        app.router.add_get('/download/track', self._download)
+        app.router.add_get('/ingest/createMediaPackage', self._respond(ingest['create-mp']))
+        app.router.add_post('/ingest/addDCCatalog', self._respond(ingest['add-dc']))
+        app.router.add_post('/ingest/addTrack', self._respond(ingest['add-track']))
+        app.router.add_post('/ingest/ingest/{workflow}', self._respond(ingest['ingest']))
+        app.router.add_post('/ingest/addMediaPackage/{workflow}', self._respond(ingest['ingest']))
+        app.router.add_get('/info/me.json', self._respond('{}'))
+        self.server = TestServer(app)
+
+        self.opencast = Opencast.__new__(Opencast)
+        self.opencast.logger = logging.getLogger(Opencast.__module__)
+        self.opencast.workers = 1
+        self.opencast.user = "test_user"
+        self.opencast.password = "test_password"
+        self.opencast.IN_PROGRESS_ROOT = self.tempdir
+        self.opencast.track_mode = 'spool'
+        self.opencast.zoom = MagicMock()
+        self.opencast.zoom.get_download_token = MagicMock(return_value="token")
+        self.opencast._fetch_files = self._fetch_files
+        self.opencast._prepare_mediapackage = self._prepare_mediapackage
+        for name in ('_mark_in_progress', '_clean_up', '_update_ingest'):
+            setattr(self.opencast, name, MagicMock())
+        self.engine = AsyncEngine({}, self.opencast)
+        asyncio.run_coroutine_threadsafe(self.server.start_server(), self.engine.loop).result(timeout=10)
+        self.opencast.url = str(self.server.make_url('')).rstrip('/')
+
+    def tearDown(self):
+        asyncio.run_coroutine_threadsafe(self.server.close(), self.engine.loop).result(timeout=10)
+        shutil.rmtree(self.tempdir)
+
+    def _respond(self, text):
+        async def respond(request):
+            form = await request.post() if request.can_read_body else {}
+            #Uploaded files are closed once the response is sent
+            self.requests.append((request.path, { name: value if isinstance(value, str) else value.file.read() for name, value in form.items() }))
+            return web.Response(text=text)
+        return respond
+
+    async def _download(self, request):
+        self.requests.append((request.path, request.query.get('access_token')))
+        return web.Response(body=self.TRACK)
+
+    def _fetch_files(self, job):
+        job.files = [{'recording_id': 'track', 'recording_type': 'shared_screen_with_speaker_view', 'file_extension': 'MP4',
+                      'file_size': len(self.TRACK), 'download_url': str(self.server.make_url('/download/track'))}]
+        job.preferences = Opencast.RECORDING_TYPE_PREFERENCE
+
+    def _prepare_mediapackage(self, job):
+        job.workflow_id = 'fast'
+        job.ep_dc = '<dublincore/>'
+        return True
+
+    def test_process(self):
+        job = IngestJob("fake_uuid", {})
+        self.engine.process_threadsafe(job)
+
+        paths = [ path for path, body in self.requests ]
+        self.assertEqual(['/download/track', '/ingest/createMediaPackage', '/ingest/addDCCatalog', '/info/me.json', '/ingest/addTrack', '/ingest/ingest/fast'], paths)
+        self.assertEqual('token', self.requests[0][1])
+        upload = self.requests[4][1]
+        self.assertEqual(self.TRACK, upload['BODY'])
+        self.assertEqual('track.mp4', upload['fileName'])
+        self.assertEqual(ingest['add-track'], self.requests[5][1]['mediaPackage'])
+        self.assertEqual('5267', job.workflow_instance_id)
+        self.assertEqual(['catalogs', 'track', 'ingest'], job.checkpoint['completed'])
+        self.opencast._clean_up.assert_called_once_with(job)
+
+    def test_single_request_by_url(self):
+        self.opencast.track_mode = 'url'
+        self.opencast.url_token_lifetime = 3600
+        def prepare(job):
+            self._prepare_mediapackage(job)
+            job.single_request = True
+            return False
+        self.opencast._prepare_mediapackage = prepare
+        job = IngestJob("fake_uuid", {})
+        job.direct = True
+        self.engine.process_threadsafe(job)
+
+        #Opencast fetches the track itself, so nothing is downloaded
+        self.assertEqual(['/ingest/addMediaPackage/fast'], [ path for path, body in self.requests ])
+        self.assertEqual(str(self.server.make_url('/download/track')) + '?access_token=token', self.requests[0][1]['mediaUri'])
+        self.assertEqual('<dublincore/>', self.requests[0][1]['episodeDCCatalog'])
+        self.assertEqual('5267', job.workflow_instance_id)
+
+    def test_resume_download(self):
+        output = f"{ self.tempdir }/track.mp4"
+        with open(f"{ output }.part", 'wb') as part:
+            part.write(self.TRACK[:1000])
+        #The server ignores the Range header, so the download starts over
+        asyncio.run_coroutine_threadsafe(self.engine.download(str(self.server.make_url('/download/track')), output, len(self.TRACK)), self.engine.loop).result(timeout=10)
+        with open(output, 'rb') as track:
+            self.assertEqual(self.TRACK, track.read())
+        self.assertFalse(os.path.exists(f"{ output }.part"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import multiprocessing
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+import zingest.db
+from zingest.events import WebhookEventWorker
+
+
+class TestEvents(unittest.TestCase):
+
+    def setUp(self):
+        self.fd, self.dbfile = tempfile.mkstemp()
+        zingest.db.init({'Database': {'database': 'sqlite:///' + self.dbfile}})
+        self.config = {"Webhook": {"event_batch_size": "2", "event_interval": "0.05", "event_max_attempts": "2"}}
+
+    def tearDown(self):
+        os.close(self.fd)
+        os.remove(self.dbfile)
+
+    def get_events(self):
+        dbs = zingest.db.get_session()
+        events = dbs.query(zingest.db.WebhookEvent).all()
+        dbs.close()
+        return events
+
+    def test_process(self):
+        handled = []
+        ids = [ zingest.db.create_webhook_event("recording.completed", {"id": i}) for i in range(3) ]
+        worker = WebhookEventWorker(self.config, lambda body: handled.append(body['id']))
+        self.assertEqual(3, worker.process())
+        self.assertEqual([0, 1, 2], handled)
+        self.assertEqual([], self.get_events())
+
+    def test_retry(self):
+        def fail(body):
+            raise ConnectionError("Zoom is down")
+        event_id = zingest.db.create_webhook_event("recording.completed", {})
+        worker = WebhookEventWorker(self.config, fail)
+        self.assertEqual(1, worker.process())
+        event = self.get_events()[0]
+        self.assertEqual(1, event.attempts)
+        self.assertEqual("Zoom is down", event.last_error)
+        self.assertGreater(event.available_at, datetime.utcnow() + timedelta(seconds=50))
+
+        #Make the retry due now, then it runs out of attempts
+        zingest.db.fail_webhook_event(event_id, 1, "Zoom is down", datetime.utcnow())
+        self.assertEqual(1, worker.process())
+        event = self.get_events()[0]
+        self.assertEqual(2, event.attempts)
+        self.assertIsNone(event.available_at)
+
+    def test_worker_thread(self):
+        handled = []
+        worker = WebhookEventWorker(self.config, lambda body: handled.append(body['id']))
+        worker.start()
+        try:
+            zingest.db.create_webhook_event("recording.completed", {"id": 1})
+            worker.wake()
+            for _ in range(100):
+                if handled:
+                    break
+                worker.stopped.wait(0.05)
+        finally:
+            worker.stop()
+        self.assertEqual([1], handled)
+
+    def test_wake_from_forked_process(self):
+        handled = []
+        #Long enough that only the wakeup can explain a prompt pick up
+        worker = WebhookEventWorker({"Webhook": {"event_workers": "2", "event_interval": "60"}}, lambda body: handled.append(body['id']))
+        worker.start()
+        try:
+            worker.stopped.wait(0.1)
+            zingest.db.create_webhook_event("recording.completed", {"id": 1})
+            #As a gunicorn worker would, after the master started the event workers
+            child = multiprocessing.get_context('fork').Process(target=worker.wake)
+            child.start()
+            child.join()
+            for _ in range(100):
+                if handled:
+                    break
+                worker.stopped.wait(0.05)
+        finally:
+            worker.stop()
+        self.assertEqual([1], handled)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+import unittest
+from zingest.occupancy import OccupancyPublisher
+
+
+class TestOccupancy(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "in-progress", "occupancy.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_publish(self):
+        stages = {'upload': {'workers': 3, 'busy': 1, 'blocked': 0, 'queued': 2}}
+        self.assertIsNone(OccupancyPublisher.read(self.path))
+        OccupancyPublisher(self.path, lambda: stages).publish()
+        occupancy, age = OccupancyPublisher.read(self.path)
+        self.assertEqual(stages, occupancy)
+        self.assertLess(age, 5)
+        #Only the finished file is left behind
+        self.assertEqual(["occupancy.json"], os.listdir(os.path.dirname(self.path)))
+
+    def test_thread(self):
+        publisher = OccupancyPublisher(self.path, lambda: None, interval=60)
+        publisher.start()
+        try:
+            for _ in range(100):
+                if OccupancyPublisher.read(self.path):
+                    break
+                publisher.stopped.wait(0.05)
+        finally:
+            publisher.stop()
+        #Without the pipeline there is no occupancy, but the uploader is still known to be running
+        self.assertIsNone(OccupancyPublisher.read(self.path)[0])
+
+    def test_uploader_names(self):
+        #The uploader can't be imported here, it connects to the queue at import, so check it at least compiles
+        #without referring to anything it doesn't define or import
+        import ast
+        import builtins
+        with open(os.path.join(os.path.dirname(__file__), "..", "uploader.py")) as f:
+            tree = ast.parse(f.read())
+        defined = set(dir(builtins))
+        for node in ast.walk(tree):
+            if isinstance(node, (ast.Import, ast.ImportFrom)):
+                defined.update((alias.asname or alias.name).split('.')[0] for alias in node.names)
+            elif isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+                defined.add(node.name)
+            elif isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
+                defined.add(node.id)
+            elif isinstance(node, ast.arg):
+                defined.add(node.arg)
+        used = { node.id for node in ast.walk(tree) if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load) }
+        self.assertEqual(set(), used - defined)
+
+
+if __name__ == '__main__':
+    unittest.main()
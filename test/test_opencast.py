@@ -1,7 +1,9 @@
 import os
 import tempfile
 import json
+from datetime import datetime, timedelta
 import unittest
+import requests
 import requests_mock
 import re
 import xmltodict
@@ -9,7 +11,7 @@ from unittest.mock import MagicMock, patch
 from logger import init_logger
 from zingest.rabbit import Rabbit
 from zingest.zoom import Zoom
-from zingest.opencast import Opencast
+from zingest.opencast import Opencast, PrimedDigestAuth, redact_tokens
 import tempfile
 import shutil
 import zingest.db
@@ -210,6 +212,74 @@ class TestOpencast(unittest.TestCase):
         self.assertEqual("b1d7f8d2-91fd-4710-8c63-17e3e14749a9", ingest_db_record.get_mediapackage_id())
         self.assertEqual("5267", ingest_db_record.get_workflow_id())
 
+    @requests_mock.Mocker()
+    def test_callback_resumes_from_checkpoint(self, mocker):
+        mocker.get('//localhost/api/series/series.json?count=100', text="[]")
+        opencast, _, mock_dict = self.create_mock_opencast(mocker)
+        #An earlier attempt added the track, then failed to start the workflow
+        db = zingest.db.get_session()
+        ingest_db_record = db.query(zingest.db.Ingest).one()
+        ingest_db_record.update_status(zingest.db.Status.FAILED)
+        ingest_db_record.set_checkpoint({'mediapackage': ingest['add-track'], 'completed': ['catalogs', 'track']})
+        db.commit()
+        db.close()
+
+        opencast.rabbit_callback("", "", rabbit_msg)
+
+        self.assertFalse(mock_dict['download'].called)
+        self.assertFalse(mock_dict['create'].called)
+        self.assertFalse(mock_dict['track'].called)
+        self.assert_called(mock_dict['start'], 1)
+
+        db = zingest.db.get_session()
+        ingest_db_record = db.query(zingest.db.Ingest).one()
+        self.assertEqual(zingest.db.Status.FINISHED, ingest_db_record.status)
+        self.assertEqual({}, ingest_db_record.get_checkpoint())
+        db.close()
+
+    @requests_mock.Mocker()
+    def test_callback_failure_queues_retry(self, mocker):
+        mocker.get('//localhost/api/series/series.json?count=100', text="[]")
+        self.config["Rabbit"]["retry_delays"] = "60 600"
+        self.rabbit = Rabbit(self.config, self.zoom)
+        self.rabbit.retry_rabbit_msg = MagicMock()
+        opencast, _, _ = self.create_mock_opencast(mocker)
+        opencast._fetch_files = MagicMock(side_effect=FileNotFoundError("missing"))
+        #Database polling is only needed for crashed uploaders now
+        self.assertFalse(opencast.backlog_polling)
+
+        opencast.rabbit_callback("", "", rabbit_msg)
+
+        msg, attempts = self.rabbit.retry_rabbit_msg.call_args.args
+        self.assertEqual(json.loads(rabbit_msg), msg)
+        self.assertEqual(1, attempts)
+        self.assertFalse(self.rabbit.retry_rabbit_msg.call_args.kwargs['park'])
+        db = zingest.db.get_session()
+        ingest_db_record = db.query(zingest.db.Ingest).one()
+        self.assertEqual(zingest.db.Status.FAILED, ingest_db_record.status)
+        self.assertLess(ingest_db_record.next_attempt_at, datetime.utcnow() + timedelta(seconds=61))
+        db.close()
+
+    @requests_mock.Mocker()
+    def test_callback_missing_recording_fails(self, mocker):
+        mocker.get('//localhost/api/series/series.json?count=100', text="[]")
+        opencast, _, mock_dict = self.create_mock_opencast(mocker)
+        db = zingest.db.get_session()
+        db.query(zingest.db.Recording).delete()
+        db.commit()
+        db.close()
+
+        opencast.rabbit_callback("", "", rabbit_msg)
+
+        self.assertFalse(mock_dict['create'].called)
+        db = zingest.db.get_session()
+        ingest_db_record = db.query(zingest.db.Ingest).one()
+        #Counted as a failed attempt, so it is eventually dead lettered rather than retried forever
+        self.assertEqual(zingest.db.Status.FAILED, ingest_db_record.status)
+        self.assertEqual(1, ingest_db_record.attempts)
+        self.assertIn("RecordingNotFound", ingest_db_record.last_error)
+        db.close()
+
     @requests_mock.Mocker()
     def test_ocUpload(self, mocker):
         opencast, _, mock_dict = self.create_mock_opencast(mocker)
@@ -225,6 +295,105 @@ class TestOpencast(unittest.TestCase):
         self.assertEqual(mpid, wfdict['wf:workflow']['mp:mediapackage']['@id'])
         self.assertEqual(wfInstId, wfdict['wf:workflow']['@id'])
 
+    @requests_mock.Mocker()
+    def test_ocUpload_mediapackage(self, mocker):
+        #Skip the series retries, they are not relevant here
+        mocker.get('//localhost/api/series/series.json?count=100', text="[]")
+        self.config["Uploader"] = {"ingest_mode": "mediapackage"}
+        opencast, _, mock_dict = self.create_mock_opencast(mocker)
+        bodies = []
+        def read_body(request, context):
+            #The track is closed once oc_upload returns, so the body has to be read while the request is made
+            bodies.append(request.body.read())
+            return ingest['ingest']
+        single = mocker.post("//localhost/ingest/addMediaPackage/test_workflow", text=read_body)
+        wfdict = xmltodict.parse(ingest['ingest'])
+        mpid, wfInstId = opencast.oc_upload("fake_uuid", "test/resources/media/fake", acl_id="test_acl", workflow_id="test_workflow")
+
+        self.assert_called(single, 1)
+        self.assertFalse(mock_dict['create'].called)
+        self.assertFalse(mock_dict['catalog'].called)
+        self.assertFalse(mock_dict['track'].called)
+        self.assertFalse(mock_dict['start'].called)
+        body = bodies[0]
+        self.assertLess(body.index(b'name="episodeDCCatalog"'), body.index(b'name="flavor"'))
+        self.assertLess(body.index(b'name="flavor"'), body.index(b'name="BODY"'))
+
+        self.assertEqual(mpid, wfdict['wf:workflow']['mp:mediapackage']['@id'])
+        self.assertEqual(wfInstId, wfdict['wf:workflow']['@id'])
+
+    @requests_mock.Mocker()
+    def test_callback_error_page_not_checkpointed(self, mocker):
+        mocker.get('//localhost/api/series/series.json?count=100', text="[]")
+        self.config["Uploader"] = {"ingest_mode": "mediapackage"}
+        opencast, _, _ = self.create_mock_opencast(mocker)
+        single = mocker.post(re.compile("//localhost/ingest/addMediaPackage/"), status_code=500, text="<html><body>Internal Server Error</body></html>")
+
+        opencast.rabbit_callback("", "", rabbit_msg)
+
+        self.assert_called(single, 1)
+        db = zingest.db.get_session()
+        ingest_db_record = db.query(zingest.db.Ingest).one()
+        #The next attempt has to ingest again, rather than trusting the error page
+        self.assertEqual(zingest.db.Status.FAILED, ingest_db_record.status)
+        self.assertNotIn('ingest', ingest_db_record.get_checkpoint().get('completed', []))
+        db.close()
+
+    @requests_mock.Mocker()
+    def test_callback_direct_failure_not_resent(self, mocker):
+        mocker.get('//localhost/api/series/series.json?count=100', text="[]")
+        self.config["Uploader"] = {"ingest_mode": "mediapackage", "track_mode": "url"}
+        opencast, _, mock_dict = self.create_mock_opencast(mocker)
+        single = mocker.post(re.compile("//localhost/ingest/addMediaPackage/"), exc=requests.exceptions.ReadTimeout)
+
+        opencast.rabbit_callback("", "", rabbit_msg)
+
+        #Opencast may have the first request, so the spool is left to the next attempt
+        self.assert_called(single, 1)
+        self.assertFalse(mock_dict['download'].called)
+        db = zingest.db.get_session()
+        self.assertEqual(zingest.db.Status.FAILED, db.query(zingest.db.Ingest).one().status)
+        db.close()
+
+    @requests_mock.Mocker()
+    def test_ocUpload_mediapackage_with_chat(self, mocker):
+        mocker.get('//localhost/api/series/series.json?count=100', text="[]")
+        self.config["Uploader"] = {"ingest_mode": "mediapackage"}
+        opencast, _, mock_dict = self.create_mock_opencast(mocker)
+        single = mocker.post("//localhost/ingest/addMediaPackage/test_workflow", text=ingest['ingest'])
+        opencast.oc_upload("fake_uuid", "test/resources/media/fake", "test/resources/media/fake", acl_id="test_acl", workflow_id="test_workflow")
+
+        #Chat transcripts can't be added with addMediaPackage
+        self.assertFalse(single.called)
+        self.assert_called(mock_dict['create'], 1)
+        self.assert_called(mock_dict['track'], 1)
+        self.assert_called(mock_dict['start'], 1)
+
+    def test_redact_tokens(self):
+        url = "https://us02web.zoom.us/rec/download/abc?access_token=eyJ.secret.sig&other=1"
+        self.assertEqual("https://us02web.zoom.us/rec/download/abc?access_token=REDACTED&other=1", redact_tokens(url))
+        self.assertNotIn("secret", redact_tokens({'mediaUri': url}))
+
+    @requests_mock.Mocker()
+    def test_primed_digest_auth(self, mocker):
+        challenge = {'status_code': 401, 'headers': {'WWW-Authenticate': 'Digest realm="Opencast", qop="auth", nonce="abc123"'}}
+        me = mocker.get("//localhost/info/me.json", [ challenge, {'text': "{}"} ])
+        upload = mocker.post("//localhost/ingest/addTrack", text=ingest['add-track'])
+        auth = PrimedDigestAuth("test_user", "test_password", 240)
+        self.assertFalse(auth.is_primed())
+
+        requests.get("http://localhost/info/me.json", auth=auth)
+        self.assertEqual(2, me.call_count)
+        self.assertTrue(auth.is_primed())
+
+        #The nonce is reused, so the upload is authenticated on the first attempt
+        requests.post("http://localhost/ingest/addTrack", auth=auth, data="body")
+        self.assertEqual(1, upload.call_count)
+        self.assertIn('nc=00000002', upload.last_request.headers['Authorization'])
+
+        auth.nonce_lifetime = 0
+        self.assertFalse(auth.is_primed())
+
 
 if __name__ == '__main__':
     unittest.main()
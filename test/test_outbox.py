@@ -0,0 +1,77 @@
+import multiprocessing
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+import zingest.db
+from zingest.outbox import OutboxRelay
+
+
+class TestOutbox(unittest.TestCase):
+
+    def setUp(self):
+        self.fd, self.dbfile = tempfile.mkstemp()
+        zingest.db.init({'Database': {'database': 'sqlite:///' + self.dbfile}})
+        self.config = {"Queue": {"outbox_batch_size": "2", "outbox_interval": "0.05"}}
+
+    def tearDown(self):
+        os.close(self.fd)
+        os.remove(self.dbfile)
+
+    def test_relay_in_batches(self):
+        queue = MagicMock()
+        ids = [ zingest.db.create_queued_ingest(f"uuid{ i }", {"workflow_id": "fast"}, "bulk") for i in range(5) ]
+        relay = OutboxRelay(self.config, queue)
+        self.assertEqual(5, relay.relay())
+        self.assertEqual(3, queue.send_rabbit_msgs.call_count)
+        sent = [ msg[1] for call in queue.send_rabbit_msgs.call_args_list for msg in call.args[0] ]
+        self.assertEqual(ids, sent)
+        self.assertEqual(0, relay.relay())
+
+    def test_relay_thread(self):
+        queue = MagicMock()
+        queue.send_rabbit_msgs.side_effect = [ ConnectionError("Queue is down"), None ]
+        relay = OutboxRelay(self.config, queue)
+        relay.start()
+        try:
+            zingest.db.create_queued_ingest("uuid", {"workflow_id": "fast"}, "webhook")
+            relay.wake()
+            #The first attempt fails, and the message is sent once the queue is back
+            for _ in range(100):
+                if queue.send_rabbit_msgs.call_count == 2:
+                    break
+                relay.stopped.wait(0.05)
+        finally:
+            relay.stop()
+        self.assertEqual(2, queue.send_rabbit_msgs.call_count)
+        dbs = zingest.db.get_session()
+        self.assertEqual(0, dbs.query(zingest.db.Outbox).count())
+        dbs.close()
+
+    def test_wake_from_forked_process(self):
+        queue = MagicMock()
+        #Long enough that only the wakeup can explain a prompt publish
+        relay = OutboxRelay({"Queue": {"outbox_interval": "60"}}, queue)
+        relay.start()
+        try:
+            relay.stopped.wait(0.1)
+            zingest.db.create_queued_ingest("uuid", {"workflow_id": "fast"}, "webhook")
+            #As a gunicorn worker would, after the master started the relay
+            child = multiprocessing.get_context('fork').Process(target=relay.wake)
+            child.start()
+            child.join()
+            for _ in range(100):
+                if queue.send_rabbit_msgs.called:
+                    break
+                relay.stopped.wait(0.05)
+        finally:
+            relay.stop()
+        self.assertEqual(1, queue.send_rabbit_msgs.call_count)
+
+    def test_bad_batch_size(self):
+        with self.assertRaises(ValueError):
+            OutboxRelay({"Queue": {"outbox_batch_size": "0"}}, MagicMock())
+
+
+if __name__ == '__main__':
+    unittest.main()
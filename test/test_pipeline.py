@@ -0,0 +1,61 @@
+import threading
+import time
+import unittest
+from zingest.pipeline import Pipeline, Stage
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_stages_run_in_order(self):
+        pipeline = Pipeline([
+            Stage('first', lambda job: job.append('first')),
+            Stage('second', lambda job: job.append('second')),
+        ])
+        self.assertEqual(['first', 'second'], pipeline.submit([]).result(timeout=5))
+        self.assertEqual(1, pipeline.stats()['second']['processed'])
+
+    def test_early_finish(self):
+        pipeline = Pipeline([
+            Stage('first', lambda job: False),
+            Stage('second', lambda job: job.append('second')),
+        ])
+        self.assertEqual([], pipeline.submit([]).result(timeout=5))
+
+    def test_failure(self):
+        def fail(job):
+            raise FileNotFoundError("missing")
+        pipeline = Pipeline([ Stage('first', fail), Stage('second', lambda job: job.append('second')) ])
+        with self.assertRaises(FileNotFoundError):
+            pipeline.submit([]).result(timeout=5)
+        self.assertEqual(1, pipeline.stats()['first']['failed'])
+        self.assertEqual(0, pipeline.stats()['second']['processed'])
+
+    def test_stage_concurrency(self):
+        #Both jobs have to be in the first stage at the same time for this to be released
+        barrier = threading.Barrier(2, timeout=5)
+        release = threading.Event()
+        pipeline = Pipeline([
+            Stage('wide', lambda job: barrier.wait(), workers=2),
+            Stage('narrow', lambda job: release.wait(5), workers=1),
+        ])
+        futures = [ pipeline.submit(i) for i in range(2) ]
+        #One job is in the narrow stage, the other waits for it
+        deadline = time.monotonic() + 5
+        while pipeline.stats()['narrow']['busy'] + pipeline.stats()['narrow']['queued'] < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(1, pipeline.stats()['narrow']['busy'])
+        self.assertEqual(1, pipeline.stats()['narrow']['queued'])
+        release.set()
+        self.assertEqual([0, 1], [ future.result(timeout=5) for future in futures ])
+
+    def test_capacity(self):
+        pipeline = Pipeline([ Stage('first', lambda job: None, workers=2, capacity=4), Stage('second', lambda job: None, workers=3) ])
+        self.assertEqual(2 + 4 + 3 + 3, pipeline.capacity())
+
+    def test_no_workers(self):
+        with self.assertRaises(ValueError):
+            Stage('empty', lambda job: None, workers=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
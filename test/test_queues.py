@@ -0,0 +1,89 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from zingest.queues import MemoryQueue, QueueBackend, SqliteQueue, create_queue
+
+
+class TestQueues(unittest.TestCase):
+
+    def setUp(self):
+        self.fd, self.dbfile = tempfile.mkstemp()
+        self.config = {"Queue": {"path": self.dbfile, "poll_interval": "0.05"}}
+
+    def tearDown(self):
+        os.close(self.fd)
+        for path in (self.dbfile, f"{ self.dbfile }-wal", f"{ self.dbfile }-shm"):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def consume(self, queue, expected, executor=None):
+        """:return: The ingest ids of the first expected messages consumed from queue"""
+        received = []
+        def callback(method_frame, properties, body):
+            received.append(json.loads(body)['ingest_id'])
+            if len(received) == expected:
+                queue.stop_consuming()
+        timeout = threading.Timer(5, queue.stop_consuming)
+        timeout.start()
+        queue.start_consuming_rabbitmsg(callback, executor=executor)
+        timeout.cancel()
+        return received
+
+    def test_memory(self):
+        queue = MemoryQueue(self.config)
+        queue.send_rabbit_msgs([ ("bulk", i, QueueBackend.BULK) for i in range(3) ])
+        queue.send_rabbit_msg("webhook", 10)
+        #The webhook ingest is scheduled ahead of the backlog
+        self.assertEqual([10, 0, 1, 2], self.consume(queue, 4))
+
+    def test_memory_retry(self):
+        self.config["Queue"]["retry_delays"] = "1"
+        queue = MemoryQueue(self.config)
+        queue.retry_rabbit_msg({"uuid": "uuid", "ingest_id": 1, "class": QueueBackend.MANUAL}, 1)
+        queue.retry_rabbit_msg({"uuid": "uuid", "ingest_id": 2}, 5, park=True)
+        start = time.monotonic()
+        self.assertEqual([1], self.consume(queue, 1))
+        self.assertGreaterEqual(time.monotonic() - start, 0.9)
+        self.assertEqual(2, json.loads(queue.parked[0])['ingest_id'])
+
+    def test_sqlite_is_durable(self):
+        SqliteQueue(self.config).send_rabbit_msgs([ ("uuid", i, QueueBackend.MANUAL) for i in range(3) ])
+        #A different instance, as if in another process
+        queue = SqliteQueue(self.config)
+        executor = ThreadPoolExecutor(max_workers=2)
+        self.assertEqual([0, 1, 2], sorted(self.consume(queue, 3, executor)))
+        executor.shutdown(wait=True)
+        #Processed messages are gone
+        self.assertEqual([], queue._take(QueueBackend.QUEUES[QueueBackend.MANUAL], 10))
+
+    def test_sqlite_unacknowledged(self):
+        self.config["Queue"]["visibility_timeout"] = "1"
+        queue = SqliteQueue(self.config)
+        queue.send_rabbit_msg("uuid", 1)
+        self.assertEqual(1, len(queue._take(QueueBackend.QUEUES[QueueBackend.WEBHOOK], 10)))
+        #Taken, so invisible until the timeout passes
+        self.assertEqual([], queue._take(QueueBackend.QUEUES[QueueBackend.WEBHOOK], 10))
+        time.sleep(1.1)
+        self.assertEqual(1, len(queue._take(QueueBackend.QUEUES[QueueBackend.WEBHOOK], 10)))
+
+    def test_sqlite_retry(self):
+        self.config["Queue"]["retry_delays"] = "60"
+        queue = SqliteQueue(self.config)
+        queue.retry_rabbit_msg({"uuid": "uuid", "ingest_id": 1, "class": QueueBackend.BULK}, 1)
+        #Not due for a minute
+        self.assertEqual([], queue._take(QueueBackend.QUEUES[QueueBackend.BULK], 10))
+
+    def test_factory(self):
+        self.config["Queue"]["backend"] = "memory"
+        self.assertIsInstance(create_queue(self.config, None), MemoryQueue)
+        self.config["Queue"]["backend"] = "carrier-pigeon"
+        with self.assertRaises(ValueError):
+            create_queue(self.config, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,9 @@
 import json
+import threading
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import MagicMock, patch
+import pika
 from zingest.rabbit import Rabbit
 from zingest.zoom import Zoom
 
@@ -72,6 +75,147 @@ class TestRabbit(unittest.TestCase):
         msg = rabbit._construct_rabbit_msg(webhook_event['payload']['object']['uuid'], 12345)
         self.assert_rabbitmsg(msg, 12345)
 
+    @patch('pika.BlockingConnection')
+    def test_consumingWithWorkers(self, connection_class):
+        connection = connection_class.return_value
+        channel = connection.channel.return_value
+        frames = [ MagicMock(delivery_tag=tag) for tag in [1, 2] ]
+        #Both callbacks have to be running at the same time for this to be released
+        barrier = threading.Barrier(3, timeout=5)
+        def deliver():
+            on_message = channel.basic_consume.call_args.kwargs['on_message_callback']
+            for frame in frames:
+                on_message(channel, frame, None, b'{}')
+            #Keep consuming until both callbacks are running, closing the connection drops anything not yet started
+            barrier.wait()
+        channel.start_consuming.side_effect = deliver
+
+        callback_threads = []
+        def callback(method_frame, properties, body):
+            callback_threads.append(threading.current_thread())
+            barrier.wait()
+
+        rabbit = Rabbit(self.config, self.zoom)
+        executor = ThreadPoolExecutor(max_workers=2)
+        rabbit.start_consuming_rabbitmsg(callback, executor=executor, prefetch_count=2)
+        executor.shutdown(wait=True)
+
+        #One channel for each class of ingest
+        self.assertEqual(len(Rabbit.CLASSES), channel.basic_qos.call_count)
+        channel.basic_qos.assert_called_with(prefetch_count=2)
+        self.assertNotIn(threading.current_thread(), callback_threads)
+        #Acks are handed back to the connection's thread rather than sent from the workers
+        channel.basic_ack.assert_not_called()
+        for call in connection.add_callback_threadsafe.call_args_list:
+            call.args[0]()
+        self.assertEqual([1, 2], sorted([ call.args[0] for call in channel.basic_ack.call_args_list ]))
+
+    @patch('pika.BlockingConnection')
+    def test_consumingInScheduledOrder(self, connection_class):
+        connection = connection_class.return_value
+        channel = connection.channel.return_value
+        consumers = {}
+        channel.basic_consume.side_effect = lambda queue, on_message_callback: consumers.update({queue: on_message_callback})
+        done = threading.Event()
+        def deliver():
+            #A bulk backlog is already waiting when a webhook ingest arrives
+            for tag in [1, 2, 3]:
+                consumers[Rabbit.QUEUES[Rabbit.BULK]](channel, MagicMock(delivery_tag=tag), None, json.dumps({'host': 'backfill'}))
+            started.wait(5)
+            consumers[Rabbit.QUEUES[Rabbit.WEBHOOK]](channel, MagicMock(delivery_tag=4), None, json.dumps({'host': 'lecturer'}))
+            release.set()
+            done.wait(5)
+        channel.start_consuming.side_effect = deliver
+
+        #The single worker is held until everything has been delivered
+        started = threading.Event()
+        release = threading.Event()
+        order = []
+        def callback(method_frame, properties, body):
+            started.set()
+            release.wait(5)
+            order.append(method_frame.delivery_tag)
+            if len(order) == 4:
+                done.set()
+
+        rabbit = Rabbit(self.config, self.zoom)
+        executor = ThreadPoolExecutor(max_workers=1)
+        rabbit.start_consuming_rabbitmsg(callback, executor=executor, prefetch_count=1)
+        executor.shutdown(wait=True)
+
+        #The first bulk message was already running, but the webhook one jumps the rest of the queue
+        self.assertEqual([1, 4, 2, 3], order)
+
+    @patch('pika.BlockingConnection')
+    def test_publisherReusesConnection(self, connection_class):
+        connection = connection_class.return_value
+        channel = connection.channel.return_value
+        rabbit = Rabbit(self.config, self.zoom)
+        rabbit.send_rabbit_msg("first", 1)
+        rabbit.send_rabbit_msg("second", 2)
+
+        connection_class.assert_called_once()
+        channel.queue_declare.assert_called_once_with(queue=Rabbit.QUEUES[Rabbit.WEBHOOK], arguments=None)
+        self.assertEqual(["first", "second"], [ json.loads(call.kwargs['body'])['uuid'] for call in channel.basic_publish.call_args_list ])
+        channel.confirm_delivery.assert_not_called()
+
+    @patch('pika.BlockingConnection')
+    def test_publisherReconnects(self, connection_class):
+        connection = connection_class.return_value
+        channel = connection.channel.return_value
+        channel.basic_publish.side_effect = [ None, pika.exceptions.StreamLostError("gone"), None ]
+        self.config["Rabbit"]["confirm_delivery"] = "true"
+        rabbit = Rabbit(self.config, self.zoom)
+        rabbit.send_rabbit_msg("first", 1)
+        rabbit.send_rabbit_msg("second", 2)
+
+        self.assertEqual(2, connection_class.call_count)
+        self.assertEqual(3, channel.basic_publish.call_count)
+        self.assertTrue(channel.basic_publish.call_args.kwargs['mandatory'])
+        self.assertEqual(2, channel.confirm_delivery.call_count)
+
+    @patch('pika.BlockingConnection')
+    def test_sendingBatch(self, connection_class):
+        channel = connection_class.return_value.channel.return_value
+        rabbit = Rabbit(self.config, self.zoom)
+        rabbit.send_rabbit_msgs([ (f"uuid-{ i }", i, Rabbit.BULK, "host", 100) for i in range(5) ])
+
+        connection_class.assert_called_once()
+        self.assertEqual(5, channel.basic_publish.call_count)
+        self.assertEqual(Rabbit.QUEUES[Rabbit.BULK], channel.basic_publish.call_args.kwargs['routing_key'])
+        #Confirmed once, for the whole batch
+        channel.tx_select.assert_called_once()
+        channel.tx_commit.assert_called_once()
+
+    @patch('pika.BlockingConnection')
+    def test_retryTopology(self, connection_class):
+        channel = connection_class.return_value.channel.return_value
+        self.config["Rabbit"]["retry_delays"] = "60 600"
+        rabbit = Rabbit(self.config, self.zoom)
+        msg = {"uuid": "uuid", "ingest_id": 1, "class": Rabbit.BULK}
+        for attempts in [1, 2, 3]:
+            rabbit.retry_rabbit_msg(msg, attempts)
+        rabbit.retry_rabbit_msg(msg, 4, park=True)
+
+        #The last delay repeats
+        queues = [ call.kwargs['routing_key'] for call in channel.basic_publish.call_args_list ]
+        self.assertEqual(["zoomhook.bulk.retry.60", "zoomhook.bulk.retry.600", "zoomhook.bulk.retry.600", Rabbit.PARKING_QUEUE], queues)
+        self.assertEqual(4, json.loads(channel.basic_publish.call_args.kwargs['body'])['attempts'])
+        #Expired messages go back to the bulk queue
+        declared = { call.kwargs['queue']: call.kwargs['arguments'] for call in channel.queue_declare.call_args_list }
+        self.assertEqual({'x-message-ttl': 600000, 'x-dead-letter-exchange': '', 'x-dead-letter-routing-key': "zoomhook.bulk"}, declared["zoomhook.bulk.retry.600"])
+        self.assertIsNone(declared[Rabbit.PARKING_QUEUE])
+
+    def test_badRetryDelays(self):
+        self.config["Rabbit"]["retry_delays"] = "60 0"
+        with self.assertRaises(ValueError):
+            Rabbit(self.config, self.zoom)
+
+    def test_unknownClass(self):
+        rabbit = Rabbit(self.config, self.zoom)
+        with self.assertRaises(ValueError):
+            rabbit.send_rabbit_msg("uuid", 1, "urgent")
+
     @unittest.skip("FIXME: We need to mock the internals of the Pika connection before this will work")
     def test_sendingMessages(self):
         rabbit = Rabbit(self.config, self.zoom)
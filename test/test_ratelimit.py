@@ -0,0 +1,70 @@
+import os
+import tempfile
+import time
+import unittest
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from unittest.mock import MagicMock
+from zingest.common import RateLimited
+from zingest.ratelimit import RateLimiter
+
+
+class TestRateLimit(unittest.TestCase):
+
+    def response(self, status_code=200, headers={}):
+        return MagicMock(status_code=status_code, headers=headers)
+
+    def test_paces_calls(self):
+        limiter = RateLimiter({"Zoom": {"rate_limit_light": "20"}})
+        start = time.monotonic()
+        #The first second's worth go straight away, the rest are spaced out
+        for _ in range(25):
+            limiter.acquire(RateLimiter.LIGHT)
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+    def test_categories(self):
+        recording_list = MagicMock(__qualname__='RecordingComponentV2.list')
+        self.assertEqual(RateLimiter.MEDIUM, RateLimiter.category(recording_list))
+        self.assertEqual(RateLimiter.HEAVY, RateLimiter.category(MagicMock(__qualname__='MeetingComponentV2.delete')))
+        with self.assertRaises(ValueError):
+            RateLimiter({"Zoom": {"rate_limit_heavy": "0"}})
+
+    def test_retry_after(self):
+        limiter = RateLimiter({"Zoom": {"rate_limit_max_wait": "10"}})
+        self.assertFalse(limiter.observe(RateLimiter.LIGHT, self.response()))
+        self.assertTrue(limiter.observe(RateLimiter.LIGHT, self.response(429, {'Retry-After': '60'})))
+        #Paused for longer than we're willing to wait
+        with self.assertRaises(RateLimited):
+            limiter.acquire(RateLimiter.LIGHT)
+        #Other categories carry on
+        limiter.acquire(RateLimiter.MEDIUM)
+
+    def test_retry_after_formats(self):
+        later = datetime.now(timezone.utc) + timedelta(minutes=10)
+        for value in (later.strftime('%Y-%m-%dT%H:%M:%SZ'), format_datetime(later, usegmt=True)):
+            seconds = RateLimiter._retry_after(self.response(429, {'Retry-After': value}))
+            self.assertAlmostEqual(600, seconds, delta=5)
+        self.assertIsNone(RateLimiter._retry_after(self.response(429, {'Retry-After': 'soon'})))
+        self.assertLessEqual(RateLimiter.backoff(10), 60)
+
+    def test_daily_quota(self):
+        limiter = RateLimiter({"Zoom": {}})
+        #The last call of the day succeeds, but the next would not
+        limiter.observe(RateLimiter.HEAVY, self.response(200, {'X-RateLimit-Type': 'Daily-limit', 'X-RateLimit-Remaining': '0'}))
+        with self.assertRaises(RateLimited):
+            limiter.acquire(RateLimiter.HEAVY)
+
+    def test_shared_between_processes(self):
+        fd, path = tempfile.mkstemp()
+        try:
+            config = {"Zoom": {"rate_limit_lock_file": path, "rate_limit_max_wait": "10"}}
+            RateLimiter(config).observe(RateLimiter.LIGHT, self.response(429, {'Retry-After': '60'}))
+            with self.assertRaises(RateLimited):
+                RateLimiter(config).acquire(RateLimiter.LIGHT)
+        finally:
+            os.close(fd)
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
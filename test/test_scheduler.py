@@ -0,0 +1,73 @@
+import threading
+import unittest
+from zingest.scheduler import FairScheduler
+
+
+class TestScheduler(unittest.TestCase):
+
+    def drain(self, scheduler):
+        items = []
+        while True:
+            item = scheduler.get(timeout=0)
+            if item is None:
+                return items
+            items.append(item)
+
+    def test_weighted_classes(self):
+        scheduler = FairScheduler({'webhook': 3, 'bulk': 1})
+        for i in range(8):
+            scheduler.put(f"bulk-{ i }", 'bulk')
+        for i in range(3):
+            scheduler.put(f"webhook-{ i }", 'webhook')
+        order = self.drain(scheduler)
+        #Three webhook ingests for every bulk one, and bulk is never starved
+        self.assertEqual(['webhook-0', 'bulk-0', 'webhook-1', 'webhook-2', 'bulk-1'], order[:5])
+        self.assertEqual(11, len(order))
+
+    def test_idle_class_does_not_bank_turns(self):
+        scheduler = FairScheduler({'webhook': 1, 'bulk': 1})
+        for i in range(4):
+            scheduler.put(f"webhook-{ i }", 'webhook')
+        self.drain(scheduler)
+        for i in range(2):
+            scheduler.put(f"webhook-{ i }", 'webhook')
+            scheduler.put(f"bulk-{ i }", 'bulk')
+        order = self.drain(scheduler)
+        self.assertEqual(['bulk-0', 'webhook-0'], sorted(order[:2]))
+
+    def test_hosts_take_turns(self):
+        scheduler = FairScheduler({'bulk': 1})
+        for i in range(3):
+            scheduler.put(f"alice-{ i }", 'bulk', 'alice')
+        scheduler.put("bob-0", 'bulk', 'bob')
+        self.assertEqual(['alice-0', 'bob-0', 'alice-1', 'alice-2'], self.drain(scheduler))
+
+    def test_shortest_first(self):
+        scheduler = FairScheduler({'bulk': 1}, shortest_first=True)
+        scheduler.put("large", 'bulk', 'alice', 4000)
+        scheduler.put("small", 'bulk', 'alice', 10)
+        scheduler.put("medium", 'bulk', 'alice', 500)
+        scheduler.put("unknown", 'bulk', 'alice')
+        self.assertEqual(['unknown', 'small', 'medium', 'large'], self.drain(scheduler))
+
+    def test_unknown_class(self):
+        scheduler = FairScheduler({'webhook': 8, 'bulk': 1})
+        scheduler.put("mystery", 'other')
+        self.assertEqual({'webhook': 0, 'bulk': 1}, scheduler.stats())
+
+    def test_close(self):
+        scheduler = FairScheduler({'bulk': 1})
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(scheduler.get()))
+        waiter.start()
+        scheduler.close()
+        waiter.join(5)
+        self.assertEqual([None], results)
+
+    def test_bad_weight(self):
+        with self.assertRaises(ValueError):
+            FairScheduler({'bulk': 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,13 @@
 import json
+import os
+import tempfile
 import unittest
+from datetime import datetime, timedelta
+import jwt
+import requests_mock
+from requests import HTTPError
 from unittest.mock import MagicMock, patch
+import zingest.db
 from zingest.common import BadWebhookData, NoMp4Files
 from zingest.zoom import Zoom
 
@@ -189,6 +196,118 @@ class TestZoom(unittest.TestCase):
         with self.assertRaises(BadWebhookData):
             zoom.validate_recording_renamed(self.rename)
 
+    def test_download_token(self):
+        zoom = Zoom(self.config)
+        token = zoom.get_download_token()
+        self.assertEqual(token, zoom.get_download_token())
+        claims = jwt.decode(token, "test_secret", algorithms=['HS256'])
+        self.assertEqual("test_key", claims['iss'])
+        self.assertLessEqual(claims['exp'], (datetime.utcnow() + timedelta(minutes=5)).timestamp() + 1)
+
+    def test_long_lived_download_token(self):
+        zoom = Zoom(self.config)
+        token = zoom.get_download_token(timedelta(hours=4))
+        claims = jwt.decode(token, "test_secret", algorithms=['HS256'])
+        self.assertGreater(claims['exp'], (datetime.utcnow() + timedelta(hours=3)).timestamp())
+        #Long lived tokens are not shared
+        self.assertNotEqual(token, zoom.get_download_token())
+
+    @requests_mock.Mocker()
+    def test_zoom_client_session(self, mocker):
+        user = mocker.get("https://api.zoom.us/v2/users/abc", json={"id": "abc"})
+        zoom = Zoom(self.config)
+        client = zoom._get_zoom_client()
+        self.assertEqual({"id": "abc"}, client.user.get(id="abc").json())
+        self.assertIs(zoom.session, client.user.session)
+        first = user.last_request.headers['Authorization']
+        self.assertEqual("test_key", jwt.decode(first.split(" ")[1], "test_secret", algorithms=['HS256'])['iss'])
+
+        #An expired token is replaced in place, rather than building a new client
+        client.config['token'] = "stale"
+        zoom.zoom_client_exp = datetime.utcnow() - timedelta(minutes=1)
+        self.assertIs(client, zoom._get_zoom_client())
+        client.user.get(id="abc")
+        self.assertEqual(first, user.last_request.headers['Authorization'])
+
+
+    @requests_mock.Mocker()
+    def test_rate_limited(self, mocker):
+        user = mocker.get("https://api.zoom.us/v2/users/abc", [
+            {'status_code': 429, 'headers': {'Retry-After': '0'}},
+            {'json': {"id": "abc"}},
+        ])
+        zoom = Zoom(self.config)
+        self.assertEqual({"id": "abc"}, zoom._make_zoom_request(zoom._get_zoom_client().user.get, {'id': "abc"}))
+        self.assertEqual(2, user.call_count)
+
+        mocker.get("https://api.zoom.us/v2/users/abc", status_code=429, headers={'Retry-After': '0'})
+        with self.assertRaises(HTTPError):
+            zoom._make_zoom_request(zoom._get_zoom_client().user.get, {'id': "abc"}, attempts=1)
+
+    @requests_mock.Mocker()
+    def test_recording_cache(self, mocker):
+        fd, dbfile = tempfile.mkstemp()
+        try:
+            zingest.db.init({'Database': {'database': 'sqlite:///' + dbfile}})
+            found = mocker.get("https://api.zoom.us/v2/meetings/abc/recordings", json={"uuid": "abc", "topic": "Old"})
+            missing = mocker.get("https://api.zoom.us/v2/meetings/def/recordings", status_code=404)
+            zoom = Zoom(self.config)
+            zoom.get_recording("abc")['topic'] = "Changed by the caller"
+            self.assertEqual("Old", zoom.get_recording("abc")['topic'])
+            self.assertEqual(1, found.call_count)
+            zoom.invalidate_recording("abc")
+            zoom.get_recording("abc")
+            self.assertEqual(2, found.call_count)
+
+            for _ in range(2):
+                with self.assertRaises(HTTPError):
+                    zoom.get_recording("def")
+            self.assertEqual(1, missing.call_count)
+            self.assertEqual({'size': 2, 'hits': 1, 'negative_hits': 1, 'misses': 3}, zoom.recording_cache.stats())
+        finally:
+            os.close(fd)
+            os.remove(dbfile)
+
+    @requests_mock.Mocker()
+    def test_user_names(self, mocker):
+        fd, dbfile = tempfile.mkstemp()
+        try:
+            zingest.db.init({'Database': {'database': 'sqlite:///' + dbfile}})
+            zingest.db.create_user("known", "Ada", "Lovelace", "ada@example.com")
+            unknown = mocker.get("https://api.zoom.us/v2/users/unknown", json={"id": "unknown", "first_name": "Alan", "last_name": "Turing", "email": "alan@example.com"})
+            mocker.get("https://api.zoom.us/v2/users/deleted", status_code=404)
+            zoom = Zoom(self.config)
+            names = zoom.get_user_names(["known", "unknown", "deleted", "unknown"])
+            self.assertEqual({"known": "Lovelace, Ada", "unknown": "Turing, Alan", "deleted": "deleted"}, names)
+            self.assertEqual(1, unknown.call_count)
+            #Now in the database, so Zoom isn't asked again
+            self.assertEqual("Turing, Alan", Zoom(self.config).get_user_names(["unknown"])["unknown"])
+            self.assertEqual(1, unknown.call_count)
+        finally:
+            os.close(fd)
+            os.remove(dbfile)
+
+    def test_catalogued_recording_files(self):
+        fd, dbfile = tempfile.mkstemp()
+        try:
+            zingest.db.init({'Database': {'database': 'sqlite:///' + dbfile}})
+            zoom = Zoom(self.config)
+            recording = self.event['object']
+            zoom.get_recording = MagicMock(return_value=recording)
+            zoom.catalog_recording_files(recording)
+            files = zoom.get_recording_files(recording['uuid'])
+            zoom.get_recording.assert_not_called()
+            self.assertEqual(sorted(zoom._parse_recording_files(recording), key=lambda f: f['recording_id']), sorted(files, key=lambda f: f['recording_id']))
+
+            #Files which were still processing are fetched again
+            recording['recording_files'][0]['status'] = "processing"
+            zoom.catalog_recording_files(recording)
+            recording['recording_files'][0]['status'] = "completed"
+            zoom.get_recording_files(recording['uuid'])
+            zoom.get_recording.assert_called_once_with(recording['uuid'])
+        finally:
+            os.close(fd)
+            os.remove(dbfile)
 
     @unittest.skip("FIXME: Zoom library users requests in the backend, we should mock the responses and test zoom.py better")
     def test_parse_recordings(self):
@@ -4,12 +4,14 @@ import os.path
 import sys
 import threading
 
-from flask import Flask
+from flask import Flask, jsonify
 
 import zingest.db
 from logger import init_logger
+from zingest.common import get_config_default
+from zingest.occupancy import OccupancyPublisher
 from zingest.opencast import Opencast
-from zingest.rabbit import Rabbit
+from zingest.queues import create_queue
 from zingest.zoom import Zoom
 
 init_logger()
@@ -29,7 +31,7 @@ except FileNotFoundError:
 
 zingest.db.init(config)
 z = Zoom(config)
-r = Rabbit(config, z)
+r = create_queue(config, z)
 o = Opencast(config, r, z)
 
 def uploader():
@@ -44,6 +46,13 @@ thread.start()
 thread = threading.Thread(target=reingester, daemon=True)
 thread.start()
 
+#gunicorn --preload only runs the threads above in its master, so the workers answering /count read this file
+OCCUPANCY_FILE = get_config_default(config, "Uploader", "occupancy_file", os.path.join(o.IN_PROGRESS_ROOT, "occupancy.json"))
+OCCUPANCY_INTERVAL = 5
+
+publisher = OccupancyPublisher(OCCUPANCY_FILE, o.get_occupancy, OCCUPANCY_INTERVAL)
+publisher.start()
+
 
 app = Flask(__name__)
 
@@ -53,4 +62,12 @@ def get_index():
 
 @app.route('/count', methods=['GET'])
 def get_count():
-    return "Count of currently ingesting recordings is: "
+    published = OccupancyPublisher.read(OCCUPANCY_FILE)
+    if published is None:
+        return "Count of currently ingesting recordings is not available yet", 503
+    occupancy, age = published
+    if occupancy is None:
+        return "Count of currently ingesting recordings is: "
+    in_flight = sum(stage['busy'] + stage.get('blocked', 0) + stage['queued'] for stage in occupancy.values())
+    #A file much older than OCCUPANCY_INTERVAL means the process doing the ingests has stopped
+    return jsonify({'ingesting': in_flight, 'stages': occupancy, 'age_seconds': int(age)})
@@ -7,14 +7,17 @@ from datetime import datetime, date, timedelta
 from urllib.parse import urlencode, parse_qs
 from requests import HTTPError
 
-from flask import Flask, request, render_template, render_template_string, redirect
+from flask import Flask, request, render_template, render_template_string, redirect, jsonify
 
 from zingest import db
 from logger import init_logger
-from zingest.common import BadWebhookData, NoMp4Files, get_config_ignore
+from zingest.common import BadWebhookData, NoMp4Files, get_config_default, get_config_ignore
+from zingest.dedup import EventDeduplicator
+from zingest.events import WebhookEventWorker
 from zingest.filter import RegexFilter
 from zingest.opencast import Opencast
-from zingest.rabbit import Rabbit
+from zingest.outbox import OutboxRelay
+from zingest.queues import QueueBackend, create_queue
 from zingest.zoom import Zoom
 
 MIN_DURATION = 0
@@ -75,6 +78,9 @@ try:
         else:
             logger.debug(f"Webhook pre-shared secre not configured")
             WEBHOOK_SECRET = None
+    #Store webhook events and respond straight away, leaving the Zoom requests to a background worker
+    ASYNC_PROCESSING = get_config_default(config, 'Webhook', 'async_processing', 'false').lower() == 'true'
+    logger.debug(f"Webhook events processed asynchronously: { ASYNC_PROCESSING }")
 except KeyError as err:
     sys.exit("Key {0} was not found".format(err))
 except ValueError as err:
@@ -82,10 +88,17 @@ except ValueError as err:
 
 db.init(config)
 z = Zoom(config)
-r = Rabbit(config, z)
+r = create_queue(config, z)
 o = Opencast(config, r, z)
+relay = OutboxRelay(config, r)
+relay.start()
+#The handler is defined further down, so it is looked up when called
+event_worker = WebhookEventWorker(config, lambda body: _process_stored_webhook_event(body))
+if ASYNC_PROCESSING:
+    event_worker.start()
 
 recording_filter = RegexFilter(config)
+dedup = EventDeduplicator(config)
 
 app = Flask(__name__)
 
@@ -233,7 +246,7 @@ def single_recording(recording_id):
         return render_template("error.html", message = repr(e))
 
 
-def _ingest_single_recording(recording_id, dur_check=True):
+def _ingest_single_recording(recording_id, dur_check=True, ingest_class=QueueBackend.MANUAL):
     logger.info(f"Ingesting for { recording_id }")
     origin_page = urllib.parse.unquote_plus(request.form.get('origin_page', ""))
     query_string = urllib.parse.unquote_plus(request.form.get('origin_query_string',""))
@@ -241,7 +254,7 @@ def _ingest_single_recording(recording_id, dur_check=True):
     params = { key: value for key, value in request.form.items() if not key.startswith("origin") and not key.startswith("bulk_") and not '' == value }
     params['is_webhook'] = False
     params['dur_check'] = dur_check
-    _queue_recording(recording_id, params)
+    _queue_recording(recording_id, params, ingest_class=ingest_class)
 
     return origin_page, query_string
 
@@ -365,8 +378,9 @@ def do_bulk():
             return render_template_string("No workflow ID set"), 400
         logger.debug(f"Bulk ingest with workflow { workflow_id } and acl id { acl_id } to series { series_id }")
 
+        #The outbox relay sends the messages on in batches, rather than each needing its own round trip to rabbit
         for event_id in event_ids:
-            origin_page, query_string = _ingest_single_recording(event_id, dur_check)
+            origin_page, query_string = _ingest_single_recording(event_id, dur_check, QueueBackend.BULK)
 
         logger.debug(f"Referrer is { request.referrer }")
         if request.referrer:
@@ -378,12 +392,22 @@ def do_bulk():
         return render_template("error.html", message = repr(e))
 
 
+## Cache statistics
+
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    #Each gunicorn worker has its own caches, so these only cover the worker which answers
+    return jsonify({
+        'pid': os.getpid(),
+        'recording_cache': z.recording_cache.stats(),
+        'dedup': dedup.stats(),
+    })
+
 ## Webhook support
 
 @app.route('/webhook', methods=['POST'])
 @app.errorhandler(400)
-@db.with_session
-def do_POST(dbs):
+def do_POST():
     logger.debug("POST received")
 
     #If this header is missing this will throw a 400 automatically
@@ -405,20 +429,101 @@ def do_POST(dbs):
         logger.error("Event is missing")
         return render_template_string("Missing event field in webhook body"), 400
 
+    #Zoom redelivers events it thinks timed out, which we can answer without doing anything
+    key = EventDeduplicator.event_key(body)
+    if key and dedup.is_duplicate(key):
+        logger.info(f"Ignoring duplicate delivery of { key }")
+        return f"Duplicate event { key }, already received"
+
+    if not ASYNC_PROCESSING:
+        try:
+            response = _process_webhook_event(body)
+        except Exception:
+            _forget_event(key)
+            raise
+        if isinstance(response, tuple) and response[1] >= 500:
+            #Let Zoom's redelivery have another go
+            _forget_event(key)
+        elif key:
+            dedup.remember(key)
+        return response
+
+    event_type = body["event"]
+    try:
+        if not _validate_webhook_event(body["payload"], event_type):
+            logger.info(f"Unknown event type { event_type }, but passing initial validations.  Unable to continue processing this event.")
+            return f"Unable to ingest, unkonwn event type { event_type }"
+    except BadWebhookData as e:
+        logger.exception("Payload failed validation")
+        return render_template_string("Payload failed validation"), 400
+    except NoMp4Files as e:
+        logger.error("No mp4 files found!")
+        return render_template_string("No mp4 files found!"), 400
+    try:
+        event_id = db.create_webhook_event(event_type, body)
+    except Exception:
+        _forget_event(key)
+        raise
+    if key:
+        dedup.remember(key)
+    event_worker.wake()
+    logger.debug(f"Stored { event_type } event as { event_id }")
+    return f"Accepted { event_type } event { event_id }"
+
+
+def _forget_event(key):
+    if not key:
+        return
+    try:
+        dedup.forget(key)
+    except Exception:
+        logger.exception(f"Unable to forget webhook event { key }, redeliveries of it will be ignored")
+
+
+def _validate_webhook_event(payload, event_type):
+    """
+    Check an event's payload, without any requests to Zoom
+
+    :return: Whether the event is of a type we process
+    """
+    z.validate_recording_payload(payload)
+    if "recording.completed" == event_type:
+        logger.debug(f"Validating recording.completed event")
+        z.validate_recording_object(payload['object'])
+        logger.debug(f"Validated recording.completed event for { payload['object']['uuid'] }, processing.")
+    elif "recording.renamed" == event_type:
+        logger.debug(f"Validating recording.renamed event")
+        z.validate_recording_renamed(payload)
+    else:
+        return False
+    return True
+
+
+def _process_stored_webhook_event(body):
+    """
+    Process an event stored by do_POST.  Errors which might be temporary are raised so the event is retried.
+    """
+    with app.app_context():
+        response = _process_webhook_event(body)
+    if isinstance(response, tuple) and response[1] >= 500:
+        raise Exception(f"Processing webhook event failed with { response[1] }: { response[0] }")
+    logger.debug(f"Processed stored { body['event'] } event: { response }")
+
+
+@db.with_session
+def _process_webhook_event(dbs, body):
     payload = body["payload"]
     event_type = body["event"]
     obj = None
     try:
-        z.validate_recording_payload(payload)
+        if not _validate_webhook_event(payload, event_type):
+            logger.info(f"Unknown event type { event_type }, but passing initial validations.  Unable to continue processing this event.")
+            return f"Unable to ingest, unkonwn event type { event_type }"
         obj = payload['object']
-        if "recording.completed" == event_type:
-            logger.debug(f"Validating recording.completed event")
-            z.validate_recording_object(obj)
-            logger.debug(f"Validated recording.completed event for { obj['uuid'] }, processing.")
-        elif "recording.renamed" == event_type:
-            logger.debug(f"Validating recording.renamed event")
-            z.validate_recording_renamed(payload)
+        if "recording.renamed" == event_type:
             uuid = obj['uuid']
+            #The cached copy has the old title
+            z.invalidate_recording(uuid)
             new_title = obj['topic'].replace('\u200b', '')
             existing_db_recording = dbs.query(db.Recording).filter(db.Recording.uuid == uuid).one_or_none()
             if existing_db_recording:
@@ -442,9 +547,6 @@ def do_POST(dbs):
             #We're seeing the occasional issue where the rename event fires, but the response from Zoom contains the *old* name.
             #So we override it here.
             obj['topic'] = new_title
-        else:
-            logger.info(f"Unknown event type { event_type }, but passing initial validations.  Unable to continue processing this event.")
-            return f"Unable to ingest, unkonwn event type { event_type }"
     except BadWebhookData as e:
         logger.exception("Payload failed validation")
         return render_template_string("Payload failed validation"), 400
@@ -458,6 +560,12 @@ def do_POST(dbs):
         logger.error("Body is ^^^")
         return render_template_string("Error"), 500
 
+    if "recording.completed" == event_type:
+        #Zoom may have (re)processed the recording since we last looked it up
+        z.invalidate_recording(obj['uuid'])
+        #Renamed recordings were fetched from Zoom above, which catalogs them already
+        z.catalog_recording_files(obj)
+
     uuid = obj['uuid']
     if "download_token" in body:
         token = body["download_token"]
@@ -485,7 +593,7 @@ def do_POST(dbs):
 ## Actually ingesting the recording (validating things, creating the rabbit message)
 
 @db.with_session
-def _queue_recording(dbs, uuid, zingest, token=None):
+def _queue_recording(dbs, uuid, zingest, token=None, ingest_class=None):
 
     logger.debug(f"_queue_recording called with { uuid } and { zingest }")
     #Check if the recording exists, and create it if it does not
@@ -514,6 +622,8 @@ def _queue_recording(dbs, uuid, zingest, token=None):
 
     logger.debug(f"{ db_uuid }: Checking duration: { check_duration }")
     logger.debug(f"{ db_uuid }: Is a webhook event: { is_webhook }")
+    if not ingest_class:
+        ingest_class = QueueBackend.WEBHOOK if is_webhook else QueueBackend.MANUAL
 
     if not WEBHOOK_ENABLE and is_webhook:
         logger.debug(f"Incoming POST for { db_uuid } is a webhook event, and the webhook is disabled!")
@@ -547,15 +657,14 @@ def _queue_recording(dbs, uuid, zingest, token=None):
     if "creator" not in zingest:
         zingest["creator"] = renderable["host"]
 
-    #Create the ingest record
-    logger.debug(f"Creating ingest record for { db_uuid } with params { zingest }")
-    ingest_id = db.create_ingest(db_uuid, zingest)
-
-    logger.debug(f"Sending rabbit message to ingest { db_uuid } with params { ingest_id }")
-    r.send_rabbit_msg(db_uuid, ingest_id)
+    #Create the ingest record, and its rabbit message, in one commit.  The relay does the actual sending.
+    logger.debug(f"Creating ingest record for { db_uuid } with params { zingest } as a { ingest_class } ingest")
+    #get_recording is cached, so this doesn't cost another Zoom request
+    ingest_id = db.create_queued_ingest(db_uuid, zingest, ingest_class, existing_rec.get_user_id(), z.get_recording(db_uuid).get('total_size'))
+    relay.wake()
 
     logger.debug("POST processed successfully")
-    return f"Successfully sent { db_uuid } and { ingest_id } to rabbit"
+    return f"Successfully queued { db_uuid } and { ingest_id } for rabbit"
 
 
 if __name__ == "__main__":
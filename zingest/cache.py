@@ -0,0 +1,79 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    A thread safe LRU cache whose entries also expire, so that a changed value is picked up eventually even if
+    nobody invalidates it.  Errors can be cached too (eg, a 404), for a separate, usually shorter, time.
+    """
+
+    def __init__(self, size, ttl, negative_ttl=0, cache_error=None):
+        """
+        :param size: The most entries to keep, least recently used are dropped first
+        :param ttl: Seconds an entry is kept for
+        :param negative_ttl: Seconds an error is kept for
+        :param cache_error: Called with an exception raised by a load, returns whether to cache it
+        """
+        if size < 1:
+            raise ValueError(f"Cache size must be at least 1, not { size }")
+        self.logger = logging.getLogger(__name__)
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.cache_error = cache_error
+        self.lock = threading.Lock()
+        #Key to (expiry, value, error), least recently used first
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+
+    def get_or_load(self, key, load):
+        """
+        Get the value for key, calling load(key) to get it if it isn't cached.  Cached errors are raised again.
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > now:
+                self.entries.move_to_end(key)
+                _, value, error = entry
+                if error is None:
+                    self.hits += 1
+                    return value
+                self.negative_hits += 1
+            else:
+                error = None
+                self.misses += 1
+        if error is not None:
+            raise error
+        try:
+            value = load(key)
+        except Exception as e:
+            if self.negative_ttl > 0 and self.cache_error and self.cache_error(e):
+                self._put(key, None, e, self.negative_ttl)
+            raise
+        self._put(key, value, None, self.ttl)
+        return value
+
+    def _put(self, key, value, error, ttl):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value, error)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'hits': self.hits, 'negative_hits': self.negative_hits, 'misses': self.misses}
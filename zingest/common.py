@@ -6,6 +6,14 @@ class NoMp4Files(Exception):
     pass
 
 
+class RateLimited(Exception):
+    pass
+
+
+class RecordingNotFound(Exception):
+    pass
+
+
 def get_config_ignore(config, group, key, ignore_blank_values):
     if config and group in config and key in config[group]:
         value = config[group][key]
@@ -20,3 +28,12 @@ def get_config_ignore(config, group, key, ignore_blank_values):
 
 def get_config(config, group, key):
     return get_config_ignore(config, group, key, False)
+
+def get_config_default(config, group, key, default):
+    try:
+        value = get_config_ignore(config, group, key, True)
+    except KeyError:
+        return default
+    if value is None or len(str(value).strip()) == 0:
+        return default
+    return str(value).strip()
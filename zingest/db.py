@@ -4,8 +4,10 @@ import string
 from datetime import datetime
 from functools import wraps
 
-from sqlalchemy import Column, Integer, String, LargeBinary, DateTime, \
-    Boolean, create_engine, func, or_, and_
+from sqlalchemy import Column, Integer, BigInteger, String, LargeBinary, DateTime, \
+    Boolean, Index, case, create_engine, func, inspect, or_, and_, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateIndex
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
@@ -29,6 +31,42 @@ def init(config):
         log.warn("Using default SQLite database, this is probably not what you want!")
         engine = create_engine(db)
     Base.metadata.create_all(engine)
+    upgrade(engine)
+
+
+def upgrade(engine):
+    """
+    Add any columns and indexes which are missing from existing tables.  create_all() only creates tables
+    which don't exist at all, so without this databases created by older versions would lack newer columns.
+    Only nullable columns, or columns with a simple default, can be added this way.
+
+    :param engine: The engine to upgrade
+    """
+    log = logging.getLogger(__name__)
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = [ column['name'] for column in inspector.get_columns(table.name) ]
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                log.info(f"Adding missing column { column.name } to { table.name }")
+                column_type = column.type.compile(dialect=engine.dialect)
+                default = ""
+                if column.default is not None and column.default.is_scalar:
+                    value = column.default.arg
+                    if isinstance(value, bool):
+                        value = int(value)
+                    default = f" DEFAULT { value if isinstance(value, (int, float)) else repr(str(value)) }"
+                nullable = "" if column.nullable else " NOT NULL"
+                connection.execute(text(f"ALTER TABLE { table.name } ADD COLUMN { column.name } { column_type }{ default }{ nullable }"))
+            existing_indexes = [ index['name'] for index in inspector.get_indexes(table.name) ]
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    log.info(f"Adding missing index { index.name } to { table.name }")
+                    connection.execute(CreateIndex(index))
 
 
 def get_session():
@@ -82,6 +120,29 @@ def create_recording_if_needed(dbs, j):
         existing_recording = create_recording(j)
     return existing_recording
 
+@with_session
+def save_recording_files(dbs, uuid, files):
+    """
+    Replace the catalog of recording uuid's files with files, as found in Zoom's webhook, recording and list
+    responses.  Files without an id (eg, those still being processed) are skipped.
+    """
+    dbs.query(RecordingFile).filter(RecordingFile.uuid == uuid).delete(synchronize_session=False)
+    for file in files:
+        if file.get('id'):
+            dbs.add(RecordingFile(uuid, file))
+    dbs.commit()
+
+@with_session
+def find_recording_files(dbs, uuid, updated_after):
+    """
+    :return: The catalogued files of recording uuid, or an empty list if there are none or any of them were last
+             updated before updated_after
+    """
+    files = dbs.query(RecordingFile).filter(RecordingFile.uuid == uuid).order_by(RecordingFile.recording_start).all()
+    if any(file.updated < updated_after for file in files):
+        return []
+    return files
+
 @with_session
 def create_ingest(dbs, uuid, params):
     ingest = Ingest(uuid, params)
@@ -90,6 +151,302 @@ def create_ingest(dbs, uuid, params):
     dbs.refresh(ingest)
     return ingest.get_id()
 
+@with_session
+def create_queued_ingest(dbs, uuid, params, ingest_class, host=None, size=None):
+    """
+    Create an ingest, and the outbox entry for its queue message, in a single transaction.  Either both exist
+    afterwards or neither does, so an ingest can't be left without a message because the queue was down.
+
+    :return: The id of the new ingest
+    """
+    ingest = Ingest(uuid, params)
+    dbs.add(ingest)
+    #Assigns the ingest's id without committing
+    dbs.flush()
+    ingest_id = ingest.get_id()
+    dbs.add(Outbox(uuid, ingest_id, ingest_class, host, size))
+    dbs.commit()
+    return ingest_id
+
+@with_session
+def relay_outbox(dbs, publish, limit=100):
+    """
+    Publish up to limit outbox entries, oldest first, and remove them once they are published.  If publish raises
+    the entries stay where they are, to be tried again.  On MariaDB, MySQL and PostgreSQL the entries are locked
+    until then, so concurrent relays skip each other's entries rather than publishing them twice.
+
+    :param publish: Called with the list of entries to publish
+    :return: The number of entries published
+    """
+    query = dbs.query(Outbox).order_by(Outbox.outbox_id).limit(limit)
+    if dbs.get_bind().dialect.name in ('mysql', 'mariadb', 'postgresql'):
+        query = query.with_for_update(skip_locked=True)
+    entries = query.all()
+    if len(entries) == 0:
+        return 0
+    publish(entries)
+    dbs.query(Outbox).filter(Outbox.outbox_id.in_([ entry.outbox_id for entry in entries ])).delete(synchronize_session=False)
+    dbs.commit()
+    return len(entries)
+
+@with_session
+def create_webhook_event(dbs, event_type, body):
+    """
+    Store a raw webhook event to be processed later, see claim_webhook_events
+
+    :return: The id of the stored event
+    """
+    event = WebhookEvent(event_type, body)
+    dbs.add(event)
+    dbs.commit()
+    dbs.refresh(event)
+    return event.event_id
+
+@with_session
+def claim_webhook_events(dbs, lease, limit=10):
+    """
+    Claim up to limit stored webhook events which are due, oldest first.  A claimed event isn't handed out again
+    until lease has passed, so if its processor dies it is picked up again after that.
+
+    :return: The list of claimed events
+    """
+    now = datetime.utcnow()
+    candidates = dbs.query(WebhookEvent.event_id) \
+        .filter(WebhookEvent.available_at <= now) \
+        .order_by(WebhookEvent.event_id) \
+        .limit(limit) \
+        .all()
+    claimed = []
+    for (event_id,) in candidates:
+        updated = dbs.query(WebhookEvent) \
+            .filter(WebhookEvent.event_id == event_id, WebhookEvent.available_at <= now) \
+            .update({WebhookEvent.available_at: now + lease}, synchronize_session=False)
+        if 1 == updated:
+            claimed.append(event_id)
+    dbs.commit()
+    if len(claimed) == 0:
+        return []
+    return dbs.query(WebhookEvent).filter(WebhookEvent.event_id.in_(claimed)).order_by(WebhookEvent.event_id).all()
+
+@with_session
+def complete_webhook_event(dbs, event_id):
+    dbs.query(WebhookEvent).filter(WebhookEvent.event_id == event_id).delete(synchronize_session=False)
+    dbs.commit()
+
+@with_session
+def fail_webhook_event(dbs, event_id, attempts, error, available_at=None):
+    """
+    Record a failed attempt at processing a webhook event
+
+    :param available_at: When to try again, None to give up.  The event is kept for inspection either way.
+    """
+    dbs.query(WebhookEvent) \
+        .filter(WebhookEvent.event_id == event_id) \
+        .update({WebhookEvent.attempts: attempts, WebhookEvent.available_at: available_at,
+                 WebhookEvent.last_error: str(error)[:1024]}, synchronize_session=False)
+    dbs.commit()
+
+@with_session
+def record_event_key(dbs, key, ttl):
+    """
+    Record that the webhook event identified by key has been received.  The key is the table's primary key, so
+    when several processes receive the same event at once exactly one of them records it.
+
+    :param ttl: How long a key is remembered for.  Keys older than this are recorded again as if they were new.
+    :return: True if the event is new, False if it was already received within ttl
+    """
+    now = datetime.utcnow()
+    dbs.add(EventKey(key, now))
+    try:
+        dbs.commit()
+        return True
+    except IntegrityError:
+        dbs.rollback()
+    updated = dbs.query(EventKey) \
+        .filter(EventKey.key == key, EventKey.received < now - ttl) \
+        .update({EventKey.received: now}, synchronize_session=False)
+    dbs.commit()
+    return 1 == updated
+
+@with_session
+def forget_event_key(dbs, key):
+    """
+    Forget that an event was received, so that a redelivery of it is processed
+    """
+    dbs.query(EventKey).filter(EventKey.key == key).delete(synchronize_session=False)
+    dbs.commit()
+
+@with_session
+def purge_event_keys(dbs, older_than):
+    """
+    :return: The number of keys received before older_than which were removed
+    """
+    deleted = dbs.query(EventKey).filter(EventKey.received < older_than).delete(synchronize_session=False)
+    dbs.commit()
+    return deleted
+
+def _lease_available(now):
+    return or_(Ingest.owner == None, Ingest.lease_expires == None, Ingest.lease_expires < now)
+
+@with_session
+def claim_ingest(dbs, ingest_id, owner, lease):
+    """
+    Claim an ingest for owner, so that no other node processes it at the same time.  The claim is a single
+    conditional UPDATE, so exactly one of several competing nodes wins it on any database.
+
+    :param ingest_id: The ingest to claim
+    :param owner: The id of the claiming node
+    :param lease: timedelta the claim is valid for, after which other nodes may take the ingest over
+    :return: When the claim expires if the ingest is now owned by owner, None if someone else holds it, or it is done
+    """
+    now = datetime.utcnow()
+    claimed = dbs.query(Ingest) \
+        .filter(Ingest.ingest_id == ingest_id, Ingest.status.notin_([Status.FINISHED, Status.WARNING, Status.DEAD_LETTER]), _lease_available(now)) \
+        .update({Ingest.owner: owner, Ingest.lease_expires: now + lease, Ingest.heartbeat: now}, synchronize_session=False)
+    dbs.commit()
+    return now + lease if 1 == claimed else None
+
+def _due(now, older_than):
+    #Failed ingests are due once their backoff is over.  New ingests are only picked up here if their rabbit
+    #message seems to have been lost
+    failed = and_(Ingest.status == Status.FAILED, Ingest.next_attempt_at <= now)
+    if older_than is None:
+        return failed
+    return or_(failed, and_(Ingest.status == Status.NEW, Ingest.timestamp <= older_than))
+
+@with_session
+def claim_backlog(dbs, owner, lease, older_than, limit=1, exclude=(), due_before=None):
+    """
+    Claim up to limit ingests which are due for (re)processing, and which no other node holds.  Both halves
+    of the due check are covered by an index, so this stays cheap however many ingests have failed.
+
+    On MariaDB, MySQL and PostgreSQL the candidate rows are locked with SELECT ... FOR UPDATE SKIP LOCKED,
+    so concurrent nodes skip each other's rows rather than waiting on them.  SQLite has no row locks, but
+    only allows one writer at a time, so the conditional UPDATE of each row decides who gets it there.
+
+    :param older_than: New ingests queued before this are claimed too, None to only claim failed ingests
+    :param exclude: Ids of ingests not to claim, eg those already attempted in this pass over the backlog
+    :param due_before: Only claim failed ingests whose next attempt was due before this, defaults to now
+    :return: The list of claimed ingests
+    """
+    now = datetime.utcnow()
+    query = dbs.query(Ingest) \
+        .filter(_due(due_before or now, older_than), _lease_available(now))
+    if exclude:
+        query = query.filter(Ingest.ingest_id.notin_(list(exclude)))
+    query = query \
+        .order_by(Ingest.timestamp) \
+        .limit(limit)
+    if dbs.get_bind().dialect.name in ('mysql', 'mariadb', 'postgresql'):
+        query = query.with_for_update(skip_locked=True)
+    claimed = []
+    for ingest in query.all():
+        updated = dbs.query(Ingest) \
+            .filter(Ingest.ingest_id == ingest.ingest_id, _lease_available(now)) \
+            .update({Ingest.owner: owner, Ingest.lease_expires: now + lease, Ingest.heartbeat: now}, synchronize_session=False)
+        if 1 == updated:
+            claimed.append(ingest.ingest_id)
+    dbs.commit()
+    if len(claimed) == 0:
+        return []
+    return dbs.query(Ingest).filter(Ingest.ingest_id.in_(claimed)).all()
+
+@with_session
+def release_ingest(dbs, ingest_id, owner):
+    """
+    Give up owner's claim on an ingest, so that it may be retried by any node
+    """
+    dbs.query(Ingest) \
+        .filter(Ingest.ingest_id == ingest_id, Ingest.owner == owner) \
+        .update({Ingest.owner: None, Ingest.lease_expires: None}, synchronize_session=False)
+    dbs.commit()
+
+@with_session
+def record_failure(dbs, ingest_id, attempts, error, next_attempt_at=None):
+    """
+    Record a failed attempt at an ingest
+
+    :param attempts: The number of failed attempts, including this one
+    :param error: Description of what went wrong
+    :param next_attempt_at: When to try again, None to give up and dead letter the ingest
+    """
+    status = Status.FAILED if next_attempt_at else Status.DEAD_LETTER
+    dbs.query(Ingest) \
+        .filter(Ingest.ingest_id == ingest_id) \
+        .update({Ingest.status: status, Ingest.timestamp: datetime.utcnow(), Ingest.attempts: attempts,
+                 Ingest.next_attempt_at: next_attempt_at, Ingest.last_error: str(error)[:1024]}, synchronize_session=False)
+    dbs.commit()
+    return status
+
+@with_session
+def save_checkpoint(dbs, ingest_id, owner, checkpoint):
+    """
+    Record how far owner has got with an ingest, so that a retry can resume from there
+
+    :param checkpoint: A JSON serializable dict
+    :return: True if the checkpoint was saved, False if owner no longer holds the ingest
+    """
+    updated = dbs.query(Ingest) \
+        .filter(Ingest.ingest_id == ingest_id, Ingest.owner == owner) \
+        .update({Ingest.checkpoint: json.dumps(checkpoint).encode('utf-8')}, synchronize_session=False)
+    dbs.commit()
+    return 1 == updated
+
+@with_session
+def next_attempt_due(dbs):
+    """
+    :return: When the next failed ingest is due to be retried, or None if there are none
+    """
+    return dbs.query(func.min(Ingest.next_attempt_at)).filter(Ingest.status == Status.FAILED).scalar()
+
+@with_session
+def heartbeat_ingests(dbs, ingest_ids, owner, lease):
+    """
+    Record that owner is still alive and working on ingest_ids, and extend its claims on them
+
+    :return: The number of ingests which are still owned by owner
+    """
+    now = datetime.utcnow()
+    updated = dbs.query(Ingest) \
+        .filter(Ingest.ingest_id.in_(ingest_ids), Ingest.owner == owner) \
+        .update({Ingest.heartbeat: now, Ingest.lease_expires: now + lease}, synchronize_session=False)
+    dbs.commit()
+    return updated
+
+def _stale(stale_before):
+    #Rows from before heartbeats existed only have their timestamp to go on
+    return and_(Ingest.status == Status.IN_PROGRESS,
+                or_(Ingest.heartbeat < stale_before, and_(Ingest.heartbeat == None, Ingest.timestamp < stale_before)))
+
+@with_session
+def find_stale_ingests(dbs, stale_before):
+    """
+    :return: The ingests which are in progress, but whose owner has not been heard from since stale_before
+    """
+    return dbs.query(Ingest).filter(_stale(stale_before)).all()
+
+@with_session
+def requeue_stale_ingest(dbs, ingest_id, stale_before, max_attempts):
+    """
+    Mark a stale in progress ingest as failed and due now, and drop its owner's claim, so that it is processed
+    again.  The crash counts as an attempt, so a recording which keeps killing its uploader is dead lettered
+    once it has used up its attempts.  Only one of several nodes reaping at the same time succeeds.
+
+    :param max_attempts: The number of failed attempts after which the ingest is dead lettered rather than requeued
+    :return: The ingest's new status, FAILED or DEAD_LETTER, or None if this call did not reap it
+    """
+    now = datetime.utcnow()
+    exhausted = Ingest.attempts + 1 >= max_attempts
+    updated = dbs.query(Ingest) \
+        .filter(Ingest.ingest_id == ingest_id, _stale(stale_before)) \
+        .update({Ingest.status: case((exhausted, Status.DEAD_LETTER), else_=Status.FAILED), Ingest.timestamp: now,
+                 Ingest.attempts: Ingest.attempts + 1, Ingest.next_attempt_at: case((exhausted, None), else_=now),
+                 Ingest.last_error: "Abandoned in progress", Ingest.owner: None, Ingest.lease_expires: None, Ingest.heartbeat: None}, synchronize_session=False)
+    dbs.commit()
+    if 1 != updated:
+        return None
+    return dbs.query(Ingest.status).filter(Ingest.ingest_id == ingest_id).scalar()
+
 @with_session
 def ensure_user(dbs, j):
     user_id = j['id']
@@ -185,6 +542,19 @@ def find_user_by_id_or_email(dbs, query):
             )).one_or_none()
 
 
+@with_session
+def find_users_by_ids(dbs, user_ids):
+    """
+    :return: dict of user id to User, for those of user_ids which are in the database
+    """
+    user_ids = list(set(user_ids))
+    users = {}
+    #Keeps each IN list well below the databases' limits on query parameters
+    for i in range(0, len(user_ids), 500):
+        for user in dbs.query(User).filter(User.user_id.in_(user_ids[i:i + 500])).all():
+            users[user.user_id] = user
+    return users
+
 
 class Constants:
 
@@ -202,6 +572,10 @@ class Status(Constants):
     IN_PROGRESS = 1
     FINISHED = 2
     WARNING = 3
+    #Failed, and waiting for its next attempt
+    FAILED = 4
+    #Failed too many times, will not be retried automatically
+    DEAD_LETTER = 5
 
 
 # Database Schema Definition
@@ -260,6 +634,61 @@ class Recording(Base):
         }
 
 
+class RecordingFile(Base):
+    """Database definition of one file of a Zoom recording, see save_recording_files."""
+
+    __tablename__ = 'recording_file'
+
+    file_id = Column('id', String(length=64), primary_key=True)
+    uuid = Column('uuid', String(length=32), nullable=False)
+    recording_start = Column('recording_start', String(length=32), nullable=True)
+    recording_end = Column('recording_end', String(length=32), nullable=True)
+    recording_type = Column('recording_type', String(length=64), nullable=True)
+    file_type = Column('file_type', String(length=16), nullable=True)
+    file_extension = Column('file_extension', String(length=16), nullable=True)
+    file_size = Column('file_size', BigInteger(), nullable=True)
+    download_url = Column('download_url', String(length=1024), nullable=True)
+    status = Column('status', String(length=32), nullable=True)
+    updated = Column('updated', DateTime(), nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index('ix_recording_file_uuid', 'uuid'),
+    )
+
+    def __init__(self, uuid, data):
+        self.file_id = data['id']
+        self.uuid = uuid
+        self.recording_start = data.get('recording_start')
+        self.recording_end = data.get('recording_end')
+        self.recording_type = data.get('recording_type')
+        self.file_type = data.get('file_type')
+        self.file_extension = data.get('file_extension')
+        self.file_size = data.get('file_size')
+        self.download_url = data.get('download_url')
+        self.status = data.get('status')
+        self.updated = datetime.utcnow()
+
+    def is_complete(self):
+        return self.status is not None and self.status.lower() == 'completed'
+
+    def serialize(self):
+        """
+        Serialize this object in the same form as Zoom.get_recording_files.
+
+        :return: Dictionary representing this object.
+        """
+        return {
+            'recording_id': self.file_id,
+            'recording_start': self.recording_start,
+            'recording_end': self.recording_end,
+            'download_url': self.download_url,
+            'file_type': self.file_type,
+            'file_size': self.file_size,
+            'file_extension': self.file_extension,
+            'recording_type': self.recording_type,
+        }
+
+
 class Ingest(Base):
     """Database definition of an ingest to Opencast."""
 
@@ -275,6 +704,24 @@ class Ingest(Base):
     params = Column('zingest_parms', LargeBinary(), nullable=False)
     mediapackage_id = Column('mediapackage_id', String(length=36), nullable=True, default=None)
     workflow_id = Column('workflow_id', String(length=36), nullable=True, default=None)
+    #The node currently processing this ingest, and until when that claim holds
+    owner = Column('owner', String(length=128), nullable=True, default=None)
+    lease_expires = Column('lease_expires', DateTime(), nullable=True, default=None)
+    #Refreshed by the owner while it works on the ingest, so crashed owners can be detected
+    heartbeat = Column('heartbeat', DateTime(), nullable=True, default=None)
+    #Number of failed attempts so far, when the next one is due, and why the last one failed
+    attempts = Column('attempts', Integer(), nullable=False, default=0)
+    next_attempt_at = Column('next_attempt_at', DateTime(), nullable=True, default=None)
+    last_error = Column('last_error', String(length=1024), nullable=True, default=None)
+    #JSON record of the work done by failed attempts, so the next one can pick up where they left off
+    checkpoint = Column('checkpoint', LargeBinary(), nullable=True, default=None)
+
+    __table_args__ = (
+        Index('ix_ingest_status_timestamp', 'status', 'timestamp'),
+        Index('ix_ingest_status_next_attempt', 'status', 'next_attempt_at'),
+        #The webhook checks for an existing webhook ingest of a recording before creating another
+        Index('ix_ingest_uuid_is_webhook', 'uuid', 'is_webhook'),
+    )
 
     def __init__(self, uuid, params="{}"):
         self.uuid = uuid
@@ -282,6 +729,7 @@ class Ingest(Base):
             self.webhook_ingest = str(params['is_webhook']) in ['true', 'True']
         self.params = json.dumps(params).encode('utf-8')
         self.update_status(Status.NEW)
+        self.attempts = 0
         self.mediapackage_id = None
         self.workflow_id = None
 
@@ -294,6 +742,12 @@ class Ingest(Base):
     def get_params(self):
         return self.params
 
+    def get_checkpoint(self):
+        return json.loads(self.checkpoint.decode('utf-8')) if self.checkpoint else {}
+
+    def set_checkpoint(self, checkpoint):
+        self.checkpoint = json.dumps(checkpoint).encode('utf-8') if checkpoint else None
+
     def status_str(self):
         """Return status as string."""
         return Status.str(self.status)
@@ -325,8 +779,84 @@ class Ingest(Base):
             'status': self.status,
             'mediapackage_id': self.mediapackage_id,
             'workflow_id': self.workflow_id,
+            'owner': self.owner,
+            'attempts': self.attempts,
+            'next_attempt_at': self.next_attempt_at,
+            'last_error': self.last_error,
         }
 
+class Outbox(Base):
+    """Database definition of a queue message waiting to be published, see create_queued_ingest."""
+
+    __tablename__ = 'outbox'
+
+    outbox_id = Column('id', Integer(), primary_key=True, autoincrement=True)
+    uuid = Column('uuid', String(length=32), nullable=False)
+    ingest_id = Column('ingest_id', Integer(), nullable=False)
+    ingest_class = Column('ingest_class', String(length=16), nullable=False)
+    host = Column('host', String(length=32), nullable=True, default=None)
+    size = Column('size', BigInteger(), nullable=True, default=None)
+    timestamp = Column('timestamp', DateTime(), nullable=False, default=datetime.utcnow)
+
+    def __init__(self, uuid, ingest_id, ingest_class, host=None, size=None):
+        self.uuid = uuid
+        self.ingest_id = ingest_id
+        self.ingest_class = ingest_class
+        self.host = host
+        self.size = size
+        self.timestamp = datetime.utcnow()
+
+    def get_message_args(self):
+        """:return: The arguments to send_rabbit_msg for this entry"""
+        return (self.uuid, self.ingest_id, self.ingest_class, self.host, self.size)
+
+
+class WebhookEvent(Base):
+    """Database definition of a raw webhook event which has been accepted, but not yet processed."""
+
+    __tablename__ = 'webhook_event'
+
+    event_id = Column('id', Integer(), primary_key=True, autoincrement=True)
+    event_type = Column('event_type', String(length=64), nullable=False)
+    body = Column('body', LargeBinary(), nullable=False)
+    received = Column('received', DateTime(), nullable=False, default=datetime.utcnow)
+    #When the event is next due to be processed, None once it has been given up on
+    available_at = Column('available_at', DateTime(), nullable=True, default=datetime.utcnow)
+    attempts = Column('attempts', Integer(), nullable=False, default=0)
+    last_error = Column('last_error', String(length=1024), nullable=True, default=None)
+
+    __table_args__ = (
+        Index('ix_webhook_event_available_at', 'available_at'),
+    )
+
+    def __init__(self, event_type, body):
+        self.event_type = event_type
+        self.body = json.dumps(body).encode('utf-8')
+        self.received = datetime.utcnow()
+        self.available_at = self.received
+        self.attempts = 0
+
+    def get_body(self):
+        return json.loads(self.body.decode('utf-8'))
+
+
+class EventKey(Base):
+    """Database definition of the key of a received webhook event, see record_event_key."""
+
+    __tablename__ = 'webhook_event_key'
+
+    key = Column('event_key', String(length=255), primary_key=True)
+    received = Column('received', DateTime(), nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index('ix_webhook_event_key_received', 'received'),
+    )
+
+    def __init__(self, key, received=None):
+        self.key = key
+        self.received = received or datetime.utcnow()
+
+
 class User(Base):
     """Database definition of a Zoom user."""
 
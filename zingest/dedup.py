@@ -0,0 +1,110 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from zingest import db
+from zingest.common import get_config_default
+
+
+class EventDeduplicator:
+    """
+    Recognises webhook events which Zoom has delivered before, so that its redeliveries can be answered without
+    validating them again or calling Zoom or Opencast.
+
+    Keys are checked against a bounded in-memory LRU first, which is what absorbs a storm of redeliveries, then
+    recorded in the database, whose unique key settles races between processes and survives restarts.
+
+    A key only goes into the LRU once its event has been handled successfully.  Until then processing may still
+    fail, and the key be forgotten, in any process, and none of them may be left ignoring Zoom's redelivery.
+    """
+
+    SECTION = "Webhook"
+
+    def __init__(self, config):
+        self.logger = logging.getLogger(__name__)
+        self.size = int(get_config_default(config, EventDeduplicator.SECTION, "dedup_cache_size", 10000))
+        self.ttl = timedelta(hours=float(get_config_default(config, EventDeduplicator.SECTION, "dedup_ttl_hours", 24)))
+        if self.size < 1:
+            raise ValueError(f"dedup_cache_size must be at least 1, not { self.size }")
+        self.lock = threading.Lock()
+        #Key to when it was received, by time.monotonic(), least recently seen first
+        self.recent = OrderedDict()
+        self.next_purge = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def event_key(body):
+        """
+        Identify a webhook event.  Completions are unique per recording, renames per recording and new title.
+
+        :return: The key, or None if the event can't be identified
+        """
+        try:
+            event_type = body['event']
+            obj = body['payload']['object']
+            if "recording.renamed" == event_type:
+                return f"{ event_type }:{ obj['uuid'] }:{ obj['topic'] }"[:255]
+            return f"{ event_type }:{ obj['uuid'] }"[:255]
+        except (KeyError, TypeError):
+            return None
+
+    def is_duplicate(self, key):
+        """
+        Check whether key has been seen within the TTL, and record it in the database if not
+
+        :return: True if the event is a duplicate
+        """
+        now = time.monotonic()
+        with self.lock:
+            seen = self.recent.get(key)
+            if seen is not None and now - seen < self.ttl.total_seconds():
+                self.recent.move_to_end(key)
+                self.hits += 1
+                return True
+        new = db.record_event_key(key, self.ttl)
+        with self.lock:
+            if new:
+                self.misses += 1
+            else:
+                self.hits += 1
+        self._purge(now)
+        return not new
+
+    def remember(self, key):
+        """
+        Keep key in memory, so redeliveries are answered without the database.  Only call this once its event has
+        been handled, since a key in memory can't be forgotten by other processes.
+        """
+        with self.lock:
+            self.recent[key] = time.monotonic()
+            self.recent.move_to_end(key)
+            while len(self.recent) > self.size:
+                self.recent.popitem(last=False)
+
+    def forget(self, key):
+        """
+        Forget key, so that a redelivery of its event is processed.  Used when processing failed.
+        """
+        with self.lock:
+            self.recent.pop(key, None)
+        db.forget_event_key(key)
+
+    def _purge(self, now):
+        #Expired keys are ignored anyway, so the table only needs trimming now and then
+        with self.lock:
+            if now < self.next_purge:
+                return
+            self.next_purge = now + 3600
+        try:
+            purged = db.purge_event_keys(datetime.utcnow() - self.ttl)
+            if purged > 0:
+                self.logger.debug(f"Purged { purged } expired webhook event keys")
+        except Exception:
+            self.logger.exception("Unable to purge expired webhook event keys")
+
+    def stats(self):
+        with self.lock:
+            return {'cached': len(self.recent), 'hits': self.hits, 'misses': self.misses}
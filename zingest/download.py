@@ -0,0 +1,301 @@
+import json
+import logging
+import os
+import queue
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from zingest.common import get_config_default
+from zingest.transport import create_session
+
+
+class DownloadException(Exception):
+    pass
+
+
+class DownloadJournal:
+    """
+    Records which byte ranges of an in-progress download have been written to disk,
+    along with the validators (url identity, size) needed to safely resume it later.
+    """
+
+    def __init__(self, path, identity, size):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.identity = identity
+        self.size = size
+        self.done = []
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Load the journal from disk.
+
+        :return: True if a journal matching this download was found, False otherwise
+        """
+        if not os.path.isfile(self.path):
+            return False
+        try:
+            with open(self.path, 'r') as fd:
+                journal = json.load(fd)
+        except (OSError, ValueError):
+            self.logger.warning(f"Unable to read download journal { self.path }, discarding it")
+            return False
+        if journal.get('identity') != self.identity or journal.get('size') != self.size:
+            self.logger.info(f"Download journal { self.path } belongs to a different file, discarding it")
+            return False
+        self.done = [ (start, end) for start, end in journal.get('done', []) ]
+        return True
+
+    def reset(self):
+        with self.lock:
+            self.done = []
+            self._write()
+
+    def add(self, start, end):
+        """Mark the bytes [start, end) as written, and persist the journal"""
+        if end <= start:
+            return
+        with self.lock:
+            merged = []
+            for existing in sorted(self.done + [ (start, end) ]):
+                if merged and existing[0] <= merged[-1][1]:
+                    merged[-1] = (merged[-1][0], max(merged[-1][1], existing[1]))
+                else:
+                    merged.append(existing)
+            self.done = merged
+            self._write()
+
+    def _write(self):
+        tmp = f"{ self.path }.tmp"
+        with open(tmp, 'w') as fd:
+            json.dump({'identity': self.identity, 'size': self.size, 'done': self.done}, fd)
+        os.replace(tmp, self.path)
+
+    def completed(self):
+        return sum(end - start for start, end in self.done)
+
+    def missing(self, start, end):
+        """:return: The list of [start, end) ranges inside [start, end) which have not been written yet"""
+        gaps = []
+        position = start
+        for done_start, done_end in self.done:
+            if done_end <= position or done_start >= end:
+                continue
+            if done_start > position:
+                gaps.append((position, done_start))
+            position = max(position, done_end)
+        if position < end:
+            gaps.append((position, end))
+        return gaps
+
+    def remove(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+class Downloader:
+
+    CHUNK_SIZE = 8192
+    #How often progress within a single request is written to the journal
+    JOURNAL_INTERVAL = 8 * 1024 * 1024
+    CONTENT_RANGE = re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)")
+
+    def __init__(self, config, session=None):
+        """
+        :param session: The requests.Session to download through, defaults to a new one configured from the [Zoom] section
+        """
+        self.logger = logging.getLogger(__name__)
+        self.session = session or create_session(config, "Zoom", default_read_timeout=60)
+        #Number of parallel HTTP Range requests per file, 1 disables segmented downloads
+        self.connections = int(get_config_default(config, "Uploader", "download_connections", 1))
+        self.segment_size = int(get_config_default(config, "Uploader", "download_segment_mb", 64)) * 1024 * 1024
+        self.logger.debug(f"Downloading with { self.connections } connection(s) per file, in segments of { self.segment_size } bytes")
+
+    def download(self, url, output, expected_size, identity=None):
+        """
+        Download url to output.  The file is written to output.part, with progress recorded in output.journal,
+        and only moved to output once complete.  If a previous attempt left a matching journal behind then
+        the download resumes where it stopped.
+
+        :param identity: Stable identifier for the remote file, defaults to url without its query string (ie, access token)
+        """
+        expected_size = int(expected_size) if expected_size else 0
+        part = f"{ output }.part"
+        journal = DownloadJournal(f"{ output }.journal", identity or url.split('?')[0], expected_size)
+        if not journal.load() or not os.path.isfile(part):
+            journal.reset()
+        elif journal.completed() > 0:
+            self.logger.info(f"Resuming download of { output } at { journal.completed() } of { expected_size } bytes")
+
+        source = None
+        if expected_size and (journal.completed() > 0 or (self.connections > 1 and expected_size > self.segment_size)):
+            source = self._probe_range_support(url, expected_size)
+            if not source:
+                self.logger.debug(f"Range requests are not supported for { output }, falling back to a single stream")
+
+        if source:
+            self._download_ranges(source, part, expected_size, journal)
+            if journal.completed() != expected_size or os.path.getsize(part) != expected_size:
+                raise DownloadException(f"{ output } has { journal.completed() } bytes, expected { expected_size }")
+        else:
+            journal.reset()
+            self._download_single(url, part, journal)
+            if expected_size and expected_size != os.path.getsize(part):
+                self.logger.warning(f"{ output } has { os.path.getsize(part) } bytes, expected { expected_size }")
+        os.replace(part, output)
+        journal.remove()
+
+    def _download_single(self, url, path, journal):
+        with open(path, 'wb') as fd:
+            with self.session.get(url, stream=True) as r:
+                r.raise_for_status()
+                self._write_response(r, fd, 0, journal)
+
+    def _probe_range_support(self, url, expected_size):
+        """
+        Check whether the server honours Range requests for this url.
+
+        :return: The (post-redirect) url to fetch the segments from, or None if Range is not supported
+        """
+        with self.session.get(url, headers={'Range': 'bytes=0-0'}, stream=True) as r:
+            if r.status_code != 206:
+                return None
+            match = Downloader.CONTENT_RANGE.match(r.headers.get('Content-Range', ''))
+            if not match or match.group(3) != str(expected_size):
+                self.logger.debug(f"Unexpected Content-Range { r.headers.get('Content-Range') } for a file of { expected_size } bytes")
+                return None
+            return r.url
+
+    def _segments(self, expected_size):
+        return [ (start, min(start + self.segment_size, expected_size)) for start in range(0, expected_size, self.segment_size) ]
+
+    def _download_ranges(self, url, path, expected_size, journal):
+        if not os.path.isfile(path):
+            with open(path, 'wb') as fd:
+                fd.truncate(expected_size)
+        #Only fetch what the journal says is still missing
+        ranges = [ gap for segment in self._segments(expected_size) for gap in journal.missing(*segment) ]
+        self.logger.debug(f"Downloading { len(ranges) } ranges of { path } over { self.connections } connections")
+        with ThreadPoolExecutor(max_workers=self.connections) as executor:
+            #list() forces any exception raised by a range to surface here
+            list(executor.map(lambda r: self._download_range(url, path, r[0], r[1], journal), ranges))
+
+    def _download_range(self, url, path, start, end, journal):
+        with self.session.get(url, headers={'Range': f'bytes={ start }-{ end - 1 }'}, stream=True) as r:
+            r.raise_for_status()
+            if r.status_code != 206:
+                raise DownloadException(f"Server ignored the range request for bytes { start }-{ end - 1 }")
+            with open(path, 'r+b') as fd:
+                fd.seek(start)
+                written = self._write_response(r, fd, start, journal)
+        if written != end - start:
+            raise DownloadException(f"Range { start }-{ end - 1 } was truncated after { written } bytes")
+
+    def _write_response(self, r, fd, offset, journal):
+        position = offset
+        marked = offset
+        for chunk in r.iter_content(chunk_size=Downloader.CHUNK_SIZE):
+            fd.write(chunk)
+            position += len(chunk)
+            if position - marked >= Downloader.JOURNAL_INTERVAL:
+                #The bytes must have left our buffers before the journal claims they are on disk
+                fd.flush()
+                journal.add(marked, position)
+                marked = position
+        fd.flush()
+        journal.add(marked, position)
+        return position - offset
+
+
+class StreamingTrack:
+    """
+    Read-only file-like view of a remote file, suitable as a MultipartEncoder field.  A background thread
+    downloads the file into a bounded in-memory buffer while the encoder drains it, so the download and the
+    upload overlap without the file ever touching disk.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, url, name, size, buffer_size, session=None):
+        self.logger = logging.getLogger(__name__)
+        self.session = session or create_session({}, "Zoom", default_read_timeout=60)
+        self.url = url
+        self.name = name
+        self.size = int(size)
+        self.chunks = queue.Queue(maxsize=max(1, buffer_size // StreamingTrack.CHUNK_SIZE))
+        self.pending = bytearray()
+        self.position = 0
+        self.error = None
+        self.eof = False
+        self.closed = False
+        self.thread = threading.Thread(target=self._fill, daemon=True)
+        self.thread.start()
+
+    def __str__(self):
+        return self.name
+
+    def __len__(self):
+        #MultipartEncoder treats the length of a readable object as the number of bytes *left* to read
+        return self.size - self.position
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _put(self, item):
+        while not self.closed:
+            try:
+                self.chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def _fill(self):
+        try:
+            with self.session.get(self.url, stream=True) as r:
+                r.raise_for_status()
+                for chunk in r.iter_content(chunk_size=StreamingTrack.CHUNK_SIZE):
+                    if self.closed:
+                        return
+                    self._put(chunk)
+        except Exception as e:
+            self.error = e
+        finally:
+            self._put(None)
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        while not self.eof and (size is None or size < 0 or len(self.pending) < size):
+            chunk = self.chunks.get()
+            if chunk is None:
+                self.eof = True
+            else:
+                self.pending.extend(chunk)
+        if self.eof and self.error:
+            raise DownloadException(f"Streaming { self.name } failed: { self.error }")
+        if size is None or size < 0:
+            size = len(self.pending)
+        data = bytes(self.pending[:size])
+        del self.pending[:size]
+        self.position += len(data)
+        if self.eof and len(self.pending) == 0 and self.position < self.size:
+            #Sending less than the advertised length would leave the upload hanging
+            raise DownloadException(f"Streaming { self.name } ended after { self.position } of { self.size } bytes")
+        return data
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        #Unblock the download thread if it is waiting for space in the buffer
+        try:
+            while True:
+                self.chunks.get_nowait()
+        except queue.Empty:
+            pass
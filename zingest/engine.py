@@ -0,0 +1,293 @@
+import asyncio
+import functools
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+import aiohttp
+
+from zingest.common import NoMp4Files, get_config_default
+from zingest.opencast import redact_tokens
+
+
+class AsyncEngine:
+    """
+    Runs ingests as coroutines on a single event loop, rather than holding a thread per in-flight recording.
+    Each step of an ingest waits on its own semaphore, so hundreds of recordings can be queued for metadata
+    while only a handful download or upload at once.
+
+    The transfers, ie downloading from Zoom and every request to Opencast, are made with aiohttp and awaited
+    on the loop.  Only what has no async client runs on executors: the database, Opencast's ACL lookups, and
+    the Zoom API call for a recording's files, which goes through the thread based rate limiter and caches
+    (and is normally answered from the file catalog without calling Zoom at all).  Stream mode, which pipes a
+    blocking download into the upload, also runs on an executor.
+    """
+
+    STEPS = [ 'metadata', 'download', 'build', 'upload', 'trigger' ]
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, config, opencast):
+        self.logger = logging.getLogger(__name__)
+        self.opencast = opencast
+        workers = opencast.workers
+        #Each step defaults to the overall worker count, so only the bottlenecks need to be configured
+        self.limits = { name: int(get_config_default(config, "Uploader", f"{ name }_workers", workers)) for name in AsyncEngine.STEPS }
+        #Recordings waiting for a semaphore cost nothing but memory, so we can accept far more than we run
+        self.in_flight = int(get_config_default(config, "Uploader", "max_in_flight", sum(self.limits.values()) * 4))
+        db_workers = int(get_config_default(config, "Uploader", "db_workers", 4))
+        self.executor = ThreadPoolExecutor(max_workers=self.limits['metadata'] + self.limits['build'] + self.limits['upload'], thread_name_prefix="ingest-io")
+        self.db_executor = ThreadPoolExecutor(max_workers=db_workers, thread_name_prefix="ingest-db")
+        self.timeouts = { group: self._timeout(config, group, read_timeout) for group, read_timeout in (("Zoom", 60), ("Opencast", 300)) }
+        self.loop = asyncio.new_event_loop()
+        self.semaphores = None
+        self.zoom_session = None
+        self.opencast_session = None
+        self.primed = False
+        self.active = { name: 0 for name in AsyncEngine.STEPS }
+        self.waiting = { name: 0 for name in AsyncEngine.STEPS }
+        ready = threading.Event()
+        threading.Thread(target=self._run_loop, args=(ready,), name="ingest-loop", daemon=True).start()
+        ready.wait()
+        self.logger.info(f"Async engine started with up to { self.in_flight } recordings in flight, step limits { self.limits }")
+
+    @staticmethod
+    def _timeout(config, group, default_read_timeout):
+        #The same settings as transport.create_session's
+        return aiohttp.ClientTimeout(
+            sock_connect=float(get_config_default(config, group, "connect_timeout", 10)),
+            sock_read=float(get_config_default(config, group, "read_timeout", default_read_timeout)))
+
+    def _run_loop(self, ready):
+        asyncio.set_event_loop(self.loop)
+        #Semaphores and sessions belong to the loop they are created on
+        self.loop.run_until_complete(self._open())
+        self.loop.call_soon(ready.set)
+        self.loop.run_forever()
+
+    async def _open(self):
+        self.semaphores = { name: asyncio.Semaphore(limit) for name, limit in self.limits.items() }
+        #The semaphores already limit how many requests are made at once
+        self.zoom_session = aiohttp.ClientSession(timeout=self.timeouts["Zoom"], connector=aiohttp.TCPConnector(limit=0))
+        self.opencast_session = aiohttp.ClientSession(
+            timeout=self.timeouts["Opencast"], connector=aiohttp.TCPConnector(limit=0), headers=self.opencast.HEADERS,
+            middlewares=(aiohttp.DigestAuthMiddleware(self.opencast.user, self.opencast.password),))
+
+    async def _run_db(self, fn, *args, **kwargs):
+        return await self.loop.run_in_executor(self.db_executor, functools.partial(fn, *args, **kwargs))
+
+    async def _run_blocking(self, fn, *args):
+        return await self.loop.run_in_executor(self.executor, fn, *args)
+
+    @asynccontextmanager
+    async def _step(self, name):
+        self.waiting[name] += 1
+        async with self.semaphores[name]:
+            self.waiting[name] -= 1
+            self.active[name] += 1
+            try:
+                yield
+            finally:
+                self.active[name] -= 1
+
+    async def process(self, job):
+        """
+        Ingest job.  Any exception is raised to the caller.
+        """
+        await self._run_db(self.opencast._mark_in_progress, job)
+        async with self._step('metadata'):
+            await self._run_blocking(self.opencast._fetch_files, job)
+        async with self._step('download'):
+            await self._download_media(job)
+        async with self._step('build'):
+            await self._build_mediapackage(job)
+        async with self._step('upload'):
+            await self._upload_track(job)
+        async with self._step('trigger'):
+            await self._trigger_workflow(job)
+        #Removing files and updating the database are cheap, and must not wait behind other ingests' steps
+        await self._run_db(self.opencast._clean_up, job)
+        await self._run_db(self.opencast._update_ingest, job)
+
+    async def _download_media(self, job):
+        oc = self.opencast
+        os.makedirs(oc.IN_PROGRESS_ROOT, exist_ok=True)
+        #Files which are already in Opencast don't need downloading again
+        if not oc._completed(job, 'catalogs', 'ingest'):
+            try:
+                job.chat = await self._fetch_checkpointed(job, 'chat', ['chat_file'], {'chat_file': 'TXT'})
+            except NoMp4Files:
+                pass
+        #Direct tracks are dealt with by the upload step
+        if not job.direct and not oc._completed(job, 'track', 'ingest'):
+            job.track = await self._fetch_checkpointed(job, 'track', job.preferences)
+
+    async def _fetch_checkpointed(self, job, key, preferences, extension_overrides={}):
+        oc = self.opencast
+        path = oc._reusable(job, key)
+        if path:
+            return path
+        recording_file = oc._select_file(job.uuid, job.files, preferences)
+        path = f"{ oc.IN_PROGRESS_ROOT }/{ oc._file_name(recording_file, extension_overrides) }"
+        await self.download(oc._download_url(recording_file), path, recording_file['file_size'])
+        await self._run_db(oc._checkpoint, job, **{ key: {'path': path, 'size': os.path.getsize(path)} })
+        return path
+
+    async def download(self, url, output, expected_size):
+        """
+        Download url to output, by way of output.part.  A .part left by an earlier attempt is resumed with a Range
+        request, unless it belongs to a segmented download of the threaded uploader (which leaves a journal).
+        """
+        expected_size = int(expected_size) if expected_size else 0
+        if os.path.isfile(output) and expected_size == os.path.getsize(output):
+            self.logger.debug(f"{ output } already exists and is the right size")
+            return
+        part = f"{ output }.part"
+        offset = 0
+        if os.path.isfile(part) and not os.path.exists(f"{ output }.journal"):
+            offset = os.path.getsize(part)
+        headers = {'Range': f"bytes={ offset }-"} if offset else {}
+        self.logger.debug(f"Downloading { redact_tokens(url) } to { output } from byte { offset }")
+        async with self.zoom_session.get(url, headers=headers) as response:
+            response.raise_for_status()
+            if offset and 206 != response.status:
+                self.logger.debug(f"Range requests are not supported for { output }, starting again")
+                offset = 0
+            with open(part, 'ab' if offset else 'wb') as fd:
+                async for chunk in response.content.iter_chunked(AsyncEngine.CHUNK_SIZE):
+                    fd.write(chunk)
+        if expected_size and expected_size != os.path.getsize(part):
+            self.logger.warning(f"{ output } has { os.path.getsize(part) } bytes, expected { expected_size }")
+        os.replace(part, output)
+
+    async def _request(self, method, url, data=None, files=None):
+        """
+        Make a request to Opencast.  With files the body is multipart, streamed from the open files.
+
+        :param files: Field name to (filename, file-like object or string, content type)
+        :return: The response body, once the status has been checked
+        """
+        form = aiohttp.FormData()
+        for name, value in (data or {}).items():
+            form.add_field(name, value)
+        for name, (filename, value, content_type) in (files or {}).items():
+            form.add_field(name, value, filename=filename, content_type=content_type)
+        self.logger.debug(f"{ method }ing { redact_tokens(data) } to { redact_tokens(url) }")
+        async with self.opencast_session.request(method, url, data=form if data or files else None) as response:
+            response.raise_for_status()
+            return await response.text()
+
+    async def _prime_auth(self):
+        """
+        Get a digest challenge before sending a large body, which would otherwise be sent, rejected, and sent again
+        """
+        if self.primed:
+            return
+        try:
+            await self._request('GET', f'{ self.opencast.url }/info/me.json')
+            self.primed = True
+        except Exception as e:
+            self.logger.warning(f"Unable to prime digest authentication: { e }")
+
+    async def _build_mediapackage(self, job):
+        oc = self.opencast
+        #Rendering the catalogs may refresh the ACLs, which is a blocking call
+        if not await self._run_blocking(oc._prepare_mediapackage, job):
+            return
+        self.logger.info(f"{ job.uuid }: Creating mediapackage")
+        mp = await self._request('GET', f'{ oc.url }/ingest/createMediaPackage')
+        oc._check_valid_mediapackage(mp)
+        mp = await self._request('POST', f'{ oc.url }/ingest/addDCCatalog', {'flavor': 'dublincore/episode', 'mediaPackage': mp, 'dublinCore': job.ep_dc})
+        oc._check_valid_mediapackage(mp)
+        if job.eth_dc:
+            mp = await self._request('POST', f'{ oc.url }/ingest/addDCCatalog', {'flavor': 'ethterms/episode', 'mediaPackage': mp, 'dublinCore': job.eth_dc})
+            oc._check_valid_mediapackage(mp)
+        if job.ep_acl:
+            mp = await self._request('POST', f'{ oc.url }/ingest/addAttachment', {'flavor': 'security/xacml+episode', 'mediaPackage': mp}, {"BODY": ("xacml.xml", job.ep_acl, "text/xml")})
+            oc._check_valid_mediapackage(mp)
+        if job.chat:
+            name = os.path.basename(job.chat)
+            with open(job.chat, 'rb') as cobj:
+                mp = await self._request('POST', f'{ oc.url }/ingest/addAttachment', {'flavor': 'chat/transcript', 'mediaPackage': mp, 'fileName': name}, {"BODY": (name, cobj, "text/plain")})
+            oc._check_valid_mediapackage(mp)
+        job.mediapackage = mp
+        await self._run_db(oc._checkpoint, job, 'catalogs', mediapackage=job.mediapackage)
+
+    async def _upload_track(self, job):
+        oc = self.opencast
+        if oc._completed(job, 'track', 'ingest'):
+            self.logger.info(f"{ job.uuid }: Track was added to Opencast by an earlier attempt, skipping upload")
+            return
+        if job.direct and 'stream' == oc.track_mode:
+            return await self._run_blocking(oc._upload_track, job)
+        if job.direct:
+            job.track = oc.link_file(job.uuid, job.files, job.preferences)
+        try:
+            await self._add_track(job)
+        except Exception:
+            if job.direct:
+                #As in Opencast._upload_track, Opencast may have the request already, so it isn't sent again now
+                self.logger.error(f"{ job.uuid }: Ingest in { oc.track_mode } mode failed, the next attempt will upload via { oc.IN_PROGRESS_ROOT }")
+            raise
+
+    async def _add_track(self, job):
+        oc = self.opencast
+        if job.direct:
+            self.logger.info(f"{ job.uuid }: Ingesting { job.track.name } to { oc.url } by reference")
+            await self._send_track(job, job.track.name, {'url': job.track.url} if not job.single_request else {'mediaUri': job.track.url})
+        else:
+            track_name = os.path.basename(job.track)
+            self.logger.info(f"{ job.uuid }: Uploading { track_name } to { oc.url }")
+            await self._prime_auth()
+            with open(job.track, 'rb') as fobj:
+                await self._send_track(job, track_name, {'fileName': track_name} if not job.single_request else {}, { "BODY": (track_name, fobj, "video/mp4") })
+        if job.single_request:
+            await self._run_db(oc._checkpoint, job, 'ingest', workflow=job.workflow)
+        else:
+            await self._run_db(oc._checkpoint, job, 'track', mediapackage=job.mediapackage)
+
+    async def _send_track(self, job, track_name, track_fields, files=None):
+        oc = self.opencast
+        if job.single_request:
+            #This creates the mediapackage and starts the workflow too
+            data = dict(oc._mediapackage_fields(job.uuid, job.ep_dc, job.ep_acl), **track_fields)
+            job.workflow = oc._check_workflow_xml(await self._request('POST', f'{ oc.url }/ingest/addMediaPackage/{ job.workflow_id }', data, files))
+        else:
+            data = dict({'flavor': 'presentation/source', 'mediaPackage': job.mediapackage}, **track_fields)
+            job.mediapackage = await self._request('POST', f'{ oc.url }/ingest/addTrack', data, files)
+            oc._check_valid_mediapackage(job.mediapackage)
+
+    async def _trigger_workflow(self, job):
+        oc = self.opencast
+        if not job.workflow and oc._completed(job, 'ingest'):
+            self.logger.info(f"{ job.uuid  }: Already ingested by an earlier attempt")
+            job.workflow = job.checkpoint['workflow']
+        if not job.workflow:
+            self.logger.info(f"{ job.uuid  }: Triggering processing")
+            workflow = await self._request('POST', f'{ oc.url }/ingest/ingest/{ job.workflow_id }', {'mediaPackage': job.mediapackage})
+            job.workflow = oc._check_workflow_xml(workflow)
+            await self._run_db(oc._checkpoint, job, 'ingest', workflow=job.workflow)
+        oc._read_workflow(job)
+
+    async def rabbit_callback(self, method, properties, body):
+        ingest = await self._run_db(self.opencast._find_ingest, body)
+        if not ingest or not await self._run_db(self.opencast._claim, ingest):
+            return
+        job = self.opencast._create_job(ingest)
+        try:
+            await self.process(job)
+        except Exception as e:
+            await self._run_db(self.opencast._fail, ingest, e, json.loads(body))
+        finally:
+            await self._run_db(self.opencast._release, ingest)
+
+    def process_threadsafe(self, job):
+        """
+        Ingest job from a thread other than the engine's, blocking until it is done.
+        """
+        return asyncio.run_coroutine_threadsafe(self.process(job), self.loop).result()
+
+    def stats(self):
+        return { name: {'limit': self.limits[name], 'busy': self.active[name], 'queued': self.waiting[name]} for name in AsyncEngine.STEPS }
@@ -0,0 +1,103 @@
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from zingest import db
+from zingest.common import get_config_default
+from zingest.wakeup import Wakeup
+
+
+class WebhookEventWorker:
+    """
+    Processes the webhook events stored by db.create_webhook_event, so that the webhook itself only has to
+    validate and store each event before responding to Zoom.  Everything which needs Zoom's API happens here,
+    where a slow or failing request costs a retry rather than a timed out webhook (which Zoom then resends).
+
+    Failed events are retried with exponential backoff, and kept in the database once they run out of attempts.
+    """
+
+    SECTION = "Webhook"
+
+    def __init__(self, config, handler):
+        """
+        :param handler: Called with the body of each event, raising an exception if it should be retried
+        """
+        self.logger = logging.getLogger(__name__)
+        self.handler = handler
+        self.workers = int(get_config_default(config, WebhookEventWorker.SECTION, "event_workers", 1))
+        self.batch_size = int(get_config_default(config, WebhookEventWorker.SECTION, "event_batch_size", 10))
+        self.interval = float(get_config_default(config, WebhookEventWorker.SECTION, "event_interval", 5))
+        self.retry_seconds = int(get_config_default(config, WebhookEventWorker.SECTION, "event_retry_seconds", 60))
+        self.max_attempts = int(get_config_default(config, WebhookEventWorker.SECTION, "event_max_attempts", 5))
+        self.lease = timedelta(seconds=int(get_config_default(config, WebhookEventWorker.SECTION, "event_lease_seconds", 600)))
+        if self.workers < 1 or self.batch_size < 1:
+            raise ValueError(f"event_workers and event_batch_size must be at least 1, not { self.workers } and { self.batch_size }")
+        #Set by the gunicorn workers storing events, while the worker threads run in the master
+        self.pending = Wakeup()
+        self.stopped = threading.Event()
+        self.threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.run, name=f"webhook-event-{ i }", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stopped.set()
+        self.pending.set()
+        for thread in self.threads:
+            thread.join()
+
+    def wake(self):
+        """
+        Let the workers know there is a new event, rather than waiting for their next poll.  Works from any
+        process forked after this was created, as well as from this one.
+        """
+        self.pending.set()
+
+    def process(self):
+        """
+        Process every event which is currently due.
+
+        :return: The number of events processed, successfully or not
+        """
+        total = 0
+        while not self.stopped.is_set():
+            events = db.claim_webhook_events(self.lease, self.batch_size)
+            for event in events:
+                self._process_event(event)
+            total += len(events)
+            if len(events) < self.batch_size:
+                break
+        return total
+
+    def _process_event(self, event):
+        try:
+            self.handler(event.get_body())
+            db.complete_webhook_event(event.event_id)
+        except Exception as e:
+            attempts = event.attempts + 1
+            if attempts >= self.max_attempts:
+                self.logger.exception(f"Webhook event { event.event_id } ({ event.event_type }) failed { attempts } times, giving up")
+                db.fail_webhook_event(event.event_id, attempts, e)
+            else:
+                delay = self.retry_seconds * 2 ** (attempts - 1)
+                self.logger.exception(f"Webhook event { event.event_id } ({ event.event_type }) failed, retrying in { delay } seconds")
+                db.fail_webhook_event(event.event_id, attempts, e, datetime.utcnow() + timedelta(seconds=delay))
+
+    def run(self):
+        self.logger.info(f"Processing stored webhook events")
+        while not self.stopped.is_set():
+            #Cleared first, so an event stored while we process still gets picked up on the next pass
+            self.pending.clear()
+            try:
+                processed = self.process()
+                if processed > 0:
+                    self.logger.debug(f"Processed { processed } webhook events")
+            except Exception:
+                #Most likely the database itself, so there's no point hurrying back
+                self.logger.exception(f"Unable to process webhook events, retrying in { self.interval } seconds")
+                self.stopped.wait(self.interval)
+                continue
+            self.pending.wait(self.interval)
@@ -0,0 +1,64 @@
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+
+class OccupancyPublisher:
+    """
+    Writes the uploader's occupancy to a file every few seconds.  gunicorn --preload imports the uploader once in
+    its master, so the ingests only run there, while /count is answered by the workers, which each have an idle
+    copy of the uploader.  They read the file instead.
+    """
+
+    def __init__(self, path, get_occupancy, interval=5):
+        """
+        :param path: The file to write
+        :param get_occupancy: Called for the occupancy to publish, which must be JSON serialisable
+        :param interval: Seconds between writes
+        """
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.get_occupancy = get_occupancy
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="occupancy-publisher", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+    def publish(self):
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        #Written aside and renamed, so readers never see half a file
+        partial = f"{ self.path }.{ os.getpid() }"
+        with open(partial, 'w') as f:
+            json.dump({'stages': self.get_occupancy(), 'updated': time.time()}, f)
+        os.replace(partial, self.path)
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.publish()
+            except Exception:
+                self.logger.exception(f"Unable to publish uploader occupancy to { self.path }")
+            self.stopped.wait(self.interval)
+
+    @staticmethod
+    def read(path):
+        """
+        :return: The last published occupancy, with how many seconds ago it was published, or None if there is none
+        """
+        try:
+            with open(path) as f:
+                published = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return published['stages'], time.time() - published['updated']
@@ -3,28 +3,129 @@ import logging
 import os
 import os.path
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from datetime import datetime, timedelta
 from math import floor
 from pathlib import Path
 from urllib.error import HTTPError
 import re
+import socket
+import threading
 from xml.parsers.expat import ExpatError
-import requests
 import xmltodict
 from requests.auth import HTTPDigestAuth
 from requests_toolbelt.multipart.encoder import MultipartEncoder, MultipartEncoderMonitor
 from requests_toolbelt.exceptions import StreamingError
-from requests_toolbelt.downloadutils import stream
 
 import zingest
 from zingest import db
-from zingest.common import NoMp4Files, BadWebhookData, get_config, get_config_ignore
+from zingest.common import NoMp4Files, BadWebhookData, RecordingNotFound, get_config, get_config_ignore, get_config_default
+from zingest.download import Downloader, StreamingTrack
+from zingest.pipeline import Pipeline, Stage
+from zingest.queues import QueueBackend
+from zingest.transport import create_session
 
 
 class OpencastException(Exception):
     pass
 
 
+class PrimedDigestAuth(HTTPDigestAuth):
+    """
+    HTTPDigestAuth which tracks when this thread last received a nonce from the server.  requests reuses the
+    nonce (with an incrementing nonce count) for every later request, so as long as it is still fresh the
+    request is authenticated up front rather than sent, rejected with a 401, and sent again.
+    """
+
+    def __init__(self, username, password, nonce_lifetime):
+        super().__init__(username, password)
+        self.nonce_lifetime = nonce_lifetime
+
+    def init_per_thread_state(self):
+        super().init_per_thread_state()
+        if not hasattr(self._thread_local, 'nonce_received'):
+            self._thread_local.nonce_received = None
+
+    def build_digest_header(self, method, url):
+        if self._thread_local.chal.get('nonce') != self._thread_local.last_nonce:
+            self._thread_local.nonce_received = time.monotonic()
+        return super().build_digest_header(method, url)
+
+    def is_primed(self):
+        self.init_per_thread_state()
+        received = self._thread_local.nonce_received
+        return bool(self._thread_local.last_nonce) and received is not None and time.monotonic() - received < self.nonce_lifetime
+
+
+#Zoom download urls carry a JWT which grants access to every recording on the account, so it must never be logged
+ACCESS_TOKEN = re.compile(r"""access_token=[^&\s'"]+""")
+
+
+def redact_tokens(value):
+    return ACCESS_TOKEN.sub('access_token=REDACTED', str(value))
+
+
+class RedactTokens(logging.Filter):
+    """
+    Redacts Zoom access tokens from the tracebacks in log records, eg an HTTPError quotes the url it failed on
+    """
+
+    def filter(self, record):
+        if record.exc_info and not record.exc_text:
+            record.exc_text = redact_tokens(logging.Formatter().formatException(record.exc_info))
+        return True
+
+
+REDACT_TOKENS = RedactTokens()
+
+
+class TrackUrl:
+    """A track which Opencast fetches from the given url itself, rather than one we upload"""
+
+    def __init__(self, url, name):
+        self.url = url
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+
+class IngestJob:
+    """
+    The state of a single ingest as it moves through the stages of the uploader
+    """
+
+    def __init__(self, uuid, params, ingest=None, retry=False):
+        self.uuid = uuid
+        self.params = params
+        self.ingest = ingest
+        #Anything other than a fresh ingest has been attempted before
+        self.retry = retry
+        self.files = None
+        self.preferences = None
+        self.status = db.Status.FINISHED
+        #Whether the track bypasses the spool directory
+        self.direct = False
+        self.chat = None
+        #A path, a file-like object, or a TrackUrl
+        self.track = None
+        self.workflow_id = None
+        self.ep_dc = None
+        self.eth_dc = None
+        self.ep_acl = None
+        self.single_request = False
+        #The mediapackage XML as it is built up step by step
+        self.mediapackage = None
+        #Opencast's response to the ingest, the workflow instance XML
+        self.workflow = None
+        self.mp_id = None
+        self.workflow_instance_id = None
+        #What earlier attempts got done: the files they downloaded, the mediapackage as they left it, and
+        #which of the steps in Opencast.CHECKPOINT_STEPS they completed
+        self.checkpoint = ingest.get_checkpoint() if ingest else {}
+
+
 class Opencast:
 
     IN_PROGRESS_ROOT = "in-progress"
@@ -49,9 +150,27 @@ class Opencast:
     RECORDING_TYPE_PREFERENCE = [ 'shared_screen_with_speaker_view', 'shared_screen_with_speaker_view(CC)', 'shared_screen' ,'active_speaker' ]
     #If none of the above match, see if these do
     FALLBACK_RECORDING_TYPE_PREFERENCE = [ 'shared_screen_with_gallery_view', 'gallery_view', 'speaker_view', 'audio_only' ]
+    #How the recording's video track gets to Opencast
+    # spool: Download to IN_PROGRESS_ROOT, then upload
+    # stream: Pipe the download straight into the upload, falling back to spool on retry
+    # url: Have Opencast fetch the file from Zoom using a tokenized url, falling back to spool on retry
+    TRACK_MODES = [ 'spool', 'stream', 'url' ]
+    #How the mediapackage is assembled in Opencast
+    # steps: createMediaPackage, then one request per catalog, attachment and track, then ingest
+    # mediapackage: A single addMediaPackage request, unless there are elements it cannot carry
+    INGEST_MODES = [ 'steps', 'mediapackage' ]
+    #What drives concurrent ingests
+    # threads: A worker thread per recording, or per pipeline stage if the pipeline is enabled
+    # asyncio: Coroutines on an event loop, with a semaphore per step
+    ENGINES = [ 'threads', 'asyncio' ]
+    #The Opencast side of an ingest, as recorded in a job's checkpoint
+    # catalogs: The mediapackage has been created, with its catalogs and attachments
+    # track: The track has been added to the mediapackage
+    # ingest: The mediapackage has been ingested, and its workflow started
+    CHECKPOINT_STEPS = [ 'catalogs', 'track', 'ingest' ]
 
     def __init__(self, config, rabbit, zoom):
-        if not rabbit or type(rabbit) != zingest.rabbit.Rabbit:
+        if not rabbit or not isinstance(rabbit, QueueBackend):
             raise TypeError("Rabbit is missing or the wrong type!")
         if not zoom or type(zoom) != zingest.zoom.Zoom:
             raise TypeError("Zoom is missing or the wrong type!")
@@ -64,6 +183,7 @@ class Opencast:
             pass
 
         self.logger = logging.getLogger(__name__)
+        self.logger.addFilter(REDACT_TOKENS)
         self.url = get_config(config, "Opencast", "Url")
         self.logger.debug(f"Opencast url is {self.url}")
         self.user = get_config(config, "Opencast", "User")
@@ -83,9 +203,63 @@ class Opencast:
             self.logger.warning(f"Using default filter config: \"{ filter_config }\" because user provided config is blank!")
         self.series_filter = re.compile(filter_config)
         self.logger.debug(f"Workflow filter configured as { self.workflow_filter }")
-        self.auth = HTTPDigestAuth(self.user, self.password)
+        #Opencast's digest nonces are valid for 300 seconds by default, stay a little under that
+        nonce_lifetime = int(get_config_default(config, "Opencast", "digest_nonce_lifetime", 240))
+        self.auth = PrimedDigestAuth(self.user, self.password, nonce_lifetime)
+        self.session = create_session(config, "Opencast")
+        #Recordings are downloaded over the Zoom client's connections
+        self.downloader = Downloader(config, zoom.session)
+        self.track_mode = get_config_default(config, "Uploader", "track_mode", "spool").lower()
+        if self.track_mode not in Opencast.TRACK_MODES:
+            raise ValueError(f"Unknown track mode { self.track_mode }, expected one of { Opencast.TRACK_MODES }")
+        self.logger.debug(f"Track mode is { self.track_mode }")
+        self.ingest_mode = get_config_default(config, "Uploader", "ingest_mode", "steps").lower()
+        if self.ingest_mode not in Opencast.INGEST_MODES:
+            raise ValueError(f"Unknown ingest mode { self.ingest_mode }, expected one of { Opencast.INGEST_MODES }")
+        self.logger.debug(f"Ingest mode is { self.ingest_mode }")
+        self.stream_buffer = int(get_config_default(config, "Uploader", "stream_buffer_mb", 16)) * 1024 * 1024
+        #Opencast may queue the fetch for a while, so the token needs to outlive that as well as the transfer itself
+        self.url_token_lifetime = timedelta(minutes=int(get_config_default(config, "Uploader", "url_token_lifetime", 240)))
+        #Identifies this uploader when claiming ingests, so that several uploaders can share the database
+        self.node_id = get_config_default(config, "Uploader", "node_id", f"{ socket.gethostname() }-{ os.getpid() }")
+        #How long a claim holds before other uploaders may assume we died and take the ingest over
+        self.lease = timedelta(minutes=int(get_config_default(config, "Uploader", "lease_minutes", 360)))
+        self.logger.debug(f"Claiming ingests as { self.node_id } for { self.lease }")
+        #How often we tell the database we're still working on our ingests, and how long before others give up on us
+        self.heartbeat_interval = int(get_config_default(config, "Uploader", "heartbeat_seconds", 60))
+        self.heartbeat_timeout = timedelta(seconds=int(get_config_default(config, "Uploader", "heartbeat_timeout_seconds", 600)))
+        if self.heartbeat_timeout.total_seconds() <= self.heartbeat_interval:
+            raise ValueError("Uploader heartbeat_timeout_seconds must be longer than heartbeat_seconds")
+        self.heartbeat_ingests = set()
+        #Failed ingests are retried after retry_base_seconds, doubling each time up to retry_max_seconds
+        self.max_attempts = int(get_config_default(config, "Uploader", "max_attempts", 10))
+        self.retry_base = int(get_config_default(config, "Uploader", "retry_base_seconds", 300))
+        self.retry_max = int(get_config_default(config, "Uploader", "retry_max_seconds", 86400))
+        self.backlog_interval = int(get_config_default(config, "Uploader", "backlog_interval", 60))
+        #With retries scheduled in rabbit, the database only needs scanning for crashed uploaders, unless asked to
+        default_polling = "false" if rabbit.retry_delays else "true"
+        self.backlog_polling = get_config_default(config, "Uploader", "backlog_polling", default_polling).lower() == "true"
+        #Even without polling, a failed ingest this far past due is assumed to have lost its rabbit retry, and is picked up
+        self.overdue = timedelta(minutes=int(get_config_default(config, "Uploader", "overdue_minutes", 60)))
+        self.heartbeat_lock = threading.Lock()
+        self.heartbeat_thread = None
+        #Number of recordings ingested in parallel
+        self.workers = int(get_config_default(config, "Uploader", "workers", 1))
+        if self.workers < 1:
+            raise ValueError(f"Uploader workers must be at least 1, not { self.workers }")
         self.rabbit = rabbit
         self.zoom = zoom
+        self.pipeline = None
+        self.engine = None
+        engine = get_config_default(config, "Uploader", "engine", "threads").lower()
+        if engine not in Opencast.ENGINES:
+            raise ValueError(f"Unknown engine { engine }, expected one of { Opencast.ENGINES }")
+        if 'asyncio' == engine:
+            #Only imported when needed, it depends on aiohttp
+            from zingest.engine import AsyncEngine
+            self.engine = AsyncEngine(config, self)
+        elif get_config_default(config, "Uploader", "pipeline", "false").lower() == "true":
+            self.pipeline = self._create_pipeline(config)
         self.acls_updated = None
         self.acls = None
         self.themes_updated = None
@@ -101,11 +275,50 @@ class Opencast:
         self.get_series()
         self.logger.info("Setup complete")
 
+    def _create_pipeline(self, config):
+        stages = []
+        for name, handler in self._stages():
+            #Each stage defaults to the overall worker count, so only the bottlenecks need to be configured
+            workers = int(get_config_default(config, "Uploader", f"{ name }_workers", self.workers))
+            capacity = int(get_config_default(config, "Uploader", "stage_queue_size", workers))
+            stages.append(Stage(name, handler, workers, capacity))
+        return Pipeline(stages)
+
+    def _stages(self):
+        return [
+            ('metadata', self._fetch_metadata),
+            ('download', self._download_media),
+            ('build', self._build_mediapackage),
+            ('upload', self._upload_track),
+            ('trigger', self._complete_ingest),
+        ]
+
+    def get_occupancy(self):
+        """:return: Per stage worker and queue counts if the pipeline or async engine is enabled, otherwise None"""
+        if self.engine:
+            return self.engine.stats()
+        return self.pipeline.stats() if self.pipeline else None
+
     def run(self):
+        if self.engine:
+            return self._run_engine()
+        #Enough consumers to keep every stage of the pipeline busy
+        in_flight = self.pipeline.capacity() if self.pipeline else self.workers
+        #The pool outlives reconnects so that ingests which are still running keep their worker
+        executor = ThreadPoolExecutor(max_workers=in_flight, thread_name_prefix="ingest")
+        while True:
+            try:
+                self.logger.info(f"Consuming rabbits with up to { in_flight } recording(s) in flight")
+                self.rabbit.start_consuming_rabbitmsg(self.rabbit_callback, executor=executor, prefetch_count=in_flight)
+            except Exception as e:
+                self.logger.exception("Error connecting to rabbit!  Retry in 10 seconds...")
+                time.sleep(10)
+
+    def _run_engine(self):
         while True:
             try:
-                self.logger.info("Consuming rabbits")
-                self.rabbit.start_consuming_rabbitmsg(self.rabbit_callback)
+                self.logger.info(f"Consuming rabbits with up to { self.engine.in_flight } recording(s) in flight")
+                self.rabbit.start_consuming_rabbitmsg(self.engine.rabbit_callback, prefetch_count=self.engine.in_flight, loop=self.engine.loop)
             except Exception as e:
                 self.logger.exception("Error connecting to rabbit!  Retry in 10 seconds...")
                 time.sleep(10)
@@ -118,27 +331,63 @@ class Opencast:
                 self.logger.exception("Catchall while processing the backlog. Please report this as a bug.")
                 time.sleep(10)
 
-    @db.with_session
-    def _process_backlog(dbs, self):
+    def _process_backlog(self):
+        self._reap_stale_ingests()
+        if not self.backlog_polling:
+            #Retries are queued in rabbit, so only those whose message never made it there are left to us
+            self._claim_due(None, datetime.utcnow() - self.overdue)
+            #An ingest can't go stale any quicker than this
+            time.sleep(self.heartbeat_timeout.total_seconds())
+            return
         self.logger.info("Checking backlog")
-        hour_ago = datetime.utcnow() - timedelta(hours=1)
-        ing_list = dbs.query(db.Ingest).filter(db.Ingest.status != db.Status.FINISHED, db.Ingest.status != db.Status.WARNING, db.Ingest.status != db.Status.IN_PROGRESS, db.Ingest.timestamp <= hour_ago).all()
-        for ing in ing_list:
-            self._process(ing)
-        time.sleep(60)
+        self._claim_due(datetime.utcnow() - timedelta(hours=1))
+        #Wake up early if a retry is due before the next regular check
+        wait = self.backlog_interval
+        due = db.next_attempt_due()
+        if due:
+            wait = max(1, min(wait, (due - datetime.utcnow()).total_seconds()))
+        time.sleep(wait)
+
+    def _claim_due(self, older_than, due_before=None):
+        """
+        Claim and process the ingests which are due, see db.claim_backlog
+        """
+        #Claim one at a time so that other uploaders can share the backlog, and so that claims don't expire while waiting.
+        #Each ingest is only attempted once per pass, so one which keeps failing without being rescheduled can't hog it
+        attempted = set()
+        while True:
+            ing_list = db.claim_backlog(self.node_id, self.lease, older_than, exclude=attempted, due_before=due_before)
+            if len(ing_list) == 0:
+                break
+            for ing in ing_list:
+                attempted.add(ing.get_id())
+                self._process(ing, claimed=True)
 
-    def _do_download(self, url, output, expected_size):
+    def _do_download(self, url, output, expected_size, identity=None):
         Path(f"{ self.IN_PROGRESS_ROOT }").mkdir(parents=True, exist_ok=True)
         if os.path.isfile(output) and expected_size == os.path.getsize(output):
           self.logger.debug(f"{ output } already exists and is the right size")
           return
-        with open(output, 'wb') as fd:
-            r = requests.get(url, stream=True)
-            stream.stream_response_to_file(r, path=fd, chunksize=8192)
+        #Partial downloads are kept next to output, along with a journal which allows them to be resumed
+        self.downloader.download(url, output, expected_size, identity)
 
     def _do_get(self, url):
-        self.logger.debug(f"GETting { url }")
-        return requests.get(url, auth=self.auth, headers=Opencast.HEADERS)
+        self.logger.debug(f"GETting { redact_tokens(url) }")
+        return self.session.get(url, auth=self.auth, headers=Opencast.HEADERS)
+
+    def _prime_auth(self):
+        """
+        Make sure this thread holds a fresh digest nonce before sending a large body.  Without one the body
+        would be sent, rejected with a 401, and then sent again in full.  Streamed bodies can't be rewound at all.
+        """
+        if self.auth.is_primed():
+            return
+        self.logger.debug("Priming digest authentication")
+        try:
+            self._do_get(f'{ self.url }/info/me.json')
+        except Exception as e:
+            #Not fatal, the upload will just authenticate the slow way
+            self.logger.warning(f"Unable to prime digest authentication: { e }")
 
     def create_callback(self, encoder):
         last = 0
@@ -154,7 +403,7 @@ class Opencast:
         return callback
 
     def _do_post(self, url, data, files=None):
-        self.logger.debug(f"POSTing { data } to { url }")
+        self.logger.debug(f"POSTing { redact_tokens(data) } to { redact_tokens(url) }")
         #Take the data params (form params)
         fields = data
         #Add the files
@@ -169,14 +418,24 @@ class Opencast:
         headers = {}
         headers.update(Opencast.HEADERS)
         headers['Content-Type'] = m.content_type
-        return requests.post(url, auth=self.auth, headers=headers, data=m)
+        return self.session.post(url, auth=self.auth, headers=headers, data=m)
+
+    def _do_post_form(self, url, data):
+        #Some endpoints (eg, addTrack by url) are only available as application/x-www-form-urlencoded
+        self.logger.debug(f"POSTing form { redact_tokens(data) } to { redact_tokens(url) }")
+        return self.session.post(url, auth=self.auth, headers=Opencast.HEADERS, data=data)
 
     def _do_put(self, url, data):
         self.logger.debug(f"PUTing { data } to { url }")
-        return requests.put(url, auth=self.auth, headers=Opencast.HEADERS, data=data)
+        return self.session.put(url, auth=self.auth, headers=Opencast.HEADERS, data=data)
+
+    def rabbit_callback(self, method, properties, body):
+        ingest = self._find_ingest(body)
+        if ingest:
+            self._process(ingest, msg=json.loads(body))
 
     @db.with_session
-    def rabbit_callback(dbs, self, method, properties, body):
+    def _find_ingest(dbs, self, body):
         j = json.loads(body)
         rec_id = j['uuid']
         ing_id = int(j['ingest_id'])
@@ -184,74 +443,337 @@ class Opencast:
         ingest = dbs.query(db.Ingest).filter(db.Ingest.ingest_id == ing_id).one_or_none()
         if ingest:
             self.logger.debug(f"Ingest { ing_id } found")
-            self._process(ingest)
         else:
             self.logger.warn(f"Received rabbit message for { rec_id } with an invalid ingest id of { ing_id }.")
+        return ingest
 
-    @db.with_session
-    def _process(dbs, self, ingest):
-        uuid = ingest.get_recording_id()
+    def _create_job(self, ingest):
         params = json.loads(ingest.get_params().decode('utf-8'))
+        return IngestJob(ingest.get_recording_id(), params, ingest, ingest.status != db.Status.NEW)
+
+    def _claim(self, ingest):
+        """
+        Take ownership of ingest, so that no other uploader processes it at the same time
+
+        :return: True if we own ingest now, False if it is owned by someone else
+        """
+        expires = db.claim_ingest(ingest.get_id(), self.node_id, self.lease)
+        if not expires:
+            self.logger.info(f"{ ingest.get_recording_id() }: Ingest { ingest.get_id() } is claimed by another uploader, or already done. Skipping")
+            return False
+        #Keep our copy in sync, otherwise merging it back would clear the claim
+        ingest.owner = self.node_id
+        ingest.lease_expires = expires
+        ingest.heartbeat = datetime.utcnow()
+        self._start_heartbeat(ingest)
+        return True
+
+    def _release(self, ingest):
+        self._stop_heartbeat(ingest)
+        db.release_ingest(ingest.get_id(), self.node_id)
+
+    def _start_heartbeat(self, ingest):
+        with self.heartbeat_lock:
+            self.heartbeat_ingests.add(ingest.get_id())
+            if not self.heartbeat_thread:
+                self.heartbeat_thread = threading.Thread(target=self._heartbeat, name="heartbeat", daemon=True)
+                self.heartbeat_thread.start()
+
+    def _stop_heartbeat(self, ingest):
+        with self.heartbeat_lock:
+            self.heartbeat_ingests.discard(ingest.get_id())
+
+    def _heartbeat(self):
+        #One thread beats for every ingest this uploader holds, however many there are
+        while True:
+            time.sleep(self.heartbeat_interval)
+            with self.heartbeat_lock:
+                ingest_ids = list(self.heartbeat_ingests)
+            if len(ingest_ids) == 0:
+                continue
+            try:
+                held = db.heartbeat_ingests(ingest_ids, self.node_id, self.lease)
+                if held != len(ingest_ids):
+                    self.logger.warning(f"Only { held } of the { len(ingest_ids) } ingests in progress are still claimed by { self.node_id }")
+            except Exception as e:
+                self.logger.exception("Unable to record heartbeat")
+
+    def _reap_stale_ingests(self):
+        """
+        Requeue ingests left in progress by an uploader which has stopped sending heartbeats (ie, crashed)
+        """
+        stale_before = datetime.utcnow() - self.heartbeat_timeout
+        for ing in db.find_stale_ingests(stale_before):
+            status = db.requeue_stale_ingest(ing.get_id(), stale_before, self.max_attempts)
+            if not status:
+                #Another uploader got there first, or the owner came back to life
+                continue
+            if db.Status.DEAD_LETTER == status:
+                self.logger.error(f"{ ing.get_recording_id() }: Ingest { ing.get_id() } was abandoned by { ing.owner }, and has failed too often to requeue")
+                ing.status = status
+                if self.rabbit.retry_delays:
+                    self._queue_retry(ing, (ing.attempts or 0) + 1, None)
+                continue
+            self.logger.warning(f"{ ing.get_recording_id() }: Ingest { ing.get_id() } was abandoned by { ing.owner }, requeuing it")
+            try:
+                self.rabbit.send_rabbit_msg(ing.get_recording_id(), ing.get_id(), QueueBackend.WEBHOOK if ing.webhook_ingest else QueueBackend.MANUAL)
+            except Exception as e:
+                #Not fatal, the backlog will pick it up eventually
+                self.logger.exception(f"{ ing.get_recording_id() }: Unable to requeue ingest { ing.get_id() }")
+
+    def _process(self, ingest, claimed=False, msg=None):
+        """
+        :param claimed: True if the caller has already claimed ingest for this node
+        :param msg: The rabbit message which asked for ingest, if any
+        """
+        if not claimed and not self._claim(ingest):
+            return
+        if claimed:
+            self._start_heartbeat(ingest)
+        job = self._create_job(ingest)
+        try:
+            if self.engine:
+                self.engine.process_threadsafe(job)
+            elif self.pipeline:
+                self.pipeline.submit(job).result()
+            else:
+                for name, handler in self._stages():
+                    handler(job)
+        except Exception as e:
+            self._fail(ingest, e, msg)
+        finally:
+            self._release(ingest)
+
+    def _retry_delay(self, attempts):
+        """:return: How long to wait before the next attempt, after attempts failures"""
+        return timedelta(seconds=min(self.retry_base * 2 ** (attempts - 1), self.retry_max))
 
+    def _fail(self, ingest, e, msg=None):
+        """
+        Log why ingest failed, and schedule its next attempt, or dead letter it if it has failed too often
+
+        :param msg: The rabbit message which asked for ingest, if any.  Sent on to the retry queues if they are enabled
+        """
+        uuid = ingest.get_recording_id()
+        self._log_failure(uuid, e)
+        attempts = (ingest.attempts or 0) + 1
+        next_attempt_at = None
+        if attempts < self.max_attempts and self.rabbit.retry_delays:
+            next_attempt_at = datetime.utcnow() + timedelta(seconds=self.rabbit.retry_delay(attempts))
+        elif attempts < self.max_attempts:
+            next_attempt_at = datetime.utcnow() + self._retry_delay(attempts)
+        status = db.record_failure(ingest.get_id(), attempts, redact_tokens(f"{ type(e).__name__ }: { e }"), next_attempt_at)
+        if db.Status.DEAD_LETTER == status:
+            self.logger.error(f"{ uuid }: Ingest { ingest.get_id() } has failed { attempts } times, giving up on it")
+        else:
+            self.logger.info(f"{ uuid }: Attempt { attempts } of ingest { ingest.get_id() } failed, retrying at { next_attempt_at }")
+        #Keep our copy in sync, otherwise merging it back would undo this
+        ingest.status = status
+        ingest.attempts = attempts
+        ingest.next_attempt_at = next_attempt_at
+        if self.rabbit.retry_delays:
+            self._queue_retry(ingest, attempts, msg)
+
+    def _queue_retry(self, ingest, attempts, msg):
+        if not msg:
+            #Ingests from the backlog have no message of their own
+            msg = {'uuid': ingest.get_recording_id(), 'ingest_id': ingest.get_id(),
+                   'class': QueueBackend.WEBHOOK if ingest.webhook_ingest else QueueBackend.MANUAL}
         try:
-            rec = dbs.query(db.Recording).filter(db.Recording.uuid == uuid).one_or_none()
-            if not rec:
-                self.logger.error(f"Unable to find recording { uuid }, this is a bug.")
-                return
-            self.logger.debug(f"{ uuid }: Recording found, processing")
-
-            ingest.update_status(db.Status.IN_PROGRESS);
-            dbs.merge(ingest)
-            dbs.commit()
-
-            if not os.path.isdir(f'{self.IN_PROGRESS_ROOT}'):
-                os.mkdir(f'{self.IN_PROGRESS_ROOT}')
-
-            self.logger.info(f"{ uuid }: Fetching {uuid}")
-            files = self.zoom.get_recording_files(uuid)
-            status = db.Status.FINISHED
-            try:
-                filename = self.fetch_file(uuid, files)
-            except NoMp4Files:
-                self.logger.warn(f"{ uuid }: Does not contain any of the normal recording files, falling back to backup")
-                #If this *still* throws a NoMp4Files then we want to pass this up the chain and retry later
-                filename = self.fetch_file(uuid, files, self.FALLBACK_RECORDING_TYPE_PREFERENCE)
+            self.rabbit.retry_rabbit_msg(msg, attempts, park=db.Status.DEAD_LETTER == ingest.status)
+        except Exception:
+            self.logger.exception(f"{ ingest.get_recording_id() }: Unable to queue the retry of ingest { ingest.get_id() }, it will be picked up from the database once it is { self.overdue } overdue")
+
+    def _log_failure(self, uuid, e):
+        if isinstance(e, FileNotFoundError):
+            self.logger.error(f"Unable to ingest { uuid }, file not found")
+        elif isinstance(e, ExpatError):
+            self.logger.error(f"Opencast did not return a valid mediapackage for { uuid }")
+        elif isinstance(e, StreamingError):
+            self.logger.error(f"Error downloading media for { uuid }", exc_info=e)
+        elif isinstance(e, HTTPError):
+            self.logger.error(f"Unable to fetch file for { uuid }", exc_info=e)
+        else:
+            self.logger.error(f"General Exception processing { uuid }", exc_info=e)
+
+    def _fetch_metadata(self, job):
+        self._mark_in_progress(job)
+        self._fetch_files(job)
+
+    @db.with_session
+    def _mark_in_progress(dbs, self, job):
+        rec = dbs.query(db.Recording).filter(db.Recording.uuid == job.uuid).one_or_none()
+        if not rec:
+            #Raised rather than skipped, so the ingest is counted as failed and eventually dead lettered
+            raise RecordingNotFound(f"Unable to find recording { job.uuid }, this is a bug.")
+        self.logger.debug(f"{ job.uuid }: Recording found, processing")
+
+        job.ingest.update_status(db.Status.IN_PROGRESS);
+        dbs.merge(job.ingest)
+        dbs.commit()
+
+    def _fetch_files(self, job):
+        uuid = job.uuid
+        self.logger.info(f"{ uuid }: Fetching {uuid}")
+        job.files = self.zoom.get_recording_files(uuid)
+        job.preferences = self.RECORDING_TYPE_PREFERENCE
+        try:
+            self._select_file(uuid, job.files, job.preferences)
+        except NoMp4Files:
+            self.logger.warn(f"{ uuid }: Does not contain any of the normal recording files, falling back to backup")
+            #If this *still* throws a NoMp4Files then we want to pass this up the chain and retry later
+            job.preferences = self.FALLBACK_RECORDING_TYPE_PREFERENCE
+            self._select_file(uuid, job.files, job.preferences)
           #If we found a fallback file finish, but set the state to warning to mark that this is (potentially) broken
-                status = db.Status.WARNING
+            job.status = db.Status.WARNING
+        #Only the first attempt bypasses the spool directory
+        job.direct = 'spool' != self.track_mode and not job.retry
+
+    def _download_media(self, job):
+        uuid = job.uuid
+        if not os.path.isdir(f'{self.IN_PROGRESS_ROOT}'):
+            os.mkdir(f'{self.IN_PROGRESS_ROOT}')
 
-            chat = None
+        #Files which are already in Opencast don't need downloading again
+        if not self._completed(job, 'catalogs', 'ingest'):
             try:
                 self.logger.debug(f"{ uuid }: Checking if chat transcript exists")
-                chat = self.fetch_file(uuid, files, ['chat_file'], {'chat_file': 'TXT'})
+                job.chat = self._fetch_checkpointed(job, 'chat', ['chat_file'], {'chat_file': 'TXT'})
             except NoMp4Files:
                 #Ignore this.  If there's no file we don't care.
                 pass
-            self.logger.info(f"{ uuid }: Uploading { uuid } as { filename } to { self.url }")
-
-            mp_id, workflow_id = self.oc_upload(uuid, filename, chat, **params)
-
-            #Clean up the files
-            self._rm(filename)
-            if None != chat:
-                self._rm(chat)
-
-            ingest.update_status(status)
-            ingest.set_workflow_id(workflow_id)
-            ingest.set_mediapackage_id(mp_id)
-            dbs.merge(ingest)
-            dbs.commit()
-        except FileNotFoundError as e:
-            self.logger.error(f"Unable to ingest { uuid }, file not found, will retry later")
-        except ExpatError as e:
-            self.logger.error(f"Opencast did not return a valid mediapackage for { uuid }, will retry later")
-        except StreamingError as e:
-            self.logger.exception(f"Error downloading media for { uuid }, will retry")
-        except HTTPError as er:
-            self.logger.exception(f"Unable to fetch file for { uuid }, will retry later")
-            #We're going to retry this since it's not in FINISHED, so we don't need to do anything here.
-        except Exception as e:
-            self.logger.exception(f"General Exception processing { uuid }")
-            #We're going to retry this since it's not in FINISHED, so we don't need to do anything here.
+
+        #Direct tracks are opened by the upload stage, so that streams aren't left idle while waiting for it
+        if not job.direct and not self._completed(job, 'track', 'ingest'):
+            job.track = self._fetch_checkpointed(job, 'track', job.preferences)
+
+    def _build_mediapackage(self, job):
+        if self._prepare_mediapackage(job):
+            job.mediapackage = self._create_mediapackage(job.uuid, job.chat, job.ep_dc, job.eth_dc, job.ep_acl)
+            self._checkpoint(job, 'catalogs', mediapackage=job.mediapackage)
+
+    def _prepare_mediapackage(self, job):
+        """
+        Render job's catalogs and ACL, and decide how it is ingested
+
+        :return: True if the mediapackage still has to be created, with its catalogs and attachments
+        """
+        params = dict(job.params)
+        acl_id = params.pop('acl_id', None)
+        job.workflow_id = params.pop('workflow_id', None)
+        if not job.workflow_id:
+            self.logger.error(f"Attempting to ingest { job.uuid } with no workflow id!")
+            raise Exception("Workflow ID is missing!")
+
+        selected_acl = self.get_single_acl(acl_id) if self.get_single_acl(acl_id) is not None else []
+        job.ep_dc = self._prep_dublincore(**params)
+        job.eth_dc = self._prep_eth_dublincore(**params)
+        if selected_acl:
+            job.ep_acl = self._prep_episode_xacml(job.uuid, selected_acl)
+        else:
+            job.ep_acl = None
+
+        #addMediaPackage has no way to carry custom catalogs or attachments
+        job.single_request = 'mediapackage' == self.ingest_mode and not job.chat and not self._has_eth_fields(**params)
+        if 'mediapackage' == self.ingest_mode and not job.single_request:
+            self.logger.debug(f"{ job.uuid }: Has a chat transcript or ethterms, ingesting step by step")
+        if self._completed(job, 'catalogs'):
+            self.logger.info(f"{ job.uuid }: Resuming with the mediapackage from an earlier attempt")
+            job.mediapackage = job.checkpoint['mediapackage']
+            job.single_request = False
+            return False
+        return not job.single_request and not self._completed(job, 'ingest')
+
+    def _upload_track(self, job):
+        if self._completed(job, 'track', 'ingest'):
+            self.logger.info(f"{ job.uuid }: Track was added to Opencast by an earlier attempt, skipping upload")
+            return
+        if job.direct:
+            try:
+                if 'stream' == self.track_mode:
+                    job.track = self.stream_file(job.uuid, job.files, job.preferences)
+                else:
+                    job.track = self.link_file(job.uuid, job.files, job.preferences)
+                self.logger.info(f"{ job.uuid }: Ingesting { job.uuid } as { job.track } to { self.url } in { self.track_mode } mode")
+                self._add_track(job)
+            except Exception:
+                #Not retried via the spool here: Opencast may have received the request already, and sending it again
+                #could create a second mediapackage and workflow.  The next attempt is never direct, so it uses the spool.
+                self.logger.error(f"{ job.uuid }: Ingest in { self.track_mode } mode failed, the next attempt will upload via { self.IN_PROGRESS_ROOT }")
+                raise
+            finally:
+                if isinstance(job.track, StreamingTrack):
+                    job.track.close()
+            return
+        self.logger.info(f"{ job.uuid }: Uploading { job.uuid } as { job.track } to { self.url }")
+        self._add_track(job)
+
+    def _complete_ingest(self, job):
+        self._trigger_workflow(job)
+        self._clean_up(job)
+        self._update_ingest(job)
+
+    def _clean_up(self, job):
+        paths = [ job.chat ]
+        if not job.direct:
+            paths.append(job.track)
+        #Including any left by earlier attempts which this one didn't need
+        paths.extend(saved['path'] for saved in (job.checkpoint.get('chat'), job.checkpoint.get('track')) if saved)
+        for path in set(path for path in paths if isinstance(path, str)):
+            self._rm(path)
+
+    @db.with_session
+    def _update_ingest(dbs, self, job):
+        job.ingest.update_status(job.status)
+        job.ingest.next_attempt_at = None
+        job.ingest.set_checkpoint(None)
+        job.ingest.set_workflow_id(job.workflow_instance_id)
+        job.ingest.set_mediapackage_id(job.mp_id)
+        dbs.merge(job.ingest)
+        dbs.commit()
+
+    def _completed(self, job, *steps):
+        """:return: True if an earlier attempt at job completed any of steps"""
+        return any(step in job.checkpoint.get('completed', []) for step in steps)
+
+    def _checkpoint(self, job, step=None, **values):
+        """
+        Record progress on job, so that if this attempt fails the next one can carry on from here
+
+        :param step: The entry in CHECKPOINT_STEPS which has just completed, if any
+        :param values: Anything else to remember, which must be JSON serializable
+        """
+        job.checkpoint.update(values)
+        if step:
+            job.checkpoint['completed'] = job.checkpoint.get('completed', []) + [ step ]
+        #Ad hoc uploads have no ingest to record progress against
+        if not job.ingest:
+            return
+        if not db.save_checkpoint(job.ingest.get_id(), self.node_id, job.checkpoint):
+            self.logger.warning(f"{ job.uuid }: Unable to checkpoint ingest { job.ingest.get_id() }, it is no longer claimed by { self.node_id }")
+        #Keep our copy in sync, otherwise merging it back would undo this
+        job.ingest.set_checkpoint(job.checkpoint)
+
+    def _fetch_checkpointed(self, job, key, preferences, extension_overrides={}):
+        """
+        Like fetch_file, but reuses the file downloaded by an earlier attempt if it is still intact
+
+        :param key: Where the file is recorded in job's checkpoint
+        """
+        path = self._reusable(job, key)
+        if path:
+            return path
+        path = self.fetch_file(job.uuid, job.files, preferences, extension_overrides)
+        self._checkpoint(job, **{ key: {'path': path, 'size': os.path.getsize(path)} })
+        return path
+
+    def _reusable(self, job, key):
+        """:return: The path of the file recorded under key in job's checkpoint if it is still intact, otherwise None"""
+        saved = job.checkpoint.get(key)
+        if saved and os.path.isfile(saved['path']) and os.path.getsize(saved['path']) == saved['size']:
+            self.logger.info(f"{ job.uuid }: Reusing { saved['path'] } downloaded by an earlier attempt")
+            return saved['path']
+        return None
 
     def _rm(self, path):
         self.logger.debug(f"Removing { path }")
@@ -262,8 +784,7 @@ class Opencast:
             if os.path.isfile(path):
                 self.logger.exception(f"Exception removing { path }.  File will need to be manually removed.")
 
-    def fetch_file(self, recording_id, files, preferences=RECORDING_TYPE_PREFERENCE, extension_overrides={}):
-        dl_url = ''
+    def _select_file(self, recording_id, files, preferences=RECORDING_TYPE_PREFERENCE):
         recording_file = None
         for preference in preferences:
             self.logger.debug(f"{ recording_id  }: Checking if recording contains a file of type { preference }")
@@ -281,25 +802,53 @@ class Opencast:
         #If we've somehow cycled through all the candidates and nothing matches, fail
         if not recording_file:
             raise NoMp4Files(f"{ recording_id }: No acceptable filetype found!")
+        return recording_file
+
+    def _file_name(self, recording_file, extension_overrides={}):
+        recording_type = recording_file['recording_type']
+        extension = recording_file["file_extension"] if recording_type not in extension_overrides else extension_overrides[recording_type]
+        #NB: recording_id likely contains characters which are invalid on some filesystems
+        return f"{ recording_file['recording_id'] }.{  extension.lower() }"
 
-        recording_type = candidate['recording_type']
+    def _download_url(self, recording_file, lifetime=None):
+        #Zoom token gets calculated at download time, regardless of inclusion in the rabbit message
+        token = self.zoom.get_download_token(lifetime)
+        return f"{ recording_file['download_url'] }?access_token={ token }"
+
+    def fetch_file(self, recording_id, files, preferences=RECORDING_TYPE_PREFERENCE, extension_overrides={}):
+        recording_file = self._select_file(recording_id, files, preferences)
         dl_url = recording_file["download_url"]
         expected_size = recording_file["file_size"]
         uuid = recording_file["recording_id"]
-        extension = recording_file["file_extension"] if recording_type not in extension_overrides else extension_overrides[recording_type]
 
         #Output file lives in the in-progress directory
-        #NB: recording_id likely contains characters which are invalid on some filesystems
-        filename = f"{self.IN_PROGRESS_ROOT}/{ uuid }.{  extension.lower() }"
+        filename = f"{self.IN_PROGRESS_ROOT}/{ self._file_name(recording_file, extension_overrides) }"
 
-        #Zoom token gets calculated at download time, regardless of inclusion in the rabbit message
-        token = self.zoom.get_download_token()
-        url = f"{dl_url}?access_token={ token }"
-        self.logger.debug(f"{ recording_id  }: Downloading file id { uuid } from { url } to { filename }")
-        self._do_download(f"{ url }", filename, expected_size)
+        url = self._download_url(recording_file)
+        self.logger.debug(f"{ recording_id  }: Downloading file id { uuid } from { redact_tokens(url) } to { filename }")
+        self._do_download(f"{ url }", filename, expected_size, dl_url)
 
         return filename
 
+    def stream_file(self, recording_id, files, preferences=RECORDING_TYPE_PREFERENCE):
+        """
+        Like fetch_file, but rather than downloading the file returns a StreamingTrack which oc_upload reads
+        from while it is being downloaded.  The caller must close() the returned track.
+        """
+        recording_file = self._select_file(recording_id, files, preferences)
+        url = self._download_url(recording_file)
+        self.logger.debug(f"{ recording_id  }: Streaming file id { recording_file['recording_id'] } from { redact_tokens(url) }")
+        return StreamingTrack(url, self._file_name(recording_file), recording_file["file_size"], self.stream_buffer, self.zoom.session)
+
+    def link_file(self, recording_id, files, preferences=RECORDING_TYPE_PREFERENCE):
+        """
+        Like fetch_file, but rather than downloading the file returns a TrackUrl which Opencast fetches itself.
+        """
+        recording_file = self._select_file(recording_id, files, preferences)
+        url = self._download_url(recording_file, self.url_token_lifetime)
+        self.logger.debug(f"{ recording_id  }: Linking file id { recording_file['recording_id'] }")
+        return TrackUrl(url, self._file_name(recording_file))
+
     def _build_ingest_renderable(self, results):
         ip = []
         for result in results:
@@ -560,59 +1109,136 @@ class Opencast:
         #We throw out the results here, we're just looking for the exception if the mediapackage is invalid
         xmltodict.parse(mp)
 
-    def oc_upload(self, rec_id, filename, chat_file=None, acl_id=None, workflow_id=None, **kwargs):
-
-        if not workflow_id:
-            self.logger.error(f"Attempting to ingest { rec_id } with no workflow id!")
-            raise Exception("Workflow ID is missing!")
+    def _check_valid_workflow(self, response):
+        """
+        Make sure an ingest request actually started a workflow, before anything records that it did
 
-        selected_acl = self.get_single_acl(acl_id) if self.get_single_acl(acl_id) is not None else []
-        ep_dc = self._prep_dublincore(**kwargs)
-        eth_dc = self._prep_eth_dublincore(**kwargs)
-        if selected_acl:
-            ep_acl = self._prep_episode_xacml(rec_id, selected_acl)
-        else:
-            ep_acl = None
+        :return: The workflow xml
+        """
+        response.raise_for_status()
+        return self._check_workflow_xml(response.text)
 
-        #TODO: Make this configurable, cf pyca's setup
-        wf_config = {'publishToSearch': 'true', 'flagQuality720p':'true', 'publishToApi':'true', 'publishToEngage':'true','straightToPublishing':'true','publishToOaiPmh':'true'}
+    def _check_workflow_xml(self, workflow):
+        """:return: workflow, if it is the xml of a workflow instance"""
+        try:
+            wfdict = xmltodict.parse(workflow)
+            wfdict['wf:workflow']['@id']
+            wfdict['wf:workflow']['mp:mediapackage']['@id']
+        except (ExpatError, KeyError, TypeError) as e:
+            raise ValueError(f"Opencast did not return a workflow: { e }")
+        return workflow
 
-        with open(filename, 'rb') as fobj:
-            self.logger.info(f"{ rec_id  }: Creating mediapackage")
-            mp = self._do_get(f'{ self.url }/ingest/createMediaPackage').text
+    def oc_upload(self, rec_id, filename, chat_file=None, acl_id=None, workflow_id=None, **kwargs):
+        job = IngestJob(rec_id, dict(kwargs, acl_id=acl_id, workflow_id=workflow_id))
+        job.track = filename
+        job.chat = chat_file
+        self._build_mediapackage(job)
+        self._add_track(job)
+        self._trigger_workflow(job)
+        return job.mp_id, job.workflow_instance_id
+
+    def _add_track(self, job):
+        #job.track is either the path to a downloaded file, an already open (streaming) file-like object, or a TrackUrl
+        track_name = os.path.basename(job.track) if isinstance(job.track, str) else job.track.name
+        with open(job.track, 'rb') if isinstance(job.track, str) else nullcontext(job.track) as fobj:
+            if job.single_request:
+                #This creates the mediapackage and starts the workflow too
+                job.workflow = self._ingest_mediapackage(job.uuid, fobj, track_name, job.ep_dc, job.ep_acl, job.workflow_id)
+            else:
+                job.mediapackage = self._add_track_to_mediapackage(job.uuid, job.mediapackage, fobj, track_name)
+        if job.single_request:
+            self._checkpoint(job, 'ingest', workflow=job.workflow)
+        else:
+            self._checkpoint(job, 'track', mediapackage=job.mediapackage)
+
+    def _trigger_workflow(self, job):
+        if not job.workflow and self._completed(job, 'ingest'):
+            self.logger.info(f"{ job.uuid  }: Already ingested by an earlier attempt")
+            job.workflow = job.checkpoint['workflow']
+        if not job.workflow:
+            self.logger.info(f"{ job.uuid  }: Triggering processing")
+            response = self._do_post(f'{ self.url }/ingest/ingest/{ job.workflow_id }', data={'mediaPackage': job.mediapackage})
+            job.workflow = self._check_valid_workflow(response)
+            self._checkpoint(job, 'ingest', workflow=job.workflow)
+        self._read_workflow(job)
+
+    def _read_workflow(self, job):
+        wfdict = xmltodict.parse(job.workflow)
+        job.mp_id = wfdict['wf:workflow']['mp:mediapackage']['@id']
+        job.workflow_instance_id = wfdict['wf:workflow']['@id']
+
+        self.logger.info(f"Ingested { job.uuid } as workflow { job.workflow_instance_id } on mediapackage { job.mp_id }")
+
+    def _has_eth_fields(self, **kwargs):
+        return any(name.startswith('eth-') for name in kwargs)
+
+    def _ingest_mediapackage(self, rec_id, fobj, track_name, ep_dc, ep_acl, workflow_id):
+        """
+        Create, fill and ingest the mediapackage in a single /ingest/addMediaPackage request
+        """
+        data = self._mediapackage_fields(rec_id, ep_dc, ep_acl)
+        self.logger.info(f"{ rec_id  }: Ingesting zoom video { track_name } as a single mediapackage")
+        if isinstance(fobj, TrackUrl):
+            data['mediaUri'] = fobj.url
+            response = self._do_post(f'{ self.url }/ingest/addMediaPackage/{ workflow_id }', data=data)
+        else:
+            self._prime_auth()
+            response = self._do_post(f'{ self.url }/ingest/addMediaPackage/{ workflow_id }', data=data, files={ "BODY": (track_name, fobj, "video/mp4") })
+        return self._check_valid_workflow(response)
+
+    def _mediapackage_fields(self, rec_id, ep_dc, ep_acl):
+        """:return: The fields of an /ingest/addMediaPackage request, apart from the track itself"""
+        #NB: Order matters here, Opencast applies the most recent flavor to each following media field
+        data = {'episodeDCCatalog': ep_dc}
+        if ep_acl:
+            data['acl'] = ep_acl
+        else:
+            self.logger.debug(f"{ rec_id  }: Blank episode security was selected, skip creating episode ACL")
+        data['flavor'] = 'presentation/source'
+        return data
+
+    def _create_mediapackage(self, rec_id, chat_file, ep_dc, eth_dc, ep_acl):
+        """
+        Create the mediapackage, and add each catalog and attachment to it with its own request
+        """
+        self.logger.info(f"{ rec_id  }: Creating mediapackage")
+        mp = self._do_get(f'{ self.url }/ingest/createMediaPackage').text
+        self._check_valid_mediapackage(mp)
+
+        self.logger.debug(f"{ rec_id  }: Ingesting episode dublin core settings")
+        mp = self._do_post(f'{ self.url }/ingest/addDCCatalog', data={'flavor': 'dublincore/episode', 'mediaPackage': mp, 'dublinCore': ep_dc}).text
+        self._check_valid_mediapackage(mp)
+        if eth_dc:
+            self.logger.debug(f"{ rec_id  }: Ingesting episode ethterms")
+            mp = self._do_post(f'{ self.url }/ingest/addDCCatalog', data={'flavor': 'ethterms/episode', 'mediaPackage': mp, 'dublinCore': eth_dc}).text
             self._check_valid_mediapackage(mp)
-
-            self.logger.debug(f"{ rec_id  }: Ingesting episode dublin core settings")
-            mp = self._do_post(f'{ self.url }/ingest/addDCCatalog', data={'flavor': 'dublincore/episode', 'mediaPackage': mp, 'dublinCore': ep_dc}).text
+        if ep_acl:
+            self.logger.debug(f"{ rec_id  }: Ingesting episode security settings")
+            mp = self._do_post(f'{ self.url }/ingest/addAttachment', data={'flavor': 'security/xacml+episode', 'mediaPackage': mp}, files = {"BODY": ("xacml.xml", ep_acl, "text/xml") }).text
             self._check_valid_mediapackage(mp)
-            if eth_dc:
-                self.logger.debug(f"{ rec_id  }: Ingesting episode ethterms")
-                mp = self._do_post(f'{ self.url }/ingest/addDCCatalog', data={'flavor': 'ethterms/episode', 'mediaPackage': mp, 'dublinCore': eth_dc}).text
-                self._check_valid_mediapackage(mp)
-            if ep_acl:
-                self.logger.debug(f"{ rec_id  }: Ingesting episode security settings")
-                mp = self._do_post(f'{ self.url }/ingest/addAttachment', data={'flavor': 'security/xacml+episode', 'mediaPackage': mp}, files = {"BODY": ("xacml.xml", ep_acl, "text/xml") }).text
+        else:
+            self.logger.debug(f"{ rec_id  }: Blank episode security was selected, skip creating episode ACL")
+        if chat_file:
+            with open(chat_file, 'rb') as cobj:
+                self.logger.debug(f"{ rec_id  }: Ingesting chat transcript { chat_file }")
+                mp = self._do_post(f'{ self.url }/ingest/addAttachment', data={'flavor': 'chat/transcript', 'mediaPackage': mp, 'fileName': os.path.basename(chat_file)}, files = {"BODY": (os.path.basename(chat_file), cobj, "text/plain") }).text
+                self.logger.info(mp)
                 self._check_valid_mediapackage(mp)
-            else:
-                self.logger.debug(f"{ rec_id  }: Blank episode security was selected, skip creating episode ACL")
-            if chat_file:
-                with open(chat_file, 'rb') as cobj:
-                    self.logger.debug(f"{ rec_id  }: Ingesting chat transcript { chat_file }")
-                    mp = self._do_post(f'{ self.url }/ingest/addAttachment', data={'flavor': 'chat/transcript', 'mediaPackage': mp, 'fileName': os.path.basename(chat_file)}, files = {"BODY": (os.path.basename(chat_file), cobj, "text/plain") }).text
-                    self.logger.info(mp)
-                    self._check_valid_mediapackage(mp)
-            self.logger.info(f"{ rec_id  }: Ingesting zoom video { filename }")
-            mp = self._do_post(f'{ self.url }/ingest/addTrack', data={'flavor': 'presentation/source', 'mediaPackage': mp, 'fileName': os.path.basename(filename)}, files={ "BODY": (os.path.basename(filename), fobj, "video/mp4") }).text
-            self._check_valid_mediapackage(mp)
-            self.logger.info(f"{ rec_id  }: Triggering processing")
-            workflow = self._do_post(f'{ self.url }/ingest/ingest/{ workflow_id }', data={'mediaPackage': mp}).text
-
-        wfdict = xmltodict.parse(workflow)
-        mpid = wfdict['wf:workflow']['mp:mediapackage']['@id']
-        workflow_instance_id = wfdict['wf:workflow']['@id']
+        return mp
 
-        self.logger.info(f"Ingested { rec_id } as workflow { workflow_instance_id } on mediapackage { mpid }")
-        return mpid, workflow_instance_id
+    def _add_track_to_mediapackage(self, rec_id, mp, fobj, track_name):
+        if isinstance(fobj, TrackUrl):
+            self.logger.info(f"{ rec_id  }: Ingesting zoom video { track_name } by reference")
+            response = self._do_post_form(f'{ self.url }/ingest/addTrack', data={'flavor': 'presentation/source', 'mediaPackage': mp, 'url': fobj.url})
+        else:
+            self.logger.info(f"{ rec_id  }: Ingesting zoom video { track_name }")
+            self._prime_auth()
+            response = self._do_post(f'{ self.url }/ingest/addTrack', data={'flavor': 'presentation/source', 'mediaPackage': mp, 'fileName': track_name}, files={ "BODY": (track_name, fobj, "video/mp4") })
+        #An error page may well parse as xml, so check the status too before the track is checkpointed
+        response.raise_for_status()
+        mp = response.text
+        self._check_valid_mediapackage(mp)
+        return mp
 
     def create_series(self, title, acl_id, theme_id=None, **kwargs):
 
@@ -0,0 +1,84 @@
+import logging
+import threading
+
+from zingest import db
+from zingest.common import get_config_default
+from zingest.wakeup import Wakeup
+
+
+class OutboxRelay:
+    """
+    Publishes the queue messages written by db.create_queued_ingest.  The web process only has to commit the
+    ingest and its outbox entry, and the messages are then sent on in batches, so one publish (and one confirm)
+    covers however many ingests were created in the meantime.  If the queue is down the entries simply wait
+    in the database until it is back.
+
+    Messages are published at least once: a crash between publishing and removing the entries sends them
+    again, which is harmless since an ingest can only be claimed while it's NEW or due for a retry.
+    """
+
+    SECTION = "Queue"
+
+    def __init__(self, config, queue):
+        """
+        :param queue: The QueueBackend to publish to
+        """
+        self.logger = logging.getLogger(__name__)
+        self.queue = queue
+        self.batch_size = int(get_config_default(config, OutboxRelay.SECTION, "outbox_batch_size", 100))
+        self.interval = float(get_config_default(config, OutboxRelay.SECTION, "outbox_interval", 5))
+        if self.batch_size < 1:
+            raise ValueError(f"outbox_batch_size must be at least 1, not { self.batch_size }")
+        #Set by the gunicorn workers creating ingests, while the relay thread runs in the master
+        self.pending = Wakeup()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="outbox-relay", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.pending.set()
+        if self.thread:
+            self.thread.join()
+
+    def wake(self):
+        """
+        Let the relay know there are new entries, rather than waiting for its next poll.  Works from any process
+        forked after the relay was created, as well as from this one.
+        """
+        self.pending.set()
+
+    def relay(self):
+        """
+        Publish everything currently in the outbox.
+
+        :return: The number of messages published
+        """
+        total = 0
+        while True:
+            published = db.relay_outbox(self._publish, self.batch_size)
+            total += published
+            if published < self.batch_size:
+                return total
+
+    def _publish(self, entries):
+        self.queue.send_rabbit_msgs([ entry.get_message_args() for entry in entries ])
+
+    def run(self):
+        self.logger.info(f"Relaying queue messages from the outbox in batches of { self.batch_size }")
+        while not self.stopped.is_set():
+            #Cleared first, so an entry committed while we relay still gets picked up on the next pass
+            self.pending.clear()
+            try:
+                published = self.relay()
+                if published > 0:
+                    self.logger.debug(f"Relayed { published } messages from the outbox")
+            except Exception:
+                self.logger.exception(f"Unable to relay messages from the outbox, retrying in { self.interval } seconds")
+                #New entries don't help while the queue is down, so don't let them wake us
+                self.stopped.wait(self.interval)
+                continue
+            self.pending.wait(self.interval)
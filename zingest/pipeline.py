@@ -0,0 +1,113 @@
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+
+
+class Stage:
+    """
+    One step of a Pipeline: a bounded queue of jobs, drained by the stage's own pool of worker threads.
+    """
+
+    def __init__(self, name, handler, workers=1, capacity=None):
+        """
+        :param name: The name of the stage, used in logs and stats
+        :param handler: Called with each job.  Returning False finishes the job early, raising fails it
+        :param workers: The number of jobs this stage handles at once
+        :param capacity: The number of jobs which may wait for this stage, defaults to workers
+        """
+        if workers < 1:
+            raise ValueError(f"Stage { name } needs at least one worker, not { workers }")
+        self.logger = logging.getLogger(__name__)
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.capacity = capacity or workers
+        self.queue = queue.Queue(maxsize=self.capacity)
+        self.next = None
+        self.lock = threading.Lock()
+        self.busy = 0
+        self.blocked = 0
+        self.processed = 0
+        self.failed = 0
+
+    def start(self):
+        for i in range(self.workers):
+            threading.Thread(target=self._work, name=f"{ self.name }-{ i }", daemon=True).start()
+
+    def put(self, job, future):
+        #Blocks while the stage is full, which holds the previous stage back
+        self.queue.put((job, future))
+
+    def _work(self):
+        while True:
+            job, future = self.queue.get()
+            with self.lock:
+                self.busy += 1
+            try:
+                proceed = self.handler(job)
+            except Exception as e:
+                with self.lock:
+                    self.busy -= 1
+                    self.failed += 1
+                future.set_exception(e)
+                continue
+            with self.lock:
+                self.busy -= 1
+                self.processed += 1
+            if proceed is False or not self.next:
+                future.set_result(job)
+                continue
+            with self.lock:
+                self.blocked += 1
+            try:
+                self.next.put(job, future)
+            finally:
+                with self.lock:
+                    self.blocked -= 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'busy': self.busy,
+                #Finished here, but waiting for space in the next stage
+                'blocked': self.blocked,
+                'queued': self.queue.qsize(),
+                'capacity': self.capacity,
+                'processed': self.processed,
+                'failed': self.failed,
+            }
+
+
+class Pipeline:
+    """
+    A chain of Stages.  Each job is handed from one stage to the next, so different jobs can be in different
+    stages at once, and each stage's concurrency is sized to its own bottleneck.
+    """
+
+    def __init__(self, stages):
+        self.logger = logging.getLogger(__name__)
+        self.stages = stages
+        for stage, following in zip(stages, stages[1:]):
+            stage.next = following
+        for stage in stages:
+            stage.start()
+        self.logger.info(f"Pipeline started: { ', '.join(f'{ stage.name } ({ stage.workers })' for stage in stages) }")
+
+    def submit(self, job):
+        """
+        Queue job at the first stage, blocking while it is full.
+
+        :return: A Future which resolves to job once it has left the last stage, or to the exception which stopped it
+        """
+        future = Future()
+        self.stages[0].put(job, future)
+        return future
+
+    def capacity(self):
+        """:return: The number of jobs the pipeline can hold before submit() blocks"""
+        return sum(stage.workers + stage.capacity for stage in self.stages)
+
+    def stats(self):
+        return { stage.name: stage.stats() for stage in self.stages }
@@ -0,0 +1,382 @@
+import asyncio
+import functools
+import itertools
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from zingest.common import get_config_default
+from zingest.scheduler import FairScheduler
+
+
+class Delivery:
+    """The parts of pika's Basic.Deliver which callbacks use, for backends which aren't rabbit"""
+
+    def __init__(self, delivery_tag, routing_key):
+        self.delivery_tag = delivery_tag
+        self.routing_key = routing_key
+
+
+class QueueBackend:
+    """
+    Where ingests wait for an uploader.  Subclasses store and deliver the messages, by implementing _publish and
+    start_consuming_rabbitmsg.  The message format, ingest classes, retry tiers and fair scheduling are shared.
+
+    The public method names are those of the original, rabbit only, implementation.
+    """
+
+    #Ingests come in three classes, each with its own queue and share of the uploaders' time
+    # webhook: Recordings which have just finished, sent by Zoom.  These are what people are waiting for
+    # manual: A single recording ingested by hand
+    # bulk: Part of a bulk ingest, usually a backfill
+    WEBHOOK = 'webhook'
+    MANUAL = 'manual'
+    BULK = 'bulk'
+    CLASSES = [ WEBHOOK, MANUAL, BULK ]
+    DEFAULT_WEIGHTS = { WEBHOOK: 8, MANUAL: 4, BULK: 1 }
+    #Webhook ingests keep the original queue, so nothing queued before an upgrade is lost
+    QUEUES = { WEBHOOK: "zoomhook", MANUAL: "zoomhook.manual", BULK: "zoomhook.bulk" }
+    #Where ingests which have failed too often end up, for someone to look at
+    PARKING_QUEUE = "zoomhook.parked"
+    #The config section holding the options below
+    SECTION = "Queue"
+
+    def __init__(self, config):
+        self.logger = logging.getLogger(type(self).__module__)
+        self.weights = { name: int(get_config_default(config, self.SECTION, f"{ name }_weight", weight)) for name, weight in QueueBackend.DEFAULT_WEIGHTS.items() }
+        self.shortest_first = get_config_default(config, self.SECTION, "shortest_first", "false").lower() == "true"
+        #Failed ingests wait out each of these delays in turn, in a queue of their own, then go back to their class's queue
+        self.retry_delays = [ int(delay) for delay in get_config_default(config, self.SECTION, "retry_delays", "").split() ]
+        if any(delay < 1 for delay in self.retry_delays):
+            raise ValueError(f"{ self.SECTION } retry_delays must all be at least 1 second, not { self.retry_delays }")
+        #Retry queue name to its delay, and the queue it hands messages back to
+        self.retry_queues = {}
+        for ingest_class in QueueBackend.CLASSES:
+            for delay in self.retry_delays:
+                self.retry_queues[self._retry_queue(ingest_class, delay)] = (delay, QueueBackend.QUEUES[ingest_class])
+
+    def _construct_rabbit_msg(self, uuid, ingest_id, ingest_class=WEBHOOK, host=None, size=None):
+        self.logger.debug("Prepping message")
+
+        rabbit_msg = {
+            "uuid": uuid,
+            "ingest_id": ingest_id,
+            "class": ingest_class,
+            #Used to schedule the ingest fairly: whose recording it is, and how much there is to transfer
+            "host": host,
+            "size": size
+        }
+        self.logger.debug(f"Message is {rabbit_msg}")
+
+        return rabbit_msg
+
+    def _prepare_rabbit_msg(self, uuid, ingest_id, ingest_class=WEBHOOK, host=None, size=None):
+        """:return: The queue and body of the message"""
+        if ingest_class not in QueueBackend.QUEUES:
+            raise ValueError(f"Unknown ingest class { ingest_class }")
+        return QueueBackend.QUEUES[ingest_class], json.dumps(self._construct_rabbit_msg(uuid, ingest_id, ingest_class, host, size))
+
+    def _publish(self, messages, transaction=False):
+        """
+        :param messages: List of (queue, body) pairs
+        :param transaction: Queue either all of messages, or none of them
+        """
+        raise NotImplementedError()
+
+    def send_rabbit_msg(self, uuid, ingest_id, ingest_class=WEBHOOK, host=None, size=None):
+        """
+        :param ingest_class: One of CLASSES
+        :param host: The Zoom user id of the recording's host
+        :param size: The total size of the recording's files, in bytes
+        """
+        queue_name, body = self._prepare_rabbit_msg(uuid, ingest_id, ingest_class, host, size)
+        self.logger.debug(f"Sending message to queue {queue_name}")
+        self._publish([ (queue_name, body) ])
+        self.logger.debug("Done!")
+
+    def send_rabbit_msgs(self, batch):
+        """
+        Send many messages at once, in a single transaction.
+
+        :param batch: List of tuples of send_rabbit_msg's arguments, ie (uuid, ingest_id[, ingest_class, host, size])
+        """
+        messages = [ self._prepare_rabbit_msg(*args) for args in batch ]
+        if len(messages) == 0:
+            return
+        self.logger.debug(f"Sending { len(messages) } messages")
+        self._publish(messages, transaction=True)
+        self.logger.debug("Done!")
+
+    def _retry_queue(self, ingest_class, delay):
+        #Named for their delay, since a rabbit queue can't be redeclared with a different TTL
+        return f"{ QueueBackend.QUEUES[ingest_class] }.retry.{ delay }"
+
+    def retry_delay(self, attempts):
+        """
+        :param attempts: The number of failed attempts so far
+        :return: The seconds to wait before the next attempt.  Once every delay has been used the last one repeats
+        """
+        return self.retry_delays[min(attempts, len(self.retry_delays)) - 1]
+
+    def retry_rabbit_msg(self, msg, attempts, park=False):
+        """
+        Send msg back to its class's queue once its retry delay is over, or park it.  Only valid if retry_delays is set.
+
+        :param msg: The message as received, or constructed by _construct_rabbit_msg
+        :param attempts: The number of failed attempts so far
+        :param park: Give up on the ingest, and send msg to PARKING_QUEUE instead
+        """
+        ingest_class = msg.get('class') if msg.get('class') in QueueBackend.QUEUES else QueueBackend.WEBHOOK
+        queue_name = QueueBackend.PARKING_QUEUE if park else self._retry_queue(ingest_class, self.retry_delay(attempts))
+        self.logger.debug(f"Sending retry of ingest {msg.get('ingest_id')} to {queue_name}")
+        self._publish([ (queue_name, json.dumps(dict(msg, attempts=attempts))) ])
+
+    def start_consuming_rabbitmsg(self, callback, executor=None, prefetch_count=1, loop=None):
+        """
+        Consume the queues of every ingest class until the connection fails, or consuming is stopped.
+
+        With an executor or loop, messages are not run in the order they arrive, but in the order chosen by a
+        FairScheduler.
+
+        :param callback: Called with (method_frame, properties, body) for each message
+        :param executor: Optional concurrent.futures executor to run the callbacks on
+        :param prefetch_count: The number of messages run at once, and the number of unacknowledged messages held
+                               from each class's queue.  This should match the number of workers in executor so that
+                               we don't hoard messages other uploaders could be working on
+        :param loop: Optional asyncio event loop, running in another thread.  If set callback must be a coroutine
+                     function, which is scheduled on loop instead of being run on executor
+        """
+        raise NotImplementedError()
+
+    def _create_scheduler(self):
+        return FairScheduler(self.weights, self.shortest_first)
+
+    def _schedule(self, scheduler, ingest_class, method_frame, properties, body, ack):
+        """
+        Queue a delivered message in scheduler
+
+        :param ack: Called, from any thread, once the message has been processed
+        """
+        try:
+            msg = json.loads(body)
+        except ValueError:
+            msg = None
+        if not isinstance(msg, dict):
+            #The callback deals with broken messages, all that matters here is when it gets them
+            msg = {}
+        self.logger.debug(f"Message {method_frame.delivery_tag} from the {ingest_class} queue, scheduling callback")
+        scheduler.put((method_frame, properties, body, ack), ingest_class, msg.get('host'), msg.get('size'))
+
+    def _dispatch(self, scheduler, callback, executor, loop, slot_count, stopped=None):
+        """
+        Hand scheduled messages to executor or loop, whenever one of their slot_count slots is free.  With neither,
+        run them here, one at a time.  Returns once scheduler is closed or stopped is set.
+        """
+        slots = threading.BoundedSemaphore(slot_count)
+        while not stopped or not stopped.is_set():
+            slots.acquire()
+            item = scheduler.get(timeout=1)
+            if item is None:
+                slots.release()
+                if scheduler.closed:
+                    return
+                continue
+            method_frame, properties, body, ack = item
+            self.logger.debug(f"Message {method_frame.delivery_tag}, running callback")
+            if loop:
+                future = asyncio.run_coroutine_threadsafe(callback(method_frame, properties, body), loop)
+                future.add_done_callback(functools.partial(self._callback_done, method_frame, ack, slots))
+            elif executor:
+                executor.submit(self._run_callback, callback, method_frame, properties, body, ack, slots)
+            else:
+                self._run_callback(callback, method_frame, properties, body, ack, slots)
+
+    def _run_callback(self, callback, method_frame, properties, body, ack, slots=None):
+        try:
+            callback(method_frame, properties, body)
+        except Exception:
+            #The ingest is still in the database, so the backlog will pick it up again
+            self.logger.exception(f"Error processing message {method_frame.delivery_tag}")
+        ack()
+        if slots:
+            slots.release()
+
+    def _callback_done(self, method_frame, ack, slots, future):
+        if future.exception():
+            self.logger.error(f"Error processing message {method_frame.delivery_tag}", exc_info=future.exception())
+        ack()
+        slots.release()
+
+
+class MemoryQueue(QueueBackend):
+    """
+    Queues messages in this process's memory.  Nothing survives a restart, and only consumers in the same
+    process see the messages, so this is for tests, benchmarks, and deployments running everything in one process.
+    """
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.pending = self._create_scheduler()
+        self.parked = []
+        self.stopped = threading.Event()
+        self.tags = itertools.count(1)
+
+    def _publish(self, messages, transaction=False):
+        #Everything is queued at once anyway
+        for queue_name, body in messages:
+            if queue_name == QueueBackend.PARKING_QUEUE:
+                self.parked.append(body)
+            elif queue_name in self.retry_queues:
+                delay, target = self.retry_queues[queue_name]
+                timer = threading.Timer(delay, self._put, args=(target, body))
+                timer.daemon = True
+                timer.start()
+            else:
+                self._put(queue_name, body)
+
+    def _put(self, queue_name, body):
+        ingest_class = next(name for name, queue in QueueBackend.QUEUES.items() if queue == queue_name)
+        self._schedule(self.pending, ingest_class, Delivery(next(self.tags), queue_name), None, body, lambda: None)
+
+    def start_consuming_rabbitmsg(self, callback, executor=None, prefetch_count=1, loop=None):
+        self.stopped.clear()
+        self._dispatch(self.pending, callback, executor, loop, prefetch_count, self.stopped)
+
+    def stop_consuming(self):
+        """Make start_consuming_rabbitmsg return, leaving anything queued where it is"""
+        self.stopped.set()
+
+
+
+class SqliteQueue(QueueBackend):
+    """
+    Queues messages in an SQLite database, so that they survive restarts and can be shared between the
+    processes of a single host (eg, the webhook and the uploader) without a broker.
+
+    A consumer takes a message by pushing its available_at past visibility_timeout, and deletes it once it has
+    been processed.  If the consumer dies in between the message becomes available again, like an unacked
+    message in rabbit.
+    """
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.path = get_config_default(config, self.SECTION, "path", "queue.db")
+        self.poll_interval = float(get_config_default(config, self.SECTION, "poll_interval", 1))
+        self.visibility_timeout = int(get_config_default(config, self.SECTION, "visibility_timeout", 6 * 60 * 60))
+        self.stopped = threading.Event()
+        #WAL lets the consumer read while another process writes.  It can't be switched on inside a transaction
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.close()
+        with self._connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS message (id INTEGER PRIMARY KEY AUTOINCREMENT, queue TEXT NOT NULL, body TEXT NOT NULL, available_at REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS ix_message_queue_available ON message (queue, available_at)")
+        self.logger.info(f"Queueing messages in { self.path }")
+
+    def _connect(self):
+        #Connections are cheap, and one per call keeps this safe to use from any thread
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        return _Transaction(connection)
+
+    def _publish(self, messages, transaction=False):
+        #Each call is a single transaction anyway
+        now = time.time()
+        rows = []
+        for queue_name, body in messages:
+            if queue_name in self.retry_queues:
+                delay, queue_name = self.retry_queues[queue_name]
+                rows.append((queue_name, body, now + delay))
+            else:
+                rows.append((queue_name, body, now))
+        with self._connect() as connection:
+            connection.executemany("INSERT INTO message (queue, body, available_at) VALUES (?, ?, ?)", rows)
+
+    def _take(self, queue_name, limit):
+        """:return: Up to limit (id, body) pairs from queue_name, which are now invisible to other consumers"""
+        now = time.time()
+        with self._connect() as connection:
+            rows = connection.execute("SELECT id, body FROM message WHERE queue = ? AND available_at <= ? ORDER BY id LIMIT ?", (queue_name, now, limit)).fetchall()
+            taken = []
+            for message_id, body in rows:
+                #Conditional, in case another process took it between the select and now
+                updated = connection.execute("UPDATE message SET available_at = ? WHERE id = ? AND available_at <= ?", (now + self.visibility_timeout, message_id, now))
+                if 1 == updated.rowcount:
+                    taken.append((message_id, body))
+            return taken
+
+    def _ack(self, message_id, ingest_class, held, lock):
+        with self._connect() as connection:
+            connection.execute("DELETE FROM message WHERE id = ?", (message_id,))
+        with lock:
+            held[ingest_class] -= 1
+
+    def start_consuming_rabbitmsg(self, callback, executor=None, prefetch_count=1, loop=None):
+        self.stopped.clear()
+        scheduler = self._create_scheduler()
+        threading.Thread(target=self._dispatch, args=(scheduler, callback, executor, loop, prefetch_count, self.stopped),
+                         name="queue-dispatch", daemon=True).start()
+        #Messages taken from each class's queue and not yet processed, which like rabbit's prefetch is capped per class
+        held = { name: 0 for name in QueueBackend.CLASSES }
+        lock = threading.Lock()
+        try:
+            while not self.stopped.is_set():
+                found = False
+                for ingest_class in QueueBackend.CLASSES:
+                    with lock:
+                        room = prefetch_count - held[ingest_class]
+                    if room <= 0:
+                        continue
+                    for message_id, body in self._take(QueueBackend.QUEUES[ingest_class], room):
+                        found = True
+                        with lock:
+                            held[ingest_class] += 1
+                        ack = functools.partial(self._ack, message_id, ingest_class, held, lock)
+                        self._schedule(scheduler, ingest_class, Delivery(message_id, QueueBackend.QUEUES[ingest_class]), None, body, ack)
+                if not found:
+                    self.stopped.wait(self.poll_interval)
+        finally:
+            #Anything still scheduled becomes visible again once its visibility timeout is over
+            scheduler.close()
+
+    def stop_consuming(self):
+        """Make start_consuming_rabbitmsg return"""
+        self.stopped.set()
+
+
+class _Transaction:
+    """Runs the body of a with block in a transaction on connection, then closes it"""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.connection.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.connection.close()
+
+
+BACKENDS = [ 'rabbit', 'memory', 'sqlite' ]
+
+def create_queue(config, zoom):
+    """
+    Create the queue backend selected by [Queue] backend, rabbit by default
+
+    :param zoom: The Zoom client, which the rabbit backend requires
+    """
+    backend = get_config_default(config, "Queue", "backend", "rabbit").lower()
+    if 'rabbit' == backend:
+        #Imported here because zingest.rabbit imports this module
+        from zingest.rabbit import Rabbit
+        return Rabbit(config, zoom)
+    elif 'memory' == backend:
+        return MemoryQueue(config)
+    elif 'sqlite' == backend:
+        return SqliteQueue(config)
+    raise ValueError(f"Unknown queue backend { backend }, expected one of { BACKENDS }")
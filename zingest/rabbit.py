@@ -1,62 +1,198 @@
-import json
+import functools
 import logging
-import time
+import queue
+import threading
 
 import pika
+from pika.exceptions import AMQPConnectionError, ChannelClosed, ChannelWrongStateError
 
 import zingest
-from zingest.common import get_config
+from zingest.common import get_config, get_config_default
+from zingest.queues import QueueBackend
 
 
-class Rabbit:
+class Publisher:
+    """
+    A connection to the broker which is kept open for publishing, and reopened if it drops.  pika connections
+    are not thread safe, so a Publisher must only be used by one thread at a time.
+    """
+
+    #Errors which mean the connection or channel has gone, rather than that the broker refused a message
+    RECONNECT_ERRORS = (AMQPConnectionError, ChannelClosed, ChannelWrongStateError)
+
+    def __init__(self, parameters, confirm=False, queue_arguments={}):
+        """
+        :param parameters: The pika.ConnectionParameters to connect with
+        :param confirm: Whether single messages wait for the broker to confirm them
+        :param queue_arguments: dict of queue name to the arguments it must be declared with, if any
+        """
+        self.logger = logging.getLogger(__name__)
+        self.parameters = parameters
+        self.confirm = confirm
+        self.queue_arguments = queue_arguments
+        self.connection = None
+        self.channel = None
+        #Batches are published in a transaction, which can't share a channel with confirms
+        self.tx_channel = None
+        self.declared = set()
+
+    def _connect(self):
+        self.close()
+        self.logger.debug(f"Opening publisher connection to {self.parameters.host}")
+        self.connection = pika.BlockingConnection(self.parameters)
+        self.channel = self.connection.channel()
+        if self.confirm:
+            self.channel.confirm_delivery()
+
+    def _ensure_connected(self):
+        if not self.connection or not self.connection.is_open:
+            self._connect()
+        else:
+            #An idle BlockingConnection doesn't answer heartbeats, this does, and raises if the broker has given up on us
+            self.connection.process_data_events(0)
+
+    def _tx_channel(self):
+        if not self.tx_channel:
+            self.tx_channel = self.connection.channel()
+            self.tx_channel.tx_select()
+        return self.tx_channel
+
+    def publish(self, messages, transaction=False):
+        """
+        Publish messages, reconnecting and trying once more if the connection has dropped.
+
+        :param messages: List of (queue, body) pairs
+        :param transaction: Publish messages in a single transaction, so that either all of them or none are
+                            queued, and the broker has them once this returns
+        """
+        for attempt in range(2):
+            try:
+                self._ensure_connected()
+                channel = self._tx_channel() if transaction else self.channel
+                for queue_name, body in messages:
+                    if queue_name not in self.declared:
+                        channel.queue_declare(queue=queue_name, arguments=self.queue_arguments.get(queue_name))
+                        self.declared.add(queue_name)
+                    #With confirms, mandatory makes the broker report a message it could not queue
+                    channel.basic_publish(exchange='', routing_key=queue_name, body=body, mandatory=self.confirm and not transaction)
+                if transaction:
+                    channel.tx_commit()
+                return
+            except Publisher.RECONNECT_ERRORS as e:
+                if attempt > 0:
+                    raise
+                self.logger.warning(f"Publisher connection to {self.parameters.host} failed, reconnecting: {e}")
+                self.close()
+
+    def close(self):
+        try:
+            if self.connection and self.connection.is_open:
+                self.connection.close()
+        except Exception:
+            #It's being thrown away anyway
+            pass
+        self.connection = None
+        self.channel = None
+        self.tx_channel = None
+        self.declared = set()
+
+
+class Rabbit(QueueBackend):
+    """
+    Queues messages in RabbitMQ, with a queue for each ingest class, and TTL delay queues for retries
+    """
+
+    SECTION = "Rabbit"
 
     def __init__(self, config, zoom):
         if not zoom or type(zoom) != zingest.zoom.Zoom:
             raise TypeError("Zoom is missing or the wrong type!")
-        self.logger = logging.getLogger(__name__)
+        super().__init__(config)
         self.rabbit_url = get_config(config, "Rabbit", "host")
         self.rabbit_user = get_config(config, "Rabbit", "user")
         self.rabbit_pass = get_config(config, "Rabbit", "password")
         self.zoom = zoom
+        self.queue_arguments = {}
+        for queue_name, (delay, target) in self.retry_queues.items():
+            #Messages expire out of the delay queue, and are dead lettered back into the queue they came from
+            self.queue_arguments[queue_name] = {
+                'x-message-ttl': delay * 1000,
+                'x-dead-letter-exchange': '',
+                'x-dead-letter-routing-key': target,
+            }
+        #Publishing reuses connections from this pool, rather than connecting for every message.  Last in, first
+        #out, so the extra connections are only opened when there are concurrent senders
+        confirm = get_config_default(config, "Rabbit", "confirm_delivery", "false").lower() == "true"
+        pool_size = int(get_config_default(config, "Rabbit", "publisher_pool_size", 2))
+        if pool_size < 1:
+            raise ValueError(f"publisher_pool_size must be at least 1, not { pool_size }")
+        self.publishers = queue.LifoQueue()
+        for i in range(pool_size):
+            self.publishers.put(Publisher(self._connection_parameters(), confirm, self.queue_arguments))
         self.logger.info("Setup complete")
         self.logger.debug(f"Init rabbitmq connection to {self.rabbit_url} with user {self.rabbit_user}")
 
-    def _construct_rabbit_msg(self, uuid, ingest_id):
-        self.logger.debug("Prepping message")
-
-        rabbit_msg = {
-            "uuid": uuid,
-            "ingest_id": ingest_id
-        }
-        self.logger.debug(f"Message is {rabbit_msg}")
+    def _connection_parameters(self):
+        credentials = pika.PlainCredentials(self.rabbit_user, self.rabbit_pass)
+        return pika.ConnectionParameters(self.rabbit_url, credentials=credentials)
 
-        return rabbit_msg
+    def _publish(self, messages, transaction=False):
+        #Waits for a free publisher if every one is in use
+        publisher = self.publishers.get()
+        try:
+            #A transaction means the broker confirms the whole batch with one round trip
+            publisher.publish(messages, transaction)
+        finally:
+            self.publishers.put(publisher)
 
-    def send_rabbit_msg(self, uuid, ingest_id):
-        msg = self._construct_rabbit_msg(uuid, ingest_id)
-        self.logger.debug(f"Sending message to {self.rabbit_url}")
-        credentials = pika.PlainCredentials(self.rabbit_user, self.rabbit_pass)
-        connection = pika.BlockingConnection(pika.ConnectionParameters(self.rabbit_url, credentials=credentials))
-        channel = connection.channel()
-        channel.queue_declare(queue="zoomhook")
-        channel.basic_publish(exchange='',
-                              routing_key="zoomhook",
-                              body=json.dumps(msg))
-        connection.close()
-        self.logger.debug("Done!")
-
-    def start_consuming_rabbitmsg(self, callback):
+    def start_consuming_rabbitmsg(self, callback, executor=None, prefetch_count=1, loop=None):
+        """
+        Each class's queue is read on its own channel, so a backlog in one never holds up delivery from the others.
+        Without an executor or loop the callbacks run on the connection's thread, which blocks heartbeats for as
+        long as the callback runs.  See QueueBackend.
+        """
         self.logger.debug(f"Connecting to {self.rabbit_url} as {self.rabbit_user}")
-        credentials = pika.PlainCredentials(self.rabbit_user, self.rabbit_pass)
-        connection = pika.BlockingConnection(pika.ConnectionParameters(self.rabbit_url, credentials=credentials))
-        rcv_channel = connection.channel()
-        rcv_channel.queue_declare(queue="zoomhook")
-        for method_frame, properties, body in rcv_channel.consume('zoomhook'):
-            self.logger.debug(f"Message {method_frame.delivery_tag}, running callback")
-            callback(method_frame, properties, body)
-            rcv_channel.basic_ack(method_frame.delivery_tag)
-        requeued_messages = rcv_channel.cancel()
-        self.logger.debug('Requeued %i messages' % requeued_messages)
-        rcv_channel.close()
-        self.logger.debug("Closing rabbit connection")
-        connection.close()
+        connection = pika.BlockingConnection(self._connection_parameters())
+        scheduler = None
+        if loop or executor:
+            scheduler = self._create_scheduler()
+            threading.Thread(target=self._dispatch, args=(scheduler, callback, executor, loop, prefetch_count),
+                             name="rabbit-dispatch", daemon=True).start()
+
+        def on_message(ingest_class, channel, method_frame, properties, body):
+            ack = functools.partial(self._post_ack, connection, channel, method_frame)
+            if scheduler:
+                self._schedule(scheduler, ingest_class, method_frame, properties, body, ack)
+            else:
+                self.logger.debug(f"Message {method_frame.delivery_tag}, running callback")
+                self._run_callback(callback, method_frame, properties, body, ack)
+
+        channels = []
+        for ingest_class in Rabbit.CLASSES:
+            rcv_channel = connection.channel()
+            rcv_channel.queue_declare(queue=Rabbit.QUEUES[ingest_class])
+            rcv_channel.basic_qos(prefetch_count=prefetch_count)
+            rcv_channel.basic_consume(queue=Rabbit.QUEUES[ingest_class], on_message_callback=functools.partial(on_message, ingest_class))
+            channels.append(rcv_channel)
+        try:
+            #This dispatches the consumers of every channel on the connection, not just the first
+            channels[0].start_consuming()
+        finally:
+            if scheduler:
+                #Anything still scheduled is unacknowledged, so the broker requeues it once the connection closes
+                scheduler.close()
+            if connection.is_open:
+                self.logger.debug("Closing rabbit connection")
+                connection.close()
+
+    def _post_ack(self, connection, channel, method_frame):
+        try:
+            #pika is not thread safe, the ack has to be sent from the connection's own thread
+            connection.add_callback_threadsafe(functools.partial(self._ack, channel, method_frame.delivery_tag))
+        except Exception:
+            #If the connection has gone away the broker has already requeued the message
+            self.logger.warning(f"Unable to acknowledge message {method_frame.delivery_tag}, the connection is closed")
+
+    def _ack(self, channel, delivery_tag):
+        if channel.is_open:
+            channel.basic_ack(delivery_tag)
@@ -0,0 +1,177 @@
+import json
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+
+from zingest.common import RateLimited, get_config_default
+
+
+class RateLimiter:
+    """
+    Token buckets for Zoom's API rate limits, one per category of endpoint, so calls are spaced out before Zoom
+    has to reject them.  Every thread shares the buckets, and with a lock_file so does every process on the host
+    which uses the same file (eg, the webhook's gunicorn workers and the uploader).
+
+    Zoom's Retry-After header, and its daily quota headers, pause the whole category until it says to try again.
+    See https://marketplace.zoom.us/docs/api-reference/rate-limits
+    """
+
+    SECTION = "Zoom"
+
+    LIGHT = "light"
+    MEDIUM = "medium"
+    HEAVY = "heavy"
+    #Requests per second for a Pro account.  Business and higher accounts have higher limits, and can configure them.
+    DEFAULT_RATES = { LIGHT: 30, MEDIUM: 20, HEAVY: 10 }
+    #The zoomus functions we call, by __qualname__.  Anything else is assumed to be heavy.
+    ENDPOINTS = {
+        'RecordingComponentV2.get': LIGHT,
+        'UserComponentV2.get': LIGHT,
+        'RecordingComponentV2.list': MEDIUM,
+        'ContactsComponentV2.search': MEDIUM,
+    }
+
+    def __init__(self, config):
+        self.logger = logging.getLogger(__name__)
+        self.rates = { name: float(get_config_default(config, RateLimiter.SECTION, f"rate_limit_{ name }", rate)) for name, rate in RateLimiter.DEFAULT_RATES.items() }
+        for name, rate in self.rates.items():
+            if rate <= 0:
+                raise ValueError(f"rate_limit_{ name } must be positive, not { rate }")
+        #Calls which have to wait longer than this fail instead, so a daily quota doesn't hold threads for hours
+        self.max_wait = float(get_config_default(config, RateLimiter.SECTION, "rate_limit_max_wait", 300))
+        self.lock_file = get_config_default(config, RateLimiter.SECTION, "rate_limit_lock_file", None)
+        self.lock = threading.Lock()
+        self.state = {}
+        self.logger.debug(f"Zoom rate limits { self.rates } requests per second, shared through { self.lock_file or 'memory' }")
+
+    @staticmethod
+    def category(function):
+        return RateLimiter.ENDPOINTS.get(function.__qualname__, RateLimiter.HEAVY)
+
+    @contextmanager
+    def _locked_state(self):
+        with self.lock:
+            if not self.lock_file:
+                yield self.state
+                return
+            #Only imported when needed, fcntl is Unix only
+            import fcntl
+            with open(self.lock_file, 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    content = f.read()
+                    state = json.loads(content) if content else {}
+                    yield state
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _bucket(self, state, category, now):
+        rate = self.rates[category]
+        bucket = state.setdefault(category, {'tokens': rate, 'updated': now, 'paused_until': 0})
+        #A bucket holds at most one second's worth of tokens
+        bucket['tokens'] = min(rate, bucket['tokens'] + max(0, now - bucket['updated']) * rate)
+        bucket['updated'] = now
+        return bucket
+
+    def _reserve(self, category):
+        """
+        Take a token from category, possibly one which is only available in the future
+
+        :return: Seconds to wait before using the token, or before trying again if the category is paused
+        """
+        with self._locked_state() as state:
+            now = time.time()
+            bucket = self._bucket(state, category, now)
+            if bucket['paused_until'] > now:
+                #Spread out everyone waiting for the pause to end, rather than having them all retry at once
+                return bucket['paused_until'] - now + random.uniform(0, 1), False
+            bucket['tokens'] -= 1
+            return max(0, -bucket['tokens'] / self.rates[category]), True
+
+    def acquire(self, category):
+        """
+        Wait until a call to an endpoint in category is allowed
+
+        :raises RateLimited: If that would take longer than rate_limit_max_wait
+        """
+        while True:
+            wait, reserved = self._reserve(category)
+            if wait > self.max_wait:
+                raise RateLimited(f"Zoom's { category } rate limit is paused for another { int(wait) } seconds")
+            if wait > 0:
+                time.sleep(wait)
+            if reserved:
+                return
+
+    def pause(self, category, seconds):
+        """
+        Stop calls to category for seconds
+        """
+        with self._locked_state() as state:
+            now = time.time()
+            bucket = self._bucket(state, category, now)
+            bucket['paused_until'] = max(bucket['paused_until'], now + seconds)
+        self.logger.warning(f"Pausing Zoom { category } calls for { int(seconds) } seconds")
+
+    def observe(self, category, response, attempt=0):
+        """
+        Apply the rate limit headers of a response from Zoom
+
+        :param attempt: The number of times this call has already been rejected, for the backoff
+        :return: Whether the response was rejected for being over a rate limit
+        """
+        daily = 'daily' in response.headers.get('X-RateLimit-Type', '').lower()
+        remaining = response.headers.get('X-RateLimit-Remaining')
+        if daily and remaining is not None and remaining.isdigit() and int(remaining) <= 0:
+            #Out of quota for the day, no sense in waiting for a rejection first
+            self.pause(category, self._retry_after(response) or self._until_tomorrow())
+        if response.status_code != 429:
+            return False
+        seconds = self._retry_after(response)
+        if seconds is None:
+            seconds = self._until_tomorrow() if daily else self.backoff(attempt)
+        self.pause(category, seconds)
+        return True
+
+    @staticmethod
+    def backoff(attempt):
+        #Jittered, so that everyone rejected at once doesn't come back at once
+        return random.uniform(0.5, 1) * min(60, 2 ** attempt)
+
+    @staticmethod
+    def _retry_after(response):
+        """
+        :return: Seconds until Zoom's Retry-After header, which may be a number of seconds or a time, or None
+        """
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        value = value.strip()
+        if value.isdigit():
+            return float(value)
+        try:
+            when = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            try:
+                when = parsedate_to_datetime(value)
+            except (TypeError, ValueError):
+                return None
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=timezone.utc)
+        return max(0, (when - datetime.now(timezone.utc)).total_seconds())
+
+    @staticmethod
+    def _until_tomorrow():
+        #Daily quotas reset at midnight UTC
+        now = datetime.now(timezone.utc)
+        tomorrow = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        return (tomorrow - now).total_seconds()
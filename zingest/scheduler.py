@@ -0,0 +1,102 @@
+import heapq
+import itertools
+import logging
+import threading
+from collections import deque
+
+
+class FairScheduler:
+    """
+    Orders queued work by class, then by host, so that a large backfill cannot starve everything else.
+
+    Classes are served by stride scheduling: each time a class is picked it is charged 1 / weight, and the
+    class with the least charge goes next.  A class with weight 8 therefore gets eight turns for every one
+    of a class with weight 1, but never starves it.  Within a class the hosts take turns, so one person's
+    five hundred recordings are interleaved with everyone else's.  With shortest_first each host's own work
+    is ordered by size rather than by arrival.
+    """
+
+    def __init__(self, weights, shortest_first=False):
+        """
+        :param weights: dict of class name to its (positive) share of the work
+        :param shortest_first: Whether to order each host's work by size, smallest first
+        """
+        for name, weight in weights.items():
+            if weight <= 0:
+                raise ValueError(f"Class { name } needs a positive weight, not { weight }")
+        self.logger = logging.getLogger(__name__)
+        self.weights = dict(weights)
+        self.shortest_first = shortest_first
+        self.condition = threading.Condition()
+        self.closed = False
+        #Per class: the charge used for stride scheduling, the hosts in turn order, and each host's work
+        self.charge = { name: 0.0 for name in weights }
+        self.hosts = { name: deque() for name in weights }
+        self.work = { name: {} for name in weights }
+        #Breaks ties between equal sizes in arrival order
+        self.sequence = itertools.count()
+
+    def put(self, item, work_class, host=None, size=None):
+        """
+        Queue item.  Unknown classes are treated as the lowest weighted one.
+        """
+        if work_class not in self.weights:
+            self.logger.warning(f"Unknown class { work_class }, scheduling it as { self._lowest() }")
+            work_class = self._lowest()
+        with self.condition:
+            if len(self.hosts[work_class]) == 0:
+                #A class which has been idle doesn't get to spend the turns it missed all at once
+                busy = [ self.charge[name] for name in self.weights if len(self.hosts[name]) > 0 ]
+                if busy:
+                    self.charge[work_class] = max(self.charge[work_class], min(busy))
+            queued = self.work[work_class].get(host)
+            if queued is None:
+                queued = self.work[work_class][host] = []
+                self.hosts[work_class].append(host)
+            order = (size or 0) if self.shortest_first else 0
+            heapq.heappush(queued, (order, next(self.sequence), item))
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        """
+        Take the next item, waiting for one if necessary.
+
+        :return: The item, or None if the scheduler was closed or timeout expired
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.closed or self._queued() > 0, timeout):
+                return None
+            if self.closed:
+                return None
+            work_class = min((name for name in self.weights if len(self.hosts[name]) > 0), key=lambda name: self.charge[name])
+            self.charge[work_class] += 1.0 / self.weights[work_class]
+            hosts = self.hosts[work_class]
+            host = hosts.popleft()
+            queued = self.work[work_class][host]
+            _, _, item = heapq.heappop(queued)
+            if queued:
+                hosts.append(host)
+            else:
+                del self.work[work_class][host]
+            return item
+
+    def close(self):
+        """
+        Drop any queued work, and wake up anyone waiting in get()
+        """
+        with self.condition:
+            self.closed = True
+            for name in self.weights:
+                self.hosts[name].clear()
+                self.work[name].clear()
+            self.condition.notify_all()
+
+    def _lowest(self):
+        return min(self.weights, key=lambda name: self.weights[name])
+
+    def _queued(self):
+        return sum(len(queued) for work in self.work.values() for queued in work.values())
+
+    def stats(self):
+        with self.condition:
+            return { name: sum(len(queued) for queued in self.work[name].values()) for name in self.weights }
@@ -0,0 +1,43 @@
+import logging
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from zingest.common import get_config_default
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter which applies a default (connect, read) timeout to any request which does not set its own.
+    """
+
+    def __init__(self, timeout, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
+
+def create_session(config, group, default_read_timeout=300):
+    """
+    Create a pooled, keep-alive session for the upstream configured under group.
+
+    :param config: The configuration
+    :param group: The config section holding pool_size, connect_timeout, and read_timeout
+    :param default_read_timeout: Seconds to wait between bytes from the server if read_timeout is not configured
+    :return: A requests.Session whose connections are reused across calls (and threads)
+    """
+    logger = logging.getLogger(__name__)
+    pool_size = int(get_config_default(config, group, "pool_size", 10))
+    connect_timeout = float(get_config_default(config, group, "connect_timeout", 10))
+    read_timeout = float(get_config_default(config, group, "read_timeout", default_read_timeout))
+    logger.debug(f"Creating { group } session with { pool_size } pooled connections per host, timeouts ({ connect_timeout }, { read_timeout })")
+    session = requests.Session()
+    #pool_block=False: if every pooled connection is busy an extra one is opened rather than waiting, it just isn't kept afterwards
+    adapter = TimeoutHTTPAdapter((connect_timeout, read_timeout), pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
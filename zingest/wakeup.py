@@ -0,0 +1,37 @@
+import os
+import select
+
+
+class Wakeup:
+    """
+    Like threading.Event, but backed by a pipe so that it can also be set from processes forked after it was
+    created.  gunicorn --preload imports the app once in its master and then forks the workers, so background
+    threads started at import only run in the master, while the requests which have work for them arrive in
+    the workers.
+    """
+
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_blocking(self.read_fd, False)
+        os.set_blocking(self.write_fd, False)
+
+    def set(self):
+        try:
+            os.write(self.write_fd, b'\0')
+        except BlockingIOError:
+            #The pipe is full, so a wakeup is already pending
+            pass
+
+    def clear(self):
+        try:
+            while os.read(self.read_fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def wait(self, timeout=None):
+        """
+        :return: True if set, False if timeout passed first
+        """
+        readable, _, _ = select.select([ self.read_fd ], [], [], timeout)
+        return bool(readable)
@@ -1,10 +1,12 @@
+import copy
 import functools
+import json
 import logging
 from datetime import datetime, timedelta
-from random import random
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import quote
-import time
+import requests
 from requests import HTTPError
 
 import jwt
@@ -28,6 +30,7 @@ def patched_init(
         timeout=15,
         version=zoomus.util.API_VERSION_2,
         base_uri=None,
+        session=None,
     ):
         """Create a new Zoom client
 
@@ -42,6 +45,7 @@ def patched_init(
                          based on the API version chosen, but it can be
                          overriden so that the GDPR compliant base URI can
                          be used in the EU.
+        :param session: The requests.Session to send API requests through
         """
         try:
             base_uri = base_uri or zoomus.client.API_BASE_URIS[version]
@@ -49,7 +53,7 @@ def patched_init(
         except KeyError:
             raise RuntimeError("API version not supported: %s" % version)
 
-        super(ZoomClient, self).__init__(base_uri=base_uri, timeout=timeout)
+        super(ZoomClient, self).__init__(base_uri=base_uri, timeout=timeout, session=session)
 
         # Setup the config details
         self.config = {
@@ -58,20 +62,41 @@ def patched_init(
             "data_type": data_type,
             "version": version,
             "base_uri": base_uri,
-            "token": zoomus.util.generate_jwt(api_key, api_secret),
+            #Set, and refreshed, by Zoom._get_zoom_client
+            "token": None,
         }
 
         # Instantiate the components
         for key in self.components.keys():
             self.components[key] = self.components[key](
-                base_uri=base_uri, config=self.config
+                base_uri=base_uri, config=self.config, timeout=timeout, session=session
             )
 ZoomClient.__init__ = patched_init
 
+#zoomus sends every API call through the module level requests functions, ie, a new connection each time.
+#Route them through the client's pooled session instead.
+def patched_request(method):
+    def request(self, endpoint, params=None, data=None, headers=None, cookies=None):
+        if data and not zoomus.util.is_str_type(data):
+            data = json.dumps(data)
+        if headers is None and self.config.get("version") == zoomus.util.API_VERSION_2:
+            headers = {
+                "Authorization": "Bearer {}".format(self.config.get("token")),
+                "Content-Type": "application/json",
+            }
+        session = getattr(self, 'session', None) or requests
+        return session.request(method, self.url_for(endpoint), params=params, data=data, headers=headers, cookies=cookies, timeout=self.timeout)
+    return request
+for method in ['get', 'post', 'patch', 'delete', 'put']:
+    setattr(zoomus.util.ApiClient, f"{ method }_request", patched_request(method.upper()))
+
 
 
 from zingest import db
-from zingest.common import BadWebhookData, NoMp4Files, get_config
+from zingest.cache import TTLCache
+from zingest.common import BadWebhookData, NoMp4Files, get_config, get_config_default
+from zingest.ratelimit import RateLimiter
+from zingest.transport import create_session
 
 
 class Zoom:
@@ -86,10 +111,23 @@ class Zoom:
         self.logger.debug(f"Init with Zoom API key {self.api_key[0:3]}XXX{self.api_key[-3:]}")
         self.gdpr = get_config(config, 'Zoom', 'GDPR').lower() == 'true'
         self.logger.info(f"GDPR compliant endpoints in use: { self.gdpr }")
+        #Shared by the API client and the recording downloads, so both reuse the same keep-alive connections
+        self.session = create_session(config, 'Zoom', default_read_timeout=60)
+        self.rate_limiter = RateLimiter(config)
         self.zoom_client = None
         self.zoom_client_exp = None
         self.jwt_token = None
         self.jwt_token_exp = None
+        #How long catalogued recording files are trusted before asking Zoom again
+        self.file_catalog_ttl = timedelta(hours=float(get_config_default(config, 'Zoom', 'file_catalog_hours', 24)))
+        #Recordings which don't exist (yet) are cached too, so repeated lookups of them don't each cost an API call
+        self.recording_cache = TTLCache(
+            int(get_config_default(config, 'Zoom', 'recording_cache_size', 1024)),
+            float(get_config_default(config, 'Zoom', 'recording_cache_seconds', 300)),
+            float(get_config_default(config, 'Zoom', 'recording_cache_404_seconds', 60)),
+            lambda e: isinstance(e, HTTPError) and e.response is not None and e.response.status_code == 404)
+        #Concurrent Zoom lookups of users we don't know yet, the rate limiter keeps them within Zoom's limits
+        self.user_lookup_workers = int(get_config_default(config, 'Zoom', 'user_lookup_workers', 4))
 
     def _validate_object_fields(self, required_object_fields, obj):
         try:
@@ -183,10 +221,27 @@ class Zoom:
         return recording_files
 
     def get_recording_files(self, rec_id):
+        catalogued = db.find_recording_files(rec_id, datetime.utcnow() - self.file_catalog_ttl)
+        #Files which were still processing when they were catalogued may have changed since, so those go to Zoom
+        if any(file.file_type and file.file_type.lower() == 'mp4' for file in catalogued) and all(file.is_complete() for file in catalogued):
+            self.logger.debug(f"{ rec_id }: Using { len(catalogued) } catalogued files")
+            return [ file.serialize() for file in catalogued ]
         rec = self.get_recording(rec_id)
         self.validate_recording_object(rec)
         return self._parse_recording_files(rec)
 
+    def catalog_recording_files(self, recording):
+        """
+        Remember the files of recording, a recording object from Zoom, so ingesting it doesn't need to ask for them again
+        """
+        if 'uuid' not in recording or 'recording_files' not in recording:
+            return
+        try:
+            db.save_recording_files(recording['uuid'], recording['recording_files'])
+        except Exception:
+            #Only an optimisation, get_recording_files asks Zoom if the files are missing
+            self.logger.exception(f"Unable to catalog the files of { recording['uuid'] }")
+
     def create_recording_from_uuid(self, uuid):
         data = self.get_recording(uuid)
         return self._create_recording_from_data(data)
@@ -195,27 +250,43 @@ class Zoom:
         required_data = { x: data[x] for x in data if x in ('uuid', 'host_id', 'start_time', 'topic', 'duration') }
         return db.create_recording(required_data)
 
-    def get_download_token(self):
+    def get_download_token(self, lifetime=None):
+        """
+        :param lifetime: Optional timedelta.  If set, a new token valid for this long is minted, rather than
+                         returning the shared (short lived) token.  Used when someone else downloads the file later.
+        """
+        if lifetime:
+            return self._encode_token(datetime.utcnow() + lifetime)
         if not self.jwt_token or datetime.utcnow() + timedelta(seconds=1) > self.jwt_token_exp:
             #Expires after 5 minutes
             self.jwt_token_exp = datetime.utcnow() + timedelta(minutes=5)
-            payload = {"iss": self.api_key, "exp": self.jwt_token_exp}
-            self.jwt_token = jwt.encode(payload, self.api_secret, algorithm='HS256', headers=Zoom.JWT_HEADERS)
-            #PyJWT 2.0 and newer return a string, older versions need to be decoded
-            if type(self.jwt_token) is not str:
-                self.jwt_token = self.jwt_token.decode("utf-8")
+            self.jwt_token = self._encode_token(self.jwt_token_exp)
         return self.jwt_token
 
+    def _encode_token(self, expiry):
+        payload = {"iss": self.api_key, "exp": expiry}
+        token = jwt.encode(payload, self.api_secret, algorithm='HS256', headers=Zoom.JWT_HEADERS)
+        #PyJWT 2.0 and newer return a string, older versions need to be decoded
+        if type(token) is not str:
+            token = token.decode("utf-8")
+        return token
+
     def _get_zoom_client(self):
-        #Note: There is a ZoomClient.refresh_tokens(), but this appears to be *broken* somehow.  Creating a new client works though...
-        if not self.zoom_client or datetime.utcnow() + timedelta(seconds=1) > self.zoom_client_exp:
+        #Note: There is a ZoomClient.refresh_tokens(), but this appears to be *broken* somehow.
+        #The client and all of its components share one config dict though, so replacing the token in there works
+        if not self.zoom_client:
             self.logger.debug("Creating new zoom client")
-            # zoom client library set this interval, so we
-            self.zoom_client_exp = datetime.utcnow() + timedelta(hours=1)
+            #timeout=None leaves the timeouts to the session
             if self.gdpr:
-                self.zoom_client = ZoomClient(self.api_key, self.api_secret, base_uri=zoomus.client.API_BASE_URIS[zoomus.util.API_GDPR])
+                self.zoom_client = ZoomClient(self.api_key, self.api_secret, timeout=None, base_uri=zoomus.client.API_BASE_URIS[zoomus.util.API_GDPR], session=self.session)
             else:
-                self.zoom_client = ZoomClient(self.api_key, self.api_secret)
+                self.zoom_client = ZoomClient(self.api_key, self.api_secret, timeout=None, session=self.session)
+            self.zoom_client_exp = None
+        if not self.zoom_client_exp or datetime.utcnow() + timedelta(seconds=1) > self.zoom_client_exp:
+            self.logger.debug("Refreshing zoom client token")
+            # zoom client library set this interval, so we
+            self.zoom_client_exp = datetime.utcnow() + timedelta(hours=1)
+            self.zoom_client.config['token'] = self._encode_token(self.zoom_client_exp)
         return self.zoom_client
 
     def _cleaner(self, thing):
@@ -240,17 +311,18 @@ class Zoom:
 
     def _make_zoom_request(self, function, args, attempts=5):
         self.logger.debug(f"Making zoom call to { function.__qualname__ } with { args }")
-        resp = function(**args)
+        category = RateLimiter.category(function)
+        for attempt in range(attempts + 1):
+            self.rate_limiter.acquire(category)
+            resp = function(**args)
+            # we hit the Zoom API rate limit, the limiter waits as long as Zoom tells it to before the next call
+            # see https://marketplace.zoom.us/docs/api-reference/rate-limits
+            if not self.rate_limiter.observe(category, resp, attempt) or attempt == attempts:
+                break
+            self.logger.warning(
+                f"Calling {function.__qualname__} failed due to Zoom API rate limitation. "
+                f"Retry {attempts - attempt} more times.")
         if 400 <= resp.status_code < 500:
-            if resp.status_code == 429:
-                # we hit the Zoom API rate limit,
-                # see https://marketplace.zoom.us/docs/api-reference/rate-limits
-                if attempts > 0:
-                    self.logger.warning(
-                        f"Calling {function.__qualname__} failed due to Zoom API rate limitation. "
-                        f"Retry {attempts} more times.")
-                    time.sleep(random(1, 5))
-                    return self._make_zoom_request(self, function, args, attempts=(attempts - 1))
             resp.raise_for_status()
         resp_dict = resp.json()
         self._cleaner(resp_dict)
@@ -261,6 +333,30 @@ class Zoom:
         user = self.get_user(user_id_or_email)
         return self.format_user_name(user)
 
+    def get_user_names(self, user_ids):
+        """
+        Look up the plaintext names of many users at once.  Users in the database are found with a single query,
+        the rest are fetched from Zoom concurrently.
+
+        :return: dict of user id to name
+        """
+        user_ids = set(user_ids)
+        names = { user_id: self.format_user_name(user.serialize()) for user_id, user in db.find_users_by_ids(user_ids).items() }
+        unknown = [ user_id for user_id in user_ids if user_id not in names ]
+        if unknown:
+            self.logger.debug(f"Looking up { len(unknown) } users in Zoom")
+            with ThreadPoolExecutor(max_workers=max(1, min(self.user_lookup_workers, len(unknown))), thread_name_prefix="zoom-user") as executor:
+                names.update(zip(unknown, executor.map(self._lookup_user_name, unknown)))
+        return names
+
+    def _lookup_user_name(self, user_id):
+        try:
+            return self.get_user_name(user_id)
+        except Exception:
+            #One missing user (eg, since deleted from Zoom) shouldn't stop the rest from being listed
+            self.logger.exception(f"Unable to look up user { user_id }, showing their id instead")
+            return user_id
+
     def format_user_name(self, user):
         return f"{ user['last_name'] }, { user['first_name'] }"
 
@@ -325,6 +421,7 @@ class Zoom:
         zoom_meetings = zoom_results['meetings']
         for meeting in zoom_meetings:
             db.create_recording_if_needed(meeting)
+            self.catalog_recording_files(meeting)
         self.logger.debug(f"Got a list of { len(zoom_meetings) } meetings")
         #We're requerying the DB here since we need to get *all* of the recordings, not the ones we just created
         ids = [ m['uuid'] for m in zoom_meetings ]
@@ -355,19 +452,30 @@ class Zoom:
     def _build_renderable_event_list(self, db_recordings, min_duration=0):
         existing_data = self._get_statuses_for([ meet.get_rec_id() for meet in db_recordings ])
 
+        names = self.get_user_names(rec.get_user_id() for rec in db_recordings)
+
         renderable = []
         for rec in db_recordings:
             rec_uuid = rec.get_rec_id()
             render = rec.serialize()
-            render['host'] = self.get_user_name(render['host'])
+            render['host'] = names[render['host']]
             render['too_short'] =  int(render['duration']) < int(min_duration)
             render['status'] = db.Status.str(existing_data[rec_uuid]) if rec_uuid in existing_data else db.Status.str(db.Status.NEW)
             renderable.append(render)
         return renderable
 
-    @functools.lru_cache(maxsize=32)
+    def get_recording(self, recording_id):
+        #A copy, so callers can't change the cached recording
+        return copy.deepcopy(self.recording_cache.get_or_load(recording_id, self._fetch_recording))
+
+    def invalidate_recording(self, recording_id):
+        """
+        Forget the cached copy of recording_id, eg, because a webhook event says it has changed
+        """
+        self.recording_cache.invalidate(recording_id)
+
     @db.with_session
-    def get_recording(dbs, self, recording_id):
+    def _fetch_recording(dbs, self, recording_id):
         try:
             if not recording_id:
                 raise ValueError('Recording ID not set or is empty.')
@@ -381,7 +489,9 @@ class Zoom:
                 args = { 'meeting_id': quote(quote(recording_id, safe=''), safe='') }
             else:
                 args = { 'meeting_id': recording_id }
-            return self._make_zoom_request(fn, args)
+            recording = self._make_zoom_request(fn, args)
+            self.catalog_recording_files(recording)
+            return recording
         except HTTPError as e:
             self.logger.debug(f"HTTPError fetching { recording_id }")
             if e.response.status_code == 404: